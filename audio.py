@@ -1,26 +1,42 @@
+import os
 import socket
+import struct
 import subprocess
 import platform
-import time
 import logging
 import threading
-import sounddevice as sd
+import time
 import numpy as np
+try:
+    import sounddevice as sd
+except OSError:  # no PortAudio, only bench_audio.py's null output can play
+    sd = None
 from config import app_config
+from runtime import runtime_state
+import audio_codec
+from jitter import JitterBuffer, SEQ_MOD
+from ringbuffer import RingBuffer
+from drift import DriftCompensator
+import capture
+import logsetup
 
 target_ip = app_config.audio_ip
+multicast_group = app_config.audio_multicast
 
 PORT = app_config.audio_port
 CHANNELS = 2
 RATE = 44100 
 FORMAT = 's16le'
 CHUNK_SIZE = 1024
+STATS_INTERVAL = 10  # seconds between receiver stats log lines
+REPORT_INTERVAL = 1.0  # seconds between receiver reports to the sender
+PLAYBACK_BLOCK = 256  # frames per sounddevice callback
+RING_SECONDS = 0.5
 
 sock , process = None , None 
 
 INPUT = 'audio=Stereo Mix (Realtek(R) Audio)'
-
-logging.basicConfig(level=logging.INFO, filename="logs.log", filemode="a", format="[Audio] - %(message)s")
+INPUT_DEVICE = 'Stereo Mix'  # sounddevice name match for the same loopback input
 
 def cleanup(sock=None, process=None):
     try:
@@ -49,83 +65,307 @@ def mute_output():
 def unmute_output():
     subprocess.run(['pactl', 'set-sink-mute', '@DEFAULT_SINK@', '0'])
 
+def destinations():
+    """Where one captured stream goes, the multicast group or every unicast receiver."""
+    if multicast_group:
+        return [(multicast_group, PORT)]
+    ips = [target_ip] + [ip for ip in app_config.audio_targets if ip != target_ip]
+    return [(ip, PORT) for ip in ips if ip]
+
+def resolve(host):
+    try:
+        return socket.gethostbyname(host)
+    except OSError:
+        return host
+
+class Receivers:
+    """Tracks what each receiver decodes and reports, from replies on the sending socket."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.caps = {}  # addr -> codec names
+        self.reports = {}  # addr -> (time, stats)
+        self.changed = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(256)
+            except ConnectionResetError:
+                continue  # Windows reports an unreachable port here
+            except OSError:
+                break
+            report = audio_codec.parse_report(data)
+            if report is not None:
+                self.reports[addr] = (time.monotonic(), report)
+                continue
+            caps = audio_codec.parse_caps(data)
+            if caps is not None and caps != self.caps.get(addr):
+                self.caps[addr] = caps
+                self.changed.set()
+
+    def common_caps(self, expected=()):
+        """Codecs every answering receiver decodes.
+
+        None when nobody answered or when one of the `expected` hosts did not:
+        a receiver older than the handshake never answers and only plays raw PCM.
+        """
+        if not self.caps:
+            return None
+        answered = {addr[0] for addr in self.caps}
+        if any(host not in answered for host in expected):
+            return None
+        answers = list(self.caps.values())
+        return [name for name in answers[0] if all(name in caps for caps in answers[1:])]
+
+    def log_stats(self, sent):
+        now = time.monotonic()
+        for addr, (at, report) in list(self.reports.items()):
+            if now - at > STATS_INTERVAL:
+                del self.reports[addr]
+                logging.info(f"Receiver {addr[0]} stopped reporting")
+                continue
+            report = {name: round(value, 1) for name, value in report.items()}
+            logging.info(f"Receiver {addr[0]}: sent {sent}, {report}")
+
+def open_capture(device, input_args, rate, frame_samples):
+    """Capture in process through sounddevice, or through ffmpeg as a fallback."""
+    backend = app_config.audio_capture
+    if backend != "ffmpeg":
+        try:
+            return capture.DeviceCapture(device, rate, CHANNELS, frame_samples)
+        except Exception as e:
+            if backend == "sounddevice":
+                raise
+            print(f"Capture device unavailable ({e}), using ffmpeg")
+            logging.info(f"Capture device unavailable ({e}), using ffmpeg")
+    return capture.FfmpegCapture(input_args, rate, CHANNELS)
+
+def stream_audio(device, input_args, targets=None, open_source=open_capture):
+    """Capture audio and send it in the format the receiver accepts.
+
+    A HELLO asks every receiver for its codecs and the stream uses a codec
+    they all decode. When a unicast receiver does not answer, the stream is
+    raw PCM as before.
+    Capture restarts whenever the common codec changes, since Opus needs
+    48 kHz input. Returns when the source ends.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    if targets is None:
+        targets = destinations()
+    source = None
+
+    def hello():
+        for dest in targets:
+            sock.sendto(audio_codec.HELLO, dest)
+
+    hello()
+    receivers = Receivers(sock)
+    for _ in range(2):
+        if receivers.changed.wait(audio_codec.NEGOTIATE_TIMEOUT):
+            if multicast_group or len(receivers.caps) == len(targets):
+                break
+            receivers.changed.clear()  # give the other receivers a chance to answer
+        hello()
+
+    # Unicast receivers are known, one that never answers gets raw PCM
+    expected = [] if multicast_group else [resolve(ip) for ip, _ in targets]
+
+    def pick_codec():
+        return audio_codec.choose(receivers.common_caps(expected), app_config.audio_codec, RATE, CHANNELS,
+                                  app_config.audio_bitrate, app_config.audio_frame_ms)
+
+    sent = 0
+    next_stats = time.monotonic() + STATS_INTERVAL
+    try:
+        codec = pick_codec()
+        while True:
+            receivers.changed.clear()
+            if codec is None:
+                rate, frame_bytes = RATE, CHUNK_SIZE
+                print("Receiver did not answer, sending raw PCM")
+                logging.info("Sending raw PCM")
+            else:
+                rate, frame_bytes = codec.rate, codec.frame_size * CHANNELS * 2
+                print(f"Sending {codec.name} audio")
+                logging.info(f"Sending {codec.name} audio, {app_config.audio_frame_ms} ms frames")
+            source = open_source(device, input_args, rate, frame_bytes // (CHANNELS * 2))
+            logging.info(f"Capturing through {source.name}")
+            seq = timestamp = 0
+            while True:
+                if receivers.changed.is_set():
+                    # A receiver (re)joined, restart only if the common codec changed
+                    receivers.changed.clear()
+                    new_codec = pick_codec()
+                    if getattr(new_codec, "name", None) != getattr(codec, "name", None):
+                        codec = new_codec
+                        break
+                data = source.read(frame_bytes)
+                if len(data) < frame_bytes:
+                    return
+                if codec is not None:
+                    data = audio_codec.pack(codec, seq, timestamp, codec.encode(data))
+                    seq += 1
+                    timestamp += codec.frame_size
+                # Encoded once, however many receivers there are
+                for dest in targets:
+                    sock.sendto(data, dest)
+                sent += 1
+                if time.monotonic() >= next_stats:
+                    next_stats += STATS_INTERVAL
+                    receivers.log_stats(sent)
+            source.close()
+            source = None
+    finally:
+        if source:
+            source.close()
+        cleanup(sock)
+
 def send_audio_linux():
     monitor = get_monitor_source()
     mute_output()
-    print(f"Sending audio  {target_ip}:{PORT}")
-    logging.info(f"Sending audio {target_ip}:{PORT}")
-
-    ffmpeg_cmd = [
-        'ffmpeg',
-        '-f', 'pulse',
-        '-i', monitor,
-        '-ac', str(CHANNELS),
-        '-ar', str(RATE),
-        '-f', 's16le',
-        '-loglevel', 'info',
-        '-'
-    ]
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE)
+    print(f"Sending audio to {', '.join(ip for ip, _ in destinations())}:{PORT}")
+    logging.info(f"Sending audio to {destinations()}")
     print(f"📤 Sending audio from {monitor} (muted locally)")
+    # The ALSA "pulse" device records whatever PULSE_SOURCE names
+    os.environ["PULSE_SOURCE"] = monitor
     try:
-        while True:
-            data = process.stdout.read(CHUNK_SIZE)
-            if not data:
-                break
-            sock.sendto(data, (target_ip, PORT))
+        stream_audio('pulse', ['-f', 'pulse', '-i', monitor])
     except KeyboardInterrupt:
         print("❌ Sender stopped.")
     finally:
         unmute_output()
-        cleanup(sock,process)
 
 def send_audio_windows():
-    ffmpeg_cmd = [
-        'ffmpeg',
-        '-f', 'dshow',
-        '-i', str(INPUT),  
-        '-ar', str(RATE),
-        '-ac' , str(CHANNELS),
-        '-f', 's16le',
-        '-loglevel', 'info',
-        '-'
-    ]
+    print(f"Sending audio to {', '.join(ip for ip, _ in destinations())}:{PORT}")
+    logging.info(f"Sending audio to {destinations()}")
+    try:
+        stream_audio(INPUT_DEVICE, ['-f', 'dshow', '-i', str(INPUT)])
+    except KeyboardInterrupt:
+        print("❌ Audio sending stopped.")
 
-    print(f"Sending audio  {target_ip}:{PORT}")
-    logging.info(f"Sending audio {target_ip}:{PORT}")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE)
+def play_audio(buffer, output_stream=None):
+    """Decode frames from the jitter buffer into the ring the device callback drains.
 
+    The callback wakes this thread whenever the ring runs low, so frames
+    leave the jitter buffer at the device's pace and the socket loop never
+    waits on the sound card. Frames are resampled slightly to hold the
+    buffered audio at the jitter buffer's target despite clock drift.
+    `output_stream` replaces sd.OutputStream.
+    """
+    output_stream = output_stream or sd.OutputStream
+    stream = None
+    stream_rate = None
+    ring = None
+    drift = None
+    decoder = None
+    frame_samples = PLAYBACK_BLOCK
+    need_data = threading.Event()
+
+    def callback(outdata, frames, time_info, status):
+        ring.read_into(outdata)
+        if ring.fill() < PLAYBACK_BLOCK + frame_samples:
+            need_data.set()
+
+    next_stats = time.monotonic() + STATS_INTERVAL
     try:
         while True:
-            data = process.stdout.read(CHUNK_SIZE)
-            if not data:
-                break
-            sock.sendto(data, (target_ip, PORT))
-    except KeyboardInterrupt:
-        print("❌ Audio sending stopped.")
+            if ring is not None and ring.fill() >= PLAYBACK_BLOCK + frame_samples:
+                need_data.wait(0.1)
+                need_data.clear()
+                continue
+            item = buffer.pop()
+            if item is not None:
+                decoder, payload = item
+                pcm = decoder.decode(payload)
+                frame_samples = len(pcm) // (CHANNELS * 2)
+            elif decoder is not None:
+                pcm = decoder.conceal(frame_samples)
+            else:
+                time.sleep(0.005)  # nothing received yet
+                continue
+            if decoder.rate != stream_rate:
+                if stream:
+                    stream.close()
+                ring = RingBuffer(int(decoder.rate * RING_SECONDS), CHANNELS)
+                drift = DriftCompensator(decoder.rate, CHANNELS)
+                stream = output_stream(
+                    samplerate=decoder.rate,
+                    channels=CHANNELS,
+                    dtype='int16',
+                    blocksize=PLAYBACK_BLOCK,
+                    callback=callback
+                )
+                ring.write(pcm)
+                stream.start()
+                stream_rate = decoder.rate
+            else:
+                buffered = buffer.depth() * frame_samples + ring.fill()
+                target = buffer.target * frame_samples + PLAYBACK_BLOCK + frame_samples
+                drift.update(buffered, target, frame_samples)
+                ring.write(memoryview(drift.process(pcm)).cast("B"))
+            if time.monotonic() >= next_stats:
+                next_stats += STATS_INTERVAL
+                ppm = round((drift.ratio - 1) * 1e6)
+                logging.info(f"Jitter buffer {buffer.stats()}, device underruns {ring.underruns}, drift correction {ppm} ppm")
     finally:
-        cleanup(sock,process)
-def receive_audio():
+        if stream:
+            stream.close()
+
+def receive_audio(port=PORT, buffer=None, output_stream=None):
     print(f"Playing Audio...")
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(("0.0.0.0", PORT))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    if multicast_group:
+        membership = struct.pack("4s4s", socket.inet_aton(multicast_group), socket.inet_aton("0.0.0.0"))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
 
-    stream = sd.OutputStream(
-        samplerate=RATE,
-        channels=CHANNELS,
-        dtype='int16',
-        blocksize=CHUNK_SIZE
-    )
+    if buffer is None:
+        buffer = JitterBuffer()
+    threading.Thread(target=play_audio, args=(buffer, output_stream), daemon=True).start()
+    decoders = {}
+    caps_sent = {}
+    # Raw PCM from legacy senders is numbered in arrival order
+    raw_decoder = audio_codec.PcmCodec(RATE, CHANNELS)
+    raw_seq = raw_timestamp = 0
+    next_report = 0.0
 
     try:
-        with stream:
-            while True:
-                data, _ = sock.recvfrom(CHUNK_SIZE * CHANNELS * 2) 
-                audio_array = np.frombuffer(data, dtype='int16').reshape(-1, CHANNELS)
-                stream.write(audio_array)
+        while True:
+            data, addr = sock.recvfrom(65536)
+            if data == audio_codec.HELLO:
+                sock.sendto(audio_codec.caps_message(), addr)
+                continue
+            try:
+                codec_id, seq, timestamp, payload = audio_codec.unpack(data)
+            except ValueError as e:
+                logging.info(f"Dropped packet: {e}")
+                continue
+            if codec_id is None:
+                decoder, seq, timestamp, payload = raw_decoder, raw_seq, raw_timestamp, data
+                raw_seq = (raw_seq + 1) % SEQ_MOD
+                raw_timestamp += len(data) // (CHANNELS * 2)
+                # A sender started before us is still sending raw PCM, tell it what we decode
+                now = time.monotonic()
+                if now - caps_sent.get(addr, 0) > 1.0:
+                    caps_sent[addr] = now
+                    sock.sendto(audio_codec.caps_message(), addr)
+            else:
+                if codec_id not in decoders:
+                    decoders[codec_id] = audio_codec.decoder_for(codec_id, RATE, CHANNELS)
+                    if decoders[codec_id] is None:
+                        logging.info(f"Cannot decode audio codec {codec_id}")
+                decoder = decoders[codec_id]
+                if decoder is None:
+                    continue
+                now = time.monotonic()
+                if now >= next_report:
+                    next_report = now + REPORT_INTERVAL
+                    sock.sendto(audio_codec.make_report(buffer.stats()), addr)
+            buffer.push(seq, timestamp, decoder.rate, (decoder, payload))
     except KeyboardInterrupt:
         print("❌ Receiver stopped.")
     finally:
@@ -147,20 +387,19 @@ def receive_audio_ffplay():
         print("❌ Receiver stopped.")
 
 def main():
+    logsetup.setup("audio")
+
     def monitor_stop():
-        while True:
-            if not app_config.is_running:
-                cleanup()
-                break
-            time.sleep(1)
+        runtime_state.wait_until(lambda: not runtime_state.is_running or runtime_state.stop_flag)
+        cleanup()
 
+    runtime_state.connect()
     threading.Thread(target=monitor_stop, daemon=True).start()
 
     os_type = platform.system().lower()
     if app_config.audio_mode == "Receive_Audio":
-        if os_type == "linux":
-            receive_audio_ffplay()
-        elif os_type == "windows":
+        if os_type in ("linux", "windows"):
+            # ffplay cannot follow the framed formats, play through sounddevice everywhere
             receive_audio()
     elif app_config.audio_mode == "Share_Audio":
         if os_type == "linux":
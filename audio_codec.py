@@ -0,0 +1,142 @@
+# audio_codec.py
+import struct
+
+try:
+    import opuslib
+except Exception:  # missing package or libopus
+    opuslib = None
+
+# Every framed datagram starts with this header, receivers that predate it
+# only ever get raw PCM.
+MAGIC = b"PA"
+VERSION = 2
+HEADER = struct.Struct("<2sBBHI")  # magic, version, codec id, sequence, timestamp (samples)
+SEQ_MOD = 1 << 16
+TIMESTAMP_MOD = 1 << 32
+
+CODEC_PCM = 0
+CODEC_OPUS = 1
+
+# Control datagrams. HELLO is a whole number of stereo s16 frames so a
+# legacy receiver plays it as two samples of noise instead of failing.
+HELLO = b"PAHELLO\x00"
+CAPS_PREFIX = b"PACAPS "
+NEGOTIATE_TIMEOUT = 0.5
+
+# Receiver reports, sent back to the sender about once a second
+REPORT = struct.Struct("<4sIIIIHff")  # magic, received, late, concealed, underruns, depth, jitter ms, latency ms
+REPORT_MAGIC = b"PARR"
+REPORT_FIELDS = ("received", "late", "concealed", "underruns", "depth", "jitter_ms", "latency_ms")
+
+OPUS_RATE = 48000
+OPUS_FRAME_MS = (2.5, 5, 10, 20, 40, 60)
+OPUS_MAX_FRAME = OPUS_RATE * 120 // 1000
+
+class PcmCodec:
+    """Uncompressed s16le, framed so the receiver knows what it gets."""
+    id = CODEC_PCM
+    name = "pcm"
+
+    def __init__(self, rate, channels, frame_ms=10):
+        self.rate = rate
+        self.channels = channels
+        self.frame_size = int(rate * frame_ms / 1000)
+
+    def encode(self, pcm):
+        return pcm
+
+    def decode(self, payload):
+        return payload
+
+    def conceal(self, samples):
+        return bytes(samples * self.channels * 2)
+
+class OpusCodec:
+    """Opus through opuslib, always 48 kHz as the encoder requires.
+
+    The restricted low delay mode keeps the algorithmic delay at 2.5 ms,
+    so the added latency is mostly the frame duration itself.
+    """
+    id = CODEC_OPUS
+    name = "opus"
+    rate = OPUS_RATE
+
+    def __init__(self, channels, bitrate=64000, frame_ms=10):
+        if frame_ms not in OPUS_FRAME_MS:
+            print(f"[Audio] Opus cannot use {frame_ms} ms frames, using 10 ms")
+            frame_ms = 10
+        self.channels = channels
+        self.bitrate = bitrate
+        self.frame_size = int(OPUS_RATE * frame_ms / 1000)
+        self.encoder = None
+        self.decoder = None
+
+    def encode(self, pcm):
+        if self.encoder is None:
+            self.encoder = opuslib.Encoder(OPUS_RATE, self.channels, opuslib.APPLICATION_RESTRICTED_LOWDELAY)
+            self.encoder.bitrate = self.bitrate
+        return self.encoder.encode(bytes(pcm), self.frame_size)
+
+    def decode(self, payload):
+        if self.decoder is None:
+            self.decoder = opuslib.Decoder(OPUS_RATE, self.channels)
+        return self.decoder.decode(bytes(payload), OPUS_MAX_FRAME)
+
+    def conceal(self, samples):
+        # An empty packet runs the decoder's loss concealment
+        if self.decoder is None:
+            self.decoder = opuslib.Decoder(OPUS_RATE, self.channels)
+        return self.decoder.decode(b"", samples)
+
+def supported():
+    """Codec names this build can decode, best first."""
+    return ["opus", "pcm"] if opuslib else ["pcm"]
+
+def caps_message():
+    return CAPS_PREFIX + ",".join(supported()).encode()
+
+def parse_caps(data):
+    """Return the codec names of a CAPS datagram, or None for anything else."""
+    if not data.startswith(CAPS_PREFIX):
+        return None
+    return data[len(CAPS_PREFIX):].decode(errors="replace").split(",")
+
+def make_report(stats):
+    return REPORT.pack(REPORT_MAGIC, *(stats[name] for name in REPORT_FIELDS))
+
+def parse_report(data):
+    """Return the stats of a receiver report, or None for anything else."""
+    if len(data) != REPORT.size or not data.startswith(REPORT_MAGIC):
+        return None
+    return dict(zip(REPORT_FIELDS, REPORT.unpack(data)[1:]))
+
+def choose(caps, preferred, rate, channels, bitrate, frame_ms):
+    """Pick the codec to send with, None means raw PCM for a legacy receiver."""
+    if caps is None:
+        return None
+    if preferred == "opus" and "opus" in caps and opuslib:
+        return OpusCodec(channels, bitrate, frame_ms)
+    return PcmCodec(rate, channels, frame_ms)
+
+def decoder_for(codec_id, rate, channels):
+    if codec_id == CODEC_PCM:
+        return PcmCodec(rate, channels)
+    if codec_id == CODEC_OPUS and opuslib:
+        return OpusCodec(channels)
+    return None
+
+def pack(codec, seq, timestamp, payload):
+    return HEADER.pack(MAGIC, VERSION, codec.id, seq % SEQ_MOD, timestamp % TIMESTAMP_MOD) + payload
+
+def unpack(data):
+    """Return (codec_id, seq, timestamp, payload).
+
+    codec_id is None for a raw PCM datagram. Raises ValueError for a framed
+    datagram of another protocol version.
+    """
+    if len(data) >= 4 and data[:2] == MAGIC and data != HELLO:
+        if data[2] != VERSION or len(data) < HEADER.size:
+            raise ValueError(f"Unsupported audio packet version {data[2]}")
+        _, _, codec_id, seq, timestamp = HEADER.unpack_from(data)
+        return codec_id, seq, timestamp, memoryview(data)[HEADER.size:]
+    return None, None, None, data
@@ -0,0 +1,413 @@
+# bench_audio.py
+"""Headless benchmark for the shared audio pipeline.
+
+Runs audio.stream_audio and audio.receive_audio in one process without
+capture or playback devices. A synthetic capture source feeds the sender.
+Datagrams cross loopback UDP through an impairment proxy that can drop,
+delay, jitter, reorder and rate limit them. The receiver plays into a null
+output that pulls audio at a real device's pace and inspects what it gets.
+
+Each network profile reports:
+  latency     capture of a click to the sample leaving the output callback
+  gaps        output blocks with silence, from loss, concealment or underruns
+  jitter      the receiver's JitterBuffer counters
+  network     packet and bit rates, and what the proxy dropped or reordered
+  cpu         per role, from the threads' CPU clocks (Linux)
+
+    python bench_audio.py --duration 10 --json before.json
+    python bench_audio.py --duration 10 --baseline before.json
+    python bench_audio.py --profiles custom --loss 0.03 --jitter-ms 15
+"""
+import argparse
+import contextlib
+import heapq
+import io
+import json
+import logging
+import platform
+import random
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+logging.basicConfig(handlers=[logging.NullHandler()])  # keep audio.py from writing logs.log
+
+import numpy as np
+import audio
+import audio_codec
+import capture
+from config import app_config
+from jitter import JitterBuffer
+from latency import percentile
+
+# loss, burst (mean lost packets in a row), delay_ms, jitter_ms, reorder, reorder_ms, rate_kbps, queue_ms
+PROFILES = {
+    "clean": dict(loss=0.0, burst=1.0, delay_ms=0.0, jitter_ms=0.0, reorder=0.0, reorder_ms=0.0, rate_kbps=0, queue_ms=200),
+    "lan": dict(loss=0.001, burst=1.0, delay_ms=1.0, jitter_ms=1.0, reorder=0.0, reorder_ms=0.0, rate_kbps=0, queue_ms=200),
+    "wifi": dict(loss=0.01, burst=2.0, delay_ms=3.0, jitter_ms=8.0, reorder=0.01, reorder_ms=15.0, rate_kbps=0, queue_ms=200),
+    "lossy": dict(loss=0.05, burst=3.0, delay_ms=10.0, jitter_ms=20.0, reorder=0.03, reorder_ms=30.0, rate_kbps=0, queue_ms=200),
+    "capped": dict(loss=0.0, burst=1.0, delay_ms=1.0, jitter_ms=1.0, reorder=0.0, reorder_ms=0.0, rate_kbps=1200, queue_ms=100),
+}
+WARMUP = 1.0  # seconds before measuring, negotiation and the first buffering
+CLICK_EVERY = 0.25  # latency above this cannot be told apart from the next click
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def thread_cpu(threads):
+    """CPU seconds used by these threads, None where per thread clocks are missing."""
+    try:
+        return sum(time.clock_gettime(time.pthread_getcpuclockid(t.ident)) for t in threads if t.is_alive())
+    except (AttributeError, OSError):
+        return None
+
+class Impairment:
+    """UDP proxy between sender and receiver that degrades the forward path.
+
+    Loss follows a two state model: after a lost packet the next one is lost
+    too with probability 1 - 1/burst. Each surviving packet is delayed by
+    delay_ms plus the absolute value of a normal jitter_ms sample, a
+    `reorder` fraction of them reorder_ms more. A rate_kbps cap queues
+    packets behind each other and drops them once more than queue_ms is
+    queued. Replies from the receiver go back untouched.
+    """
+    def __init__(self, receiver, loss, burst, delay_ms, jitter_ms, reorder, reorder_ms, rate_kbps, queue_ms, seed=1):
+        self.receiver = receiver
+        self.loss, self.burst = loss, burst
+        self.delay, self.jitter = delay_ms / 1000, jitter_ms / 1000
+        self.reorder, self.reorder_delay = reorder, reorder_ms / 1000
+        self.rate = rate_kbps * 1000 / 8  # bytes per second
+        self.queue_limit = queue_ms / 1000
+        self.random = random.Random(seed)
+        self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # the sender's side
+        self.front.bind(("127.0.0.1", 0))
+        self.address = self.front.getsockname()
+        self.back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # the receiver's side
+        self.back.bind(("127.0.0.1", 0))
+        self.sender = None
+        self.lost_last = False
+        self.link_free = 0.0
+        self.queue = []  # (due, n, datagram)
+        self.cond = threading.Condition()
+        self.counter = 0
+        self.stats = {"packets_in": 0, "bytes_in": 0, "lost": 0, "queue_drops": 0, "reordered": 0, "packets_out": 0, "bytes_out": 0}
+        self.threads = [threading.Thread(target=target, daemon=True) for target in (self._forward, self._deliver, self._reply)]
+        for thread in self.threads:
+            thread.start()
+
+    def _lose(self):
+        if self.lost_last:
+            self.lost_last = self.random.random() < 1 - 1 / self.burst
+        else:
+            self.lost_last = self.random.random() < self.loss
+        return self.lost_last
+
+    def _forward(self):
+        while True:
+            try:
+                data, self.sender = self.front.recvfrom(65536)
+            except OSError:
+                return
+            now = time.perf_counter()
+            self.stats["packets_in"] += 1
+            self.stats["bytes_in"] += len(data)
+            if self._lose():
+                self.stats["lost"] += 1
+                continue
+            due = now
+            if self.rate:
+                start = max(now, self.link_free)
+                if start - now > self.queue_limit:
+                    self.stats["queue_drops"] += 1
+                    continue
+                self.link_free = start + len(data) / self.rate
+                due = self.link_free
+            due += self.delay + abs(self.random.gauss(0, self.jitter)) if self.jitter else self.delay
+            if self.reorder and self.random.random() < self.reorder:
+                due += self.reorder_delay
+                self.stats["reordered"] += 1
+            with self.cond:
+                self.counter += 1
+                heapq.heappush(self.queue, (due, self.counter, data))
+                self.cond.notify()
+
+    def _deliver(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                due, _, data = self.queue[0]
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    self.cond.wait(wait)  # woken early when something due sooner arrives
+                    continue
+                heapq.heappop(self.queue)
+            try:
+                self.back.sendto(data, self.receiver)
+            except OSError:
+                return
+            self.stats["packets_out"] += 1
+            self.stats["bytes_out"] += len(data)
+
+    def _reply(self):
+        while True:
+            try:
+                data, _ = self.back.recvfrom(65536)
+                if self.sender is not None:
+                    self.front.sendto(data, self.sender)
+            except ConnectionResetError:
+                continue
+            except OSError:
+                return
+
+    def close(self):
+        self.front.close()
+        self.back.close()
+
+class NullOutput:
+    """Stands in for sd.OutputStream, pulls blocks at the device pace and inspects them.
+
+    A block is played at the moment the callback returns, so a click's
+    latency is measured up to the device buffer, not the speaker.
+    """
+    def __init__(self, bench, samplerate, channels, dtype, blocksize, callback):
+        self.bench = bench
+        self.rate = samplerate
+        self.callback = callback
+        self.out = np.zeros((blocksize, channels), dtype=np.int16)
+        self.active = False
+        self.played = 0  # samples
+        self.last_click = -10 ** 9
+        self.thread = threading.Thread(target=self._run, name="null-output", daemon=True)
+        bench.outputs.append(self)
+
+    def start(self):
+        self.active = True
+        self.thread.start()
+
+    def _run(self):
+        blocksize = len(self.out)
+        started = time.perf_counter()
+        debounce = int(CLICK_EVERY * self.rate / 2)
+        while self.active:
+            due = started + self.played / self.rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.callback(self.out, blocksize, None, None)
+            now = time.perf_counter()
+            left = self.out[:, 0]
+            silent = np.count_nonzero(left == 0)
+            clicks = np.flatnonzero(left >= capture.CLICK_THRESHOLD)
+            if clicks.size and self.played + clicks[0] - self.last_click > debounce:
+                self.last_click = self.played + clicks[0]
+                self.bench.heard(now + clicks[0] / self.rate)
+            self.bench.block(silent)
+            self.played += blocksize
+
+    def close(self):
+        self.active = False
+
+    def stop(self):
+        self.active = False
+
+class AudioBench:
+    def __init__(self, args, profile):
+        self.args = args
+        self.profile = profile
+        self.clicks = deque()  # capture times from the source
+        self.latencies = []
+        self.missed_clicks = 0
+        self.measuring = False
+        self.blocks = self.gap_blocks = self.gap_samples = 0
+        self.outputs = []
+        self.lock = threading.Lock()
+
+    def heard(self, at):
+        with self.lock:
+            match = None
+            while self.clicks and self.clicks[0] <= at:
+                if match is not None:
+                    self.missed_clicks += self.measuring
+                match = self.clicks.popleft()
+            if match is not None and self.measuring:
+                self.latencies.append((at - match) * 1000)
+
+    def block(self, silent):
+        if self.measuring:
+            self.blocks += 1
+            if silent:
+                self.gap_blocks += 1
+                self.gap_samples += silent
+
+    def open_source(self, device, input_args, rate, frame_samples):
+        self.rate = rate
+        return capture.SyntheticCapture(rate, audio.CHANNELS, duration=WARMUP + self.args.duration + 1.0,
+                                        click_every=CLICK_EVERY, drift_ppm=self.args.drift_ppm, clicks=self.clicks)
+
+    def run(self):
+        args = self.args
+        port = free_port()
+        buffer = JitterBuffer()
+        proxy = Impairment(("127.0.0.1", port), seed=args.seed, **self.profile)
+        receiver = threading.Thread(target=audio.receive_audio, name="receive_audio",
+                                    args=(port, buffer, lambda **kw: NullOutput(self, **kw)), daemon=True)
+        receiver.start()
+        time.sleep(0.1)
+        sender = threading.Thread(target=audio.stream_audio, name="stream_audio",
+                                  args=("synthetic", []), kwargs={"targets": [proxy.address], "open_source": self.open_source},
+                                  daemon=True)
+        sender.start()
+        time.sleep(WARMUP)
+
+        def roles():
+            threads = {t.name: t for t in threading.enumerate()}
+            return {
+                # Threads started inside audio.py carry their target's name
+                "sender": [sender] + [t for name, t in threads.items() if name.endswith("(_run)")],
+                "receiver": [receiver] + [t for name, t in threads.items() if name.endswith("(play_audio)")],
+                "output": [o.thread for o in self.outputs],
+                "impairment": proxy.threads,
+            }
+
+        before_jitter, before_net = buffer.stats(), dict(proxy.stats)
+        before_cpu = {role: thread_cpu(threads) for role, threads in roles().items()}
+        process_before = time.process_time()
+        started = time.perf_counter()
+        self.measuring = True
+        time.sleep(args.duration)
+        self.measuring = False
+        wall = time.perf_counter() - started
+        cpu = {role: thread_cpu(threads) for role, threads in roles().items()}
+        process_cpu = time.process_time() - process_before
+        after_jitter, after_net = buffer.stats(), dict(proxy.stats)
+        sender.join(3)
+        for output in self.outputs:
+            output.close()
+        proxy.close()
+
+        ordered = sorted(self.latencies)
+        net = {key: after_net[key] - before_net[key] for key in after_net}
+        counters = ("received", "late", "duplicates", "concealed", "underruns", "skipped")
+        result = {
+            "codec": "opus" if buffer.rate == audio_codec.OPUS_RATE else "pcm",
+            "latency_ms": {
+                "count": len(ordered),
+                "p50": round(percentile(ordered, 50), 2),
+                "p95": round(percentile(ordered, 95), 2),
+                "p99": round(percentile(ordered, 99), 2),
+                "max": round(ordered[-1], 2) if ordered else 0.0,
+            },
+            "missed_clicks": self.missed_clicks,
+            "gap_blocks": self.gap_blocks,
+            "gap_ms": round(1000 * self.gap_samples / self.rate, 1) if self.gap_samples else 0.0,
+            "output_blocks": self.blocks,
+            "jitter": {key: after_jitter[key] - before_jitter[key] for key in counters},
+            "jitter_target": after_jitter["target"],
+            "jitter_ms": after_jitter["jitter_ms"],
+            "network": {
+                "packets_per_s": round(net["packets_in"] / wall, 1),
+                "kbit_per_s": round(net["bytes_in"] * 8 / 1000 / wall, 1),
+                "lost": net["lost"],
+                "queue_drops": net["queue_drops"],
+                "reordered": net["reordered"],
+            },
+            "cpu_percent": {role: round(100 * (cpu[role] - before_cpu[role]) / wall, 2)
+                            for role in cpu if cpu[role] is not None and before_cpu[role] is not None},
+        }
+        result["cpu_percent"]["process"] = round(100 * process_cpu / wall, 2)
+        return result
+
+def print_results(results):
+    meta = results["meta"]
+    print(f"audio_codec {meta['audio_codec']}, {meta['frame_ms']} ms frames, drift {meta['drift_ppm']} ppm, "
+          f"{meta['python']} on {meta['platform']}")
+    for name, result in results["profiles"].items():
+        lat, jit, net = result["latency_ms"], result["jitter"], result["network"]
+        print(f"\n[{name}] {result['codec']}")
+        print(f"  latency    p50 {lat['p50']:.2f}  p95 {lat['p95']:.2f}  p99 {lat['p99']:.2f}  max {lat['max']:.2f} ms  "
+              f"(n={lat['count']}, missed {result['missed_clicks']})")
+        print(f"  gaps       {result['gap_blocks']} of {result['output_blocks']} blocks, {result['gap_ms']} ms silent")
+        print(f"  jitter     target {result['jitter_target']} frames, {result['jitter_ms']} ms, "
+              + ", ".join(f"{key} {value}" for key, value in jit.items()))
+        print(f"  network    {net['packets_per_s']} pkt/s, {net['kbit_per_s']} kbit/s, lost {net['lost']}, "
+              f"queue drops {net['queue_drops']}, reordered {net['reordered']}")
+        print("  cpu        " + ", ".join(f"{role} {value}%" for role, value in result["cpu_percent"].items()))
+
+def flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flatten(f"{prefix}.{key}" if prefix else key, item, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+    return out
+
+def compare(results, baseline):
+    print(f"\nCompared with the run from {baseline['meta']['date']}:")
+    new = flatten("", results["profiles"], {})
+    old = flatten("", baseline["profiles"], {})
+    for key in sorted(new.keys() & old.keys()):
+        before, after = old[key], new[key]
+        if before == after:
+            continue
+        change = f"{100 * (after - before) / abs(before):+.1f}%" if before else "new"
+        print(f"  {key:40} {before:>10} -> {after:<10} {change}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmark for the audio.py sender and receiver.")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds measured per profile")
+    parser.add_argument("--profiles", default="clean,wifi,lossy", help="comma separated subset of " + ", ".join(PROFILES) + ", custom")
+    parser.add_argument("--codec", default=app_config.audio_codec, choices=("opus", "pcm"), help="audio_codec to ask for")
+    parser.add_argument("--frame-ms", type=float, default=app_config.audio_frame_ms, help="audio_frame_ms")
+    parser.add_argument("--bitrate", type=int, default=app_config.audio_bitrate, help="audio_bitrate for Opus")
+    parser.add_argument("--drift-ppm", type=float, default=0.0, help="sender clock error against the output")
+    parser.add_argument("--seed", type=int, default=1, help="impairment random seed")
+    for key, value in PROFILES["wifi"].items():
+        parser.add_argument("--" + key.replace("_", "-"), type=type(value), default=None, help=f"for the custom profile, e.g. {value}")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    args = parser.parse_args()
+
+    # Only in memory, never saved to config.json
+    app_config.audio_codec = args.codec
+    app_config.audio_frame_ms = args.frame_ms
+    app_config.audio_bitrate = args.bitrate
+    audio.multicast_group = ""
+    if args.codec == "opus" and not audio_codec.opuslib:
+        print("opuslib is not available here, the stream falls back to PCM")
+
+    custom = dict(PROFILES["clean"])
+    custom.update({key: getattr(args, key) for key in custom if getattr(args, key) is not None})
+    results = {"meta": {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "audio_codec": args.codec,
+        "frame_ms": args.frame_ms,
+        "drift_ppm": args.drift_ppm,
+    }, "profiles": {}}
+    for name in (name.strip() for name in args.profiles.split(",")):
+        if not name:
+            continue
+        profile = custom if name == "custom" else PROFILES.get(name)
+        if profile is None:
+            sys.exit(f"Unknown profile {name}, choose from {', '.join(PROFILES)}, custom")
+        print(f"Running {name} for {args.duration:g} s...", file=sys.stderr)
+        with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+            results["profiles"][name] = AudioBench(args, profile).run()
+
+    print_results(results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+# bench_share.py
+"""Headless benchmark for the input protocol.
+
+Runs a server and a client MouseSyncApp in one process without a display,
+connected over loopback TCP with the real handshake, senders and receive
+loop. The client applies events to stub controllers. Synthetic streams
+stand in for pynput:
+
+  mouse      1 kHz pointer moves through the motion coalescer
+  keys       bursts of key presses and releases
+  clipboard  large clipboards sent while the pointer keeps moving
+  codec      encode/decode cost per frame type, no sockets
+
+For each scenario it reports throughput, wire bytes, process CPU time per
+delivered event, allocation counters and latency percentiles from the
+latency stamps. Save a run with --json and pass it as --baseline to a
+later run to see the differences.
+
+    python bench_share.py --duration 5 --json before.json
+    python bench_share.py --duration 5 --baseline before.json
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import io
+import json
+import logging
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+if sys.platform.startswith("linux") and not os.environ.get("DISPLAY"):
+    # pynput refuses to import without an X display, its dummy backend is enough for stubs
+    os.environ.setdefault("PYNPUT_BACKEND", "dummy")
+
+logging.basicConfig(handlers=[logging.NullHandler()])  # keep share.py from writing logs.log
+
+from pynput import keyboard
+import clipboard
+import latency
+import protocol
+import transport
+from runtime import runtime_state
+from share import MouseSyncApp, MotionCoalescer, SERVER
+
+SCENARIOS = ("codec", "mouse", "keys", "clipboard")
+DRAIN_TIMEOUT = 5.0
+
+class StubMouse:
+    """Counts what a pynput mouse Controller would have done."""
+    def __init__(self):
+        self._position = (0, 0)
+        self.moves = 0
+        self.buttons = 0
+
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, value):
+        self._position = value
+        self.moves += 1
+
+    def press(self, button):
+        self.buttons += 1
+
+    def release(self, button):
+        self.buttons += 1
+
+    def scroll(self, dx, dy):
+        self.buttons += 1
+
+class StubKeyboard:
+    def __init__(self):
+        self.keys = 0
+
+    def press(self, key):
+        self.keys += 1
+
+    def release(self, key):
+        self.keys += 1
+
+class CountingCodec:
+    """Wraps the negotiated codec to count the bytes put on the wire."""
+    def __init__(self, codec):
+        self.codec = codec
+        self.bytes = 0
+        self.frames = 0
+
+    def encode(self, evt):
+        frame = self.codec.encode(evt)
+        self.bytes += len(frame)
+        self.frames += 1
+        return frame
+
+    def __getattr__(self, name):
+        return getattr(self.codec, name)
+
+def start_loop(name):
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name=name, daemon=True).start()
+    return loop
+
+def call(loop, coro, timeout=10):
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+def pace(rate_hz, duration, step):
+    """Call step(i) at rate_hz for duration seconds, returns the number of calls."""
+    interval = 1.0 / rate_hz
+    start = time.perf_counter()
+    i = 0
+    while True:
+        due = start + i * interval
+        now = time.perf_counter()
+        if due - start >= duration:
+            return i
+        if due > now:
+            time.sleep(due - now)
+        step(i)
+        i += 1
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.server = MouseSyncApp(headless=True, mouse_controller=StubMouse(), keyboard_controller=StubKeyboard())
+        self.client = MouseSyncApp(headless=True, mouse_controller=StubMouse(), keyboard_controller=StubKeyboard())
+        self.server.max_protocol = self.client.max_protocol = args.protocol
+        self.server.stamp_events = True
+        self.server.loop = start_loop("bench-server")
+        self.client.loop = start_loop("bench-client")
+        self.clipboards = []
+        self.client.clipboard.subscribe(lambda content: self.clipboards.append(time.perf_counter()))
+
+    def connect(self):
+        runtime_state.is_running = True
+        server, client = self.server, self.client
+        listener = server.listen(0)
+        port = listener.getsockname()[1]
+        server.transition_lock = call(server.loop, self._make_lock())
+        server.build_edges()
+        server.motion = MotionCoalescer(server.loop, server.send_move, self.args.pointer_rate)
+        accepted = asyncio.run_coroutine_threadsafe(server.accept(listener, "Bench"), server.loop)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        call(client.loop, client.loop.sock_connect(sock, ("127.0.0.1", port)))
+        codec, _ = call(client.loop, protocol.client_handshake(client.loop, sock, self.args.protocol, "bench"))
+        client.connections.append(sock)
+        client.server_peer = transport.Peer(SERVER, client.open_sender(sock, codec, "Client"),
+                                            dedup=client.hashes_clipboard(codec))
+        now = latency.now_us()
+        client.server_peer.clock.add(now, now, now)  # one process, one clock
+        asyncio.run_coroutine_threadsafe(client.receive_events(sock, codec, "Client", client.server_peer), client.loop)
+
+        conn, server_codec, name = accepted.result(10)
+        server.loop.call_soon_threadsafe(server.spawn, server.serve_client(conn, server_codec, name))
+        deadline = time.monotonic() + 5
+        while not server.peers and time.monotonic() < deadline:
+            time.sleep(0.01)
+        node, peer = next(iter(server.peers.items()))
+        self.wire = CountingCodec(peer.sender.codec)
+        peer.sender.codec = self.wire
+        if peer.input_sender is not peer.sender:
+            peer.input_sender.codec = self.wire
+        self.codec_name = f"{server_codec.name} v{server_codec.version}"
+        server.request_transition(node, (server.screen_width // 2, server.screen_height // 2))
+        runtime_state.wait_until(lambda: runtime_state.active_device, 5)
+        time.sleep(0.2)
+
+    async def _make_lock(self):
+        return asyncio.Lock()
+
+    def delivered(self):
+        mouse, keys = self.client.mouse_controller, self.client.keyboard_controller
+        return mouse.moves + mouse.buttons + keys.keys
+
+    def drain(self, expected=None):
+        """Wait until the client stops receiving, or has everything when `expected` is known."""
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        last, still = -1, 0
+        while time.monotonic() < deadline:
+            now = self.delivered()
+            if expected is not None and now >= expected:
+                return
+            still = still + 1 if now == last else 0
+            if still >= 10:
+                return
+            last = now
+            time.sleep(0.02)
+
+    def measure(self, drive):
+        self.client.latency = latency.LatencyStats()
+        gc.collect()
+        if self.args.tracemalloc:
+            tracemalloc.start()
+        start = {
+            "delivered": self.delivered(),
+            "bytes": self.wire.bytes,
+            "frames": self.wire.frames,
+            "cpu": time.process_time(),
+            "wall": time.perf_counter(),
+            "gc0": gc.get_stats()[0]["collections"],
+            "blocks": sys.getallocatedblocks(),
+        }
+        extra = drive() or {}
+        expected = extra.pop("expected", None)  # events the client must apply, when nothing is coalesced
+        self.drain(None if expected is None else start["delivered"] + expected)
+        wall = time.perf_counter() - start["wall"]
+        cpu = time.process_time() - start["cpu"]
+        delivered = self.delivered() - start["delivered"]
+        generated = extra.pop("generated", 0)
+        result = {
+            "generated": generated,
+            "delivered": delivered,
+            "events_per_s": round(delivered / wall, 1),
+            "wire_kb": round((self.wire.bytes - start["bytes"]) / 1024, 1),
+            "frames": self.wire.frames - start["frames"],
+            "wire_kb_per_s": round((self.wire.bytes - start["bytes"]) / 1024 / wall, 1),
+            "cpu_us_per_event": round(cpu * 1e6 / max(generated or delivered, 1), 2),
+            "cpu_percent": round(100 * cpu / wall, 1),
+            "gc0_per_1k_events": round(1000 * (gc.get_stats()[0]["collections"] - start["gc0"]) / max(delivered, 1), 2),
+            "blocks_retained": sys.getallocatedblocks() - start["blocks"],
+        }
+        if self.args.tracemalloc:
+            result["traced_peak_kb"] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+            tracemalloc.stop()
+        result.update(extra)
+        result["latency_ms"] = {kind: {k: entry[k] for k in ("count", "p50", "p95", "p99", "max")}
+                                for kind, entry in self.client.latency.snapshot().items()}
+        return result
+
+    # Scenarios
+    def mouse(self):
+        server = self.server
+        def drive():
+            def step(i):
+                server.on_move(200 + i % 1500, 200 + (i // 7) % 600)
+            return {"generated": pace(self.args.mouse_hz, self.args.duration, step)}
+        return self.measure(drive)
+
+    def keys(self):
+        server = self.server
+        keys = [keyboard.KeyCode(char=c) for c in "the quick brown fox jumps"] + [keyboard.Key.shift]
+        def drive():
+            def step(i):
+                for key in keys:
+                    server.on_press(key)
+                    server.on_release(key)
+            generated = pace(10, self.args.duration, step) * len(keys) * 2
+            return {"generated": generated, "expected": generated}
+        return self.measure(drive)
+
+    def clipboard(self):
+        server = self.server
+        size = int(self.args.clipboard_mb * 1024 * 1024)
+        def drive():
+            node, peer = next(iter(server.peers.items()))
+            sent, times = 0, []
+            moving = threading.Event()
+            moving.set()
+            def move():
+                # The pointer keeps going, its latency shows what the transfer costs interactive traffic
+                i = 0
+                while moving.is_set():
+                    server.on_move(200 + i % 1500, 300)
+                    i += 1
+                    time.sleep(1.0 / self.args.mouse_hz)
+            mover = threading.Thread(target=move, daemon=True)
+            mover.start()
+            until = time.perf_counter() + self.args.duration
+            for n in range(self.args.clipboards):
+                text = (f"clipboard {n} " + "lorem ipsum dolor sit amet " * (size // 54)).encode()
+                image = os.urandom(size // 2)
+                content = {clipboard.TEXT: text[:size // 2], clipboard.PNG: image}
+                count = len(self.clipboards)
+                started = time.perf_counter()
+                server.clipboard.set(content)
+                call(server.loop, server.send_clipboard_if_changed(peer), timeout=60)
+                deadline = time.monotonic() + 60
+                while len(self.clipboards) == count and time.monotonic() < deadline:
+                    time.sleep(0.005)
+                times.append(time.perf_counter() - started)
+                sent += clipboard.content_size(content)
+            time.sleep(max(0.0, until - time.perf_counter()))
+            moving.clear()
+            mover.join()
+            return {
+                "clipboard_mb": round(sent / 1024 / 1024, 1),
+                "clipboard_mb_per_s": round(sent / 1024 / 1024 / max(sum(times), 1e-9), 1),
+                "clipboard_s": [round(t, 3) for t in times],
+            }
+        return self.measure(drive)
+
+def bench_codec(version, count):
+    """Encode and decode cost per frame type, in nanoseconds per frame."""
+    codec = protocol.codec_for(version)
+    events = {
+        "move": {"type": "move", "x": 0.25, "y": 0.75, "ts": latency.now_us()},
+        "click": {"type": "click", "button": "left", "pressed": True, "ts": latency.now_us()},
+        "key_press": {"type": "key_press", "kind": 1, "code": ord("a"), "ts": latency.now_us()},
+        "active_device": {"type": "active_device", "value": True},
+        "clipboard_data": {"type": "clipboard_data", "id": 1, "data": os.urandom(64 * 1024)},
+    }
+    results = {}
+    for name, evt in events.items():
+        try:
+            frame = codec.encode(evt)
+        except (protocol.ProtocolError, KeyError, TypeError):
+            continue  # not in this protocol version
+        n = count if name != "clipboard_data" else max(1, count // 100)
+        start = time.perf_counter()
+        for _ in range(n):
+            codec.encode(evt)
+        encode_ns = (time.perf_counter() - start) * 1e9 / n
+
+        buf = bytearray(frame * n)
+        view = memoryview(buf)
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        pos, end, decoded = 0, len(buf), 0
+        while pos < end:
+            frame_end = codec.frame_end(buf, pos, end)
+            codec.decode(view, pos, frame_end)
+            pos = frame_end
+            decoded += 1
+        decode_ns = (time.perf_counter() - start) * 1e9 / decoded
+        view.release()
+        results[name] = {
+            "bytes": len(frame),
+            "encode_ns": round(encode_ns, 1),
+            "decode_ns": round(decode_ns, 1),
+            "blocks_retained": sys.getallocatedblocks() - blocks,
+        }
+    return results
+
+def print_results(results):
+    meta = results["meta"]
+    print(f"protocol {meta['codec']}, pointer_rate_hz {meta['pointer_rate']}, {meta['python']} on {meta['platform']}")
+    for name, result in results["scenarios"].items():
+        print(f"\n[{name}]")
+        if name == "codec":
+            for frame, entry in result.items():
+                print(f"  {frame:15} {entry['bytes']:7} B  encode {entry['encode_ns']:9.1f} ns  decode {entry['decode_ns']:9.1f} ns")
+            continue
+        for key, value in result.items():
+            if key == "latency_ms":
+                for kind, entry in value.items():
+                    print(f"  latency {kind:10} p50 {entry['p50']:.3f}  p95 {entry['p95']:.3f}  "
+                          f"p99 {entry['p99']:.3f}  max {entry['max']:.3f} ms  (n={entry['count']})")
+            else:
+                print(f"  {key:20} {value}")
+
+def flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flatten(f"{prefix}.{key}" if prefix else key, item, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+    return out
+
+def compare(results, baseline):
+    print(f"\nCompared with {baseline['meta']['codec']} from {baseline['meta']['date']}:")
+    new = flatten("", results["scenarios"], {})
+    old = flatten("", baseline["scenarios"], {})
+    for key in sorted(new.keys() & old.keys()):
+        before, after = old[key], new[key]
+        if before == after:
+            continue
+        change = f"{100 * (after - before) / abs(before):+.1f}%" if before else "new"
+        print(f"  {key:45} {before:>12} -> {after:<12} {change}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmark for the share.py input protocol.")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per streaming scenario")
+    parser.add_argument("--protocol", type=int, default=protocol.PROTOCOL_VERSION, help="highest protocol version offered, 0 is JSON")
+    parser.add_argument("--pointer-rate", type=int, default=120, help="pointer_rate_hz of the coalescer, 0 sends every move")
+    parser.add_argument("--mouse-hz", type=int, default=1000, help="synthetic pointer event rate")
+    parser.add_argument("--clipboard-mb", type=float, default=8.0, help="size of each clipboard")
+    parser.add_argument("--clipboards", type=int, default=3, help="clipboards sent in the clipboard scenario")
+    parser.add_argument("--codec-count", type=int, default=100000, help="frames per type in the codec scenario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--tracemalloc", action="store_true", help="also report traced peak memory, slows everything down")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--verbose", action="store_true", help="show the apps' own output")
+    args = parser.parse_args()
+    wanted = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+
+    results = {"meta": {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pointer_rate": args.pointer_rate,
+        "codec": "none",
+    }, "scenarios": {}}
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with quiet:
+        if "codec" in wanted:
+            results["scenarios"]["codec"] = bench_codec(args.protocol, args.codec_count)
+        streaming = [name for name in wanted if name != "codec"]
+        if streaming:
+            bench = Bench(args)
+            bench.connect()
+            results["meta"]["codec"] = bench.codec_name
+            for name in streaming:
+                results["scenarios"][name] = getattr(bench, name)()
+            runtime_state.is_running = False
+    if results["meta"]["codec"] == "none":
+        codec = protocol.codec_for(args.protocol)
+        results["meta"]["codec"] = f"{codec.name} v{codec.version}"
+
+    print_results(results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
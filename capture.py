@@ -0,0 +1,148 @@
+# capture.py
+import math
+import subprocess
+import threading
+import time
+from collections import deque
+import numpy as np
+try:
+    import sounddevice as sd
+except OSError:  # no PortAudio, DeviceCapture fails and ffmpeg takes over
+    sd = None
+from ringbuffer import RingBuffer
+
+RING_SECONDS = 0.5
+READ_TIMEOUT = 1.0
+
+# SyntheticCapture signal, the tone never reaches 0 or CLICK_THRESHOLD
+TONE_HZ = 440
+TONE_LEVEL = 4000  # DC offset
+TONE_AMPLITUDE = 2000
+CLICK_LEVEL = 30000
+CLICK_SAMPLES = 4
+CLICK_THRESHOLD = 15000
+
+class FfmpegCapture:
+    """Reads s16le PCM from an ffmpeg subprocess."""
+    name = "ffmpeg"
+
+    def __init__(self, input_args, rate, channels):
+        ffmpeg_cmd = ['ffmpeg'] + input_args + [
+            '-ac', str(channels),
+            '-ar', str(rate),
+            '-f', 's16le',
+            '-loglevel', 'info',
+            '-'
+        ]
+        self.process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE)
+
+    def read(self, nbytes):
+        """Return `nbytes` of audio, less only when capture ended."""
+        return self.process.stdout.read(nbytes)
+
+    def close(self):
+        try:
+            self.process.terminate()
+            self.process.wait(timeout=2)
+        except Exception:
+            pass
+
+class DeviceCapture:
+    """Records from a sounddevice input stream in this process.
+
+    The stream callback copies each block into a preallocated RingBuffer and
+    `read()` copies one packet's worth out into a reused frame, so there is
+    no subprocess, no pipe and no allocation per packet.
+    """
+    name = "sounddevice"
+
+    def __init__(self, device, rate, channels, frame_samples):
+        self.channels = channels
+        self.ring = RingBuffer(int(rate * RING_SECONDS), channels)
+        self.frame = np.zeros((frame_samples, channels), dtype=np.int16)
+        self.frame_bytes = memoryview(self.frame).cast("B")
+        self.wanted = frame_samples
+        self.ready = threading.Event()
+        self.overruns = 0
+        self.stream = sd.InputStream(
+            device=device,
+            samplerate=rate,
+            channels=channels,
+            dtype='int16',
+            blocksize=frame_samples,
+            callback=self._callback
+        )
+        self.stream.start()
+
+    def _callback(self, indata, frames, time_info, status):
+        if self.ring.write(memoryview(indata).cast("B")) < frames:
+            self.overruns += 1  # the sender fell behind, newest audio is lost
+        if self.ring.fill() >= self.wanted:
+            self.ready.set()
+
+    def read(self, nbytes):
+        frames = nbytes // (self.channels * 2)
+        if frames > len(self.frame):
+            self.frame = np.zeros((frames, self.channels), dtype=np.int16)
+            self.frame_bytes = memoryview(self.frame).cast("B")
+        self.wanted = frames
+        while self.ring.fill() < frames:
+            self.ready.clear()
+            if self.ring.fill() >= frames:
+                break
+            if not self.ready.wait(READ_TIMEOUT) or not self.stream.active:
+                return b""
+        self.ring.read_into(self.frame[:frames])
+        return self.frame_bytes[:nbytes]
+
+    def close(self):
+        try:
+            self.stream.stop()
+            self.stream.close()
+        except Exception:
+            pass
+
+class SyntheticCapture:
+    """A generated signal delivered at a device's pace, for bench_audio.py.
+
+    The tone rides on a DC offset, so exact silence on the far end means
+    audio went missing. Every `click_every` seconds a short full scale click
+    replaces it, and its capture time (time.perf_counter) is appended to
+    `clicks` so the far end can time the whole path. `drift_ppm` makes this
+    clock run fast or slow against the receiver's. After `duration` seconds
+    read() returns b"" like a device that went away.
+    """
+    name = "synthetic"
+
+    def __init__(self, rate, channels, duration=None, click_every=0.5, drift_ppm=0.0, clicks=None):
+        self.rate = rate
+        self.channels = channels
+        self.end = None if duration is None else int(duration * rate)
+        self.click_every = int(click_every * rate)
+        self.clock_rate = rate * (1 + drift_ppm / 1e6)
+        self.clicks = clicks if clicks is not None else deque()
+        self.position = 0  # samples generated
+        self.start = None
+
+    def read(self, nbytes):
+        frames = nbytes // (self.channels * 2)
+        if self.start is None:
+            self.start = time.perf_counter()
+        end = self.position + frames
+        if self.end is not None and end > self.end:
+            return b""
+        delay = self.start + end / self.clock_rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)  # the last sample of this frame has not been "recorded" yet
+        t = np.arange(self.position, end)
+        signal = (TONE_LEVEL + TONE_AMPLITUDE * np.sin(2 * math.pi * TONE_HZ / self.rate * t)).astype(np.int16)
+        click = -(-self.position // self.click_every) * self.click_every
+        while click < end:
+            signal[click - self.position:click - self.position + CLICK_SAMPLES] = CLICK_LEVEL
+            self.clicks.append(self.start + click / self.clock_rate)
+            click += self.click_every
+        self.position = end
+        return np.repeat(signal[:, None], self.channels, axis=1).tobytes()
+
+    def close(self):
+        pass
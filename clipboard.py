@@ -0,0 +1,522 @@
+# clipboard.py
+import hashlib
+import platform
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+POLL_INTERVAL = 0.1  # seconds, Windows sequence number check
+PYPERCLIP_POLL_INTERVAL = 0.5
+HISTORY_ENTRIES = 16
+HISTORY_BYTES = 32 * 1024 * 1024
+MAX_ITEM_BYTES = 64 * 1024 * 1024  # larger formats are not shared
+
+# Clipboard content is a dict of MIME type -> bytes, text is UTF-8
+TEXT = "text/plain"
+HTML = "text/html"
+PNG = "image/png"
+BMP = "image/bmp"
+QT_IMAGE = "application/x-qt-image"
+
+def text_content(text):
+    return {TEXT: text.encode("utf-8", "surrogatepass")} if text else {}
+
+def content_text(content):
+    data = content.get(TEXT)
+    return data.decode("utf-8", "surrogatepass") if data is not None else ""
+
+def content_size(content):
+    return sum(len(data) for data in content.values())
+
+def content_hash(content):
+    """Identify clipboard content, 16 bytes of BLAKE2b as hex.
+
+    Plain text hashes as its UTF-8 bytes alone, like before formats were
+    shared, so older peers' clipboard_have hashes still match.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if set(content) <= {TEXT}:
+        h.update(content.get(TEXT, b""))
+        return h.hexdigest()
+    for mime in sorted(content):
+        data = content[mime]
+        h.update(mime.encode() + b"\0" + struct.pack("<Q", len(data)))
+        h.update(data)
+    return h.hexdigest()
+
+EMPTY_HASH = content_hash({})
+
+def _limited(content):
+    return {mime: data for mime, data in content.items() if data and len(data) <= MAX_ITEM_BYTES}
+
+class ClipboardHistory:
+    """Recently seen clipboard contents by hash, least recently used dropped first."""
+    def __init__(self, entries=HISTORY_ENTRIES, max_bytes=HISTORY_BYTES):
+        self.entries = entries
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def add(self, digest, content):
+        with self.lock:
+            if digest in self.items:
+                self.items.move_to_end(digest)
+                return
+            self.items[digest] = content
+            self.size += content_size(content)
+            while self.items and (len(self.items) > self.entries or self.size > self.max_bytes):
+                _, dropped = self.items.popitem(last=False)
+                self.size -= content_size(dropped)
+
+    def get(self, digest):
+        with self.lock:
+            content = self.items.get(digest)
+            if content is not None:
+                self.items.move_to_end(digest)
+            return content
+
+    def __contains__(self, digest):
+        return digest in self.items
+
+class ClipboardCache:
+    """Keeps the current clipboard content in memory.
+
+    Backends update `content` when the system clipboard changes, so `get()`
+    is a plain attribute read and never touches the system clipboard.
+    `digest` is the content hash, computed once per change. Callbacks
+    registered with `subscribe()` run on every change, local or set by us,
+    on whatever thread noticed it.
+    """
+    def __init__(self):
+        self.current = ({}, EMPTY_HASH)  # swapped as one, content and digest always match
+        self.callbacks = []
+
+    @property
+    def content(self):
+        return self.current[0]
+
+    @property
+    def text(self):
+        return content_text(self.current[0])
+
+    @property
+    def digest(self):
+        return self.current[1]
+
+    def get(self):
+        return self.current[0]
+
+    def snapshot(self):
+        """Return (content, digest) of the same clipboard content."""
+        return self.current
+
+    def set(self, content):
+        raise NotImplementedError
+
+    def promise(self, digest, mimes, fetch):
+        """Offer `mimes` on the system clipboard, calling `fetch()` for the content on first paste.
+
+        `fetch` blocks and returns the content, or None when it cannot be
+        had. Returns False when the backend cannot defer the content, the
+        caller then has to fetch it now and `set()` it.
+        """
+        return False
+
+    def pending(self):
+        """True while the current clipboard is a promise whose content has not been fetched."""
+        content, digest = self.current
+        return not content and digest != EMPTY_HASH
+
+    def fulfil(self, digest, content):
+        """Cache content fetched for a promise, if it is still the current clipboard."""
+        if self.digest == digest:
+            self.current = (content, digest)
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def _changed(self, content):
+        content = _limited(content)
+        if content == self.content:
+            return
+        self.current = (content, content_hash(content))
+        for callback in list(self.callbacks):
+            try:
+                callback(content)
+            except Exception as e:
+                print(f"[Clipboard] Subscriber error: {e}")
+
+class QtClipboard(ClipboardCache):
+    """QClipboard of the running QApplication, updated by its dataChanged signal.
+
+    Shares plain text, HTML and images, images as PNG. Must be created on
+    the Qt main thread. `run_on_gui` marshals writes there from other
+    threads.
+    """
+    def __init__(self, gui_app, run_on_gui):
+        super().__init__()
+        from PyQt5.QtCore import QBuffer, QByteArray, QIODevice, QMimeData
+        from PyQt5.QtGui import QImage
+        self.QBuffer, self.QByteArray, self.QIODevice = QBuffer, QByteArray, QIODevice
+        self.QMimeData, self.QImage = QMimeData, QImage
+
+        class PromisedMimeData(QMimeData):
+            """Lists the offered formats, the content is fetched when one is first read."""
+            def __init__(self, mimes, fetch):
+                super().__init__()
+                self.mimes = [m for m in mimes if m in (TEXT, HTML)]
+                if any(m.startswith("image/") for m in mimes):
+                    self.mimes.append(QT_IMAGE)
+                self.fetch = fetch
+                self.content = None
+
+            def formats(self):
+                return list(self.mimes)
+
+            def hasFormat(self, mime):
+                return mime in self.mimes
+
+            def retrieveData(self, mime, preferred_type):
+                if mime not in self.mimes:
+                    return None
+                if self.content is None:
+                    self.content = self.fetch() or {}
+                if mime == TEXT and TEXT in self.content:
+                    return content_text(self.content)
+                if mime == HTML and HTML in self.content:
+                    return self.content[HTML].decode("utf-8", "surrogatepass")
+                if mime == QT_IMAGE:
+                    for kind, raw in self.content.items():
+                        if kind.startswith("image/"):
+                            return QImage.fromData(raw)
+                return None
+
+        self.PromisedMimeData = PromisedMimeData
+        self.clipboard = gui_app.clipboard()
+        self.run_on_gui = run_on_gui
+        self._changed(self._read())
+        self.clipboard.dataChanged.connect(self._on_data_changed)
+
+    def _read(self):
+        content = {}
+        mime = self.clipboard.mimeData()
+        if mime is None:
+            return content
+        if mime.hasText():
+            content[TEXT] = mime.text().encode("utf-8", "surrogatepass")
+        if mime.hasHtml():
+            content[HTML] = mime.html().encode("utf-8", "surrogatepass")
+        if mime.hasImage():
+            image = self.clipboard.image()
+            if not image.isNull():
+                data = self.QByteArray()
+                buf = self.QBuffer(data)
+                buf.open(self.QIODevice.WriteOnly)
+                image.save(buf, "PNG")
+                buf.close()
+                content[PNG] = bytes(data)
+        return content
+
+    def _on_data_changed(self):
+        if self.clipboard.ownsClipboard():
+            return  # our own set(), already cached as sent, re-encoding an image would change its hash
+        self._changed(self._read())
+
+    def _apply(self, content):
+        data = self.QMimeData()
+        if TEXT in content:
+            data.setText(content_text(content))
+        if HTML in content:
+            data.setHtml(content[HTML].decode("utf-8", "surrogatepass"))
+        for mime, raw in content.items():
+            if mime.startswith("image/"):
+                image = self.QImage.fromData(raw)
+                if not image.isNull():
+                    data.setImageData(image)
+                    break
+        self.clipboard.setMimeData(data)
+
+    def set(self, content):
+        self._changed(content)
+        self.run_on_gui(lambda: self._apply(content))
+
+    def promise(self, digest, mimes, fetch):
+        self.current = ({}, digest)
+        self.run_on_gui(lambda: self.clipboard.setMimeData(self.PromisedMimeData(mimes, fetch)))
+        return True
+
+def dib_to_bmp(dib):
+    """Prepend the BITMAPFILEHEADER that CF_DIB leaves out."""
+    header_size, = struct.unpack_from("<I", dib, 0)
+    bit_count, compression, _, _, _, used = struct.unpack_from("<HIIiiI", dib, 14)
+    colors = used or (1 << bit_count if bit_count <= 8 else 0)
+    offset = 14 + header_size + colors * 4
+    if compression == 3 and header_size == 40:
+        offset += 12  # BI_BITFIELDS masks follow the header
+    return b"BM" + struct.pack("<IHHI", 14 + len(dib), 0, 0, offset) + dib
+
+def bmp_to_dib(bmp):
+    return bmp[14:] if bmp[:2] == b"BM" else None
+
+def parse_cf_html(data):
+    """HTML from the Windows "HTML Format" clipboard layout."""
+    match = re.search(rb"StartHTML:(-?\d+).*?EndHTML:(-?\d+)", data, re.S)
+    if not match or int(match.group(1)) < 0:
+        return data
+    return data[int(match.group(1)):int(match.group(2))]
+
+def make_cf_html(html):
+    """Wrap HTML in the "HTML Format" header with byte offsets."""
+    template = ("Version:0.9\r\nStartHTML:{:010d}\r\nEndHTML:{:010d}\r\n"
+                "StartFragment:{:010d}\r\nEndFragment:{:010d}\r\n")
+    prefix, suffix = b"<html><body><!--StartFragment-->", b"<!--EndFragment--></body></html>"
+    header_len = len(template.format(0, 0, 0, 0))
+    start_fragment = header_len + len(prefix)
+    end_fragment = start_fragment + len(html)
+    end_html = end_fragment + len(suffix)
+    header = template.format(header_len, end_html, start_fragment, end_fragment).encode()
+    return header + prefix + html + suffix
+
+class Win32Clipboard(ClipboardCache):
+    """Windows clipboard, re-read only when its sequence number moves.
+
+    Text, "HTML Format" and images are shared. Images are read as PNG when
+    the source program offers it and as a BMP built from CF_DIB otherwise.
+    Promised content uses delayed rendering: a hidden window owns the
+    clipboard and fetches the content when a program first asks for it.
+    """
+    def __init__(self):
+        super().__init__()
+        import win32clipboard
+        self.win32clipboard = win32clipboard
+        self.cf_html = win32clipboard.RegisterClipboardFormat("HTML Format")
+        self.cf_png = win32clipboard.RegisterClipboardFormat("PNG")
+        self.lock = threading.Lock()
+        self.sequence = None
+        self.hwnd = None
+        self.promised = None  # [fetch, content] while our hidden window owns the clipboard
+        self._refresh()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _formats(self):
+        wc = self.win32clipboard
+        return {wc.CF_UNICODETEXT: TEXT, self.cf_html: HTML, self.cf_png: PNG, wc.CF_DIB: BMP}
+
+    def _read(self):
+        wc = self.win32clipboard
+        try:
+            wc.OpenClipboard()
+        except Exception:
+            return None  # held by another program, try again next poll
+        try:
+            content = {}
+            if wc.IsClipboardFormatAvailable(wc.CF_UNICODETEXT):
+                content[TEXT] = wc.GetClipboardData(wc.CF_UNICODETEXT).encode("utf-8", "surrogatepass")
+            if wc.IsClipboardFormatAvailable(self.cf_html):
+                content[HTML] = parse_cf_html(wc.GetClipboardData(self.cf_html))
+            if wc.IsClipboardFormatAvailable(self.cf_png):
+                content[PNG] = wc.GetClipboardData(self.cf_png)
+            elif wc.IsClipboardFormatAvailable(wc.CF_DIB):
+                content[BMP] = dib_to_bmp(wc.GetClipboardData(wc.CF_DIB))
+            return content
+        except Exception:
+            return None
+        finally:
+            wc.CloseClipboard()
+
+    def _refresh(self):
+        with self.lock:
+            sequence = self.win32clipboard.GetClipboardSequenceNumber()
+            if sequence == self.sequence:
+                return
+            content = self._read()
+            if content is None:
+                return
+            self.sequence = sequence
+        self._changed(content)
+
+    def _watch(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            self._refresh()
+
+    def set(self, content):
+        wc = self.win32clipboard
+        with self.lock:
+            try:
+                wc.OpenClipboard()
+                try:
+                    wc.EmptyClipboard()
+                    if TEXT in content:
+                        wc.SetClipboardText(content_text(content), wc.CF_UNICODETEXT)
+                    if HTML in content:
+                        wc.SetClipboardData(self.cf_html, make_cf_html(content[HTML]))
+                    if PNG in content:
+                        wc.SetClipboardData(self.cf_png, content[PNG])
+                    dib = bmp_to_dib(content[BMP]) if BMP in content else None
+                    if dib:
+                        wc.SetClipboardData(wc.CF_DIB, dib)
+                finally:
+                    wc.CloseClipboard()
+            except Exception as e:
+                print(f"[Clipboard] Could not set clipboard: {e}")
+                return
+            self.sequence = wc.GetClipboardSequenceNumber()
+            self.promised = None
+        self._changed(content)
+
+    def promise(self, digest, mimes, fetch):
+        wc = self.win32clipboard
+        formats = [fmt for fmt, mime in self._formats().items() if mime in mimes]
+        if not formats:
+            return False
+        try:
+            self._start_owner()
+        except Exception as e:
+            print(f"[Clipboard] Delayed rendering unavailable: {e}")
+            return False
+        with self.lock:
+            try:
+                wc.OpenClipboard(self.hwnd)
+                try:
+                    wc.EmptyClipboard()
+                    for fmt in formats:
+                        wc.SetClipboardData(fmt, None)
+                finally:
+                    wc.CloseClipboard()
+            except Exception as e:
+                print(f"[Clipboard] Could not offer clipboard: {e}")
+                return False
+            self.promised = [fetch, None]
+            self.sequence = wc.GetClipboardSequenceNumber()
+        self.current = ({}, digest)
+        return True
+
+    def _start_owner(self):
+        if self.hwnd:
+            return
+        ready = threading.Event()
+        threading.Thread(target=self._owner_loop, args=(ready,), daemon=True).start()
+        ready.wait(2)
+        if not self.hwnd:
+            raise OSError("no clipboard owner window")
+
+    def _owner_loop(self, ready):
+        import win32api
+        import win32con
+        import win32gui
+        wndclass = win32gui.WNDCLASS()
+        wndclass.lpszClassName = "PortalClipboardOwner"
+        wndclass.hInstance = win32api.GetModuleHandle(None)
+        wndclass.lpfnWndProc = {
+            win32con.WM_RENDERFORMAT: self._on_render_format,
+            win32con.WM_RENDERALLFORMATS: self._on_render_all,
+            win32con.WM_DESTROYCLIPBOARD: self._on_destroy_clipboard,
+        }
+        try:
+            win32gui.RegisterClass(wndclass)
+            self.hwnd = win32gui.CreateWindow(wndclass.lpszClassName, "Portal clipboard", 0, 0, 0, 0, 0,
+                                              win32con.HWND_MESSAGE, 0, wndclass.hInstance, None)
+        finally:
+            ready.set()
+        win32gui.PumpMessages()
+
+    def _render(self, fmt):
+        # Runs on the owner window's thread while a program waits for the data
+        promised = self.promised
+        if promised is None:
+            return
+        if promised[1] is None:
+            promised[1] = promised[0]() or {}
+        content = promised[1]
+        wc = self.win32clipboard
+        mime = self._formats().get(fmt)
+        if mime not in content:
+            return
+        if fmt == wc.CF_UNICODETEXT:
+            wc.SetClipboardText(content_text(content), wc.CF_UNICODETEXT)
+        elif fmt == self.cf_html:
+            wc.SetClipboardData(fmt, make_cf_html(content[HTML]))
+        elif fmt == wc.CF_DIB:
+            dib = bmp_to_dib(content[BMP])
+            if dib:
+                wc.SetClipboardData(fmt, dib)
+        else:
+            wc.SetClipboardData(fmt, content[mime])
+        self.sequence = wc.GetClipboardSequenceNumber()
+
+    def _on_render_format(self, hwnd, msg, wparam, lparam):
+        try:
+            self._render(wparam)
+        except Exception as e:
+            print(f"[Clipboard] Could not render clipboard: {e}")
+        return 0
+
+    def _on_render_all(self, hwnd, msg, wparam, lparam):
+        # We are going away, leave real data behind if the clipboard is still ours
+        wc = self.win32clipboard
+        try:
+            wc.OpenClipboard(hwnd)
+            try:
+                if wc.GetClipboardOwner() == hwnd:
+                    for fmt in self._formats():
+                        self._render(fmt)
+            finally:
+                wc.CloseClipboard()
+        except Exception as e:
+            print(f"[Clipboard] Could not render clipboard: {e}")
+        return 0
+
+    def _on_destroy_clipboard(self, hwnd, msg, wparam, lparam):
+        self.promised = None
+        return 0
+
+class PollingClipboard(ClipboardCache):
+    """pyperclip fallback for other platforms, polled in the background. Text only."""
+    def __init__(self):
+        super().__init__()
+        import pyperclip
+        self.pyperclip = pyperclip
+        self.lock = threading.Lock()
+        self._refresh()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _refresh(self):
+        with self.lock:
+            try:
+                text = self.pyperclip.paste()
+            except Exception:
+                return
+        self._changed(text_content(text))
+
+    def _watch(self):
+        while True:
+            time.sleep(PYPERCLIP_POLL_INTERVAL)
+            self._refresh()
+
+    def set(self, content):
+        if TEXT not in content:
+            return  # nothing pyperclip can hold
+        with self.lock:
+            self.pyperclip.copy(content_text(content))
+        self._changed(text_content(content_text(content)))
+
+class MemoryClipboard(ClipboardCache):
+    """Clipboard that only lives in this process, for headless runs."""
+    def set(self, content):
+        self._changed(content)
+
+def create(gui_app=None, run_on_gui=None):
+    """Pick the clipboard backend for this platform."""
+    os_type = platform.system().lower()
+    if os_type == "linux" and gui_app is not None and hasattr(gui_app, "clipboard"):
+        return QtClipboard(gui_app, run_on_gui)
+    if os_type == "windows":
+        try:
+            return Win32Clipboard()
+        except ImportError:
+            pass
+    return PollingClipboard()
@@ -1,34 +1,54 @@
+import atexit
 import json
 import os
+import threading
+
+# Volatile state lives in runtime.py, drop it from config files written by older versions
+RUNTIME_KEYS = ("stop_flag", "is_running", "active_device", "clipboard")
+SAVE_DELAY = 0.5
 
 class AppConfig:
     def __init__(self):
         self.config_path = "config.json"
+        self.save_timer = None
+        self.save_lock = threading.Lock()
         self.set_defaults()
         self.load()
 
     def set_defaults(self):
         self.config = {
             # Default configuration 
-            "stop_flag": False,
-            "is_running": False,
-            "active_device": False,
             "audio_enabled": False,
             "audio_mode": "Share_Audio",
+            "audio_codec": "opus",  # or "pcm", falls back to pcm when either side lacks opus
+            "audio_bitrate": 64000,  # opus bits per second
+            "audio_frame_ms": 10,  # audio per datagram: 2.5, 5, 10, 20, 40 or 60
+            "audio_capture": "auto",  # "sounddevice", "ffmpeg", or auto to prefer sounddevice
 
             # Local config (specific to current instance)
             "mode": "server",  # or "client"
             "server_direction": "Right",  # screen direcion related to client
             "server_ip": "" ,
             "audio_ip":"",
+            "audio_targets": [],  # more receivers fed by the same capture
+            "audio_multicast": "",  # multicast group, e.g. 239.255.42.99, replaces the unicast targets
+            "wire_protocol": "binary",  # or "json" to force the legacy format
+            "pointer_rate_hz": 120,  # max pointer updates per second, 0 sends every move
+            "connection_mode": "single",  # or "dual" for the legacy two port setup
+            "client_name": "",  # name announced to the server, defaults to the host name
+            "layout": {},  # server only, screen graph e.g. {"server": {"Right": "desk-2"}}
+            "clipboard_mode": "eager",  # or "lazy" to send only an offer on crossing and fetch on paste
+            "latency_stats": False,  # timestamp input events and measure end to end latency, both machines
+            "log_level": "INFO",
+            "log_format": "text",  # or "json" for one JSON object per line
+            "log_max_bytes": 5_000_000,  # logs.log rotates at this size, 0 never
+            "log_backups": 3,  # rotated files kept, logs.log.1 is the newest
 
             #Ports
             "server_primary_port": 50007,
             "server_secondary_port": 50008,
             "audio_port": 50009, 
-
-            #clipboard
-            "clipboard" : "" 
+            "stats_port": 50010,  # localhost JSON stats while latency_stats is on, 0 disables
         }
 
     def load(self):
@@ -36,24 +56,46 @@ class AppConfig:
             try:
                 with open(self.config_path, "r") as f:
                     data = json.load(f)
-                    self.config.update(data)
+                for key in RUNTIME_KEYS:
+                    data.pop(key, None)
+                self.config.update(data)
             except Exception as e:
                 print(f"[Config] Failed to load config: {e}")
 
     def save(self):
-        try:
-            with open(self.config_path, "w") as f:
-                json.dump(self.config, f, indent=4)
-        except Exception as e:
-            print(f"[Config] Failed to save config: {e}")
+        """Schedule a write, bursts of changes end up in a single write."""
+        with self.save_lock:
+            if self.save_timer is None:
+                self.save_timer = threading.Timer(SAVE_DELAY, self.flush)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def flush(self):
+        """Write the settings now, atomically replacing the old file."""
+        with self.save_lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+            tmp_path = self.config_path + ".tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(self.config, f, indent=4)
+                os.replace(tmp_path, self.config_path)
+            except Exception as e:
+                print(f"[Config] Failed to save config: {e}")
 
     def __getattr__(self, name):
         return self.config.get(name)
 
     def __setattr__(self, name, value):
-        if name in ("config_path", "config"):
+        if name in ("config_path", "config", "save_timer", "save_lock"):
             super().__setattr__(name, value)
         else:
             self.config[name] = value
 
 app_config = AppConfig()
+
+@atexit.register
+def _flush_pending_save():
+    if app_config.save_timer is not None:
+        app_config.flush()
@@ -0,0 +1,58 @@
+# drift.py
+import numpy as np
+
+class DriftCompensator:
+    """Keeps playback latency steady when sender and receiver clocks differ.
+
+    Once per frame the buffered audio is compared with the wanted latency.
+    The error is smoothed (the jitter buffer moves in whole packets) and fed
+    to a PI controller. Its output is a resampling ratio a little above 1
+    when too much audio is buffered, a little below when it drains. Each
+    frame is stretched by that ratio with linear interpolation. The read
+    position carries over between frames, so a ratio of exactly 1 passes
+    samples through untouched.
+    """
+    def __init__(self, rate, channels, kp=0.14, ki=0.01, smoothing=2.0, max_deviation=0.005):
+        self.rate = rate
+        self.channels = channels
+        self.kp = kp
+        self.ki = ki
+        self.smoothing = smoothing  # seconds
+        self.max_deviation = max_deviation
+        self.error = None
+        self.integral = 0.0
+        self.ratio = 1.0
+        self.phase = 1.0
+        self.last = np.zeros((1, channels), dtype=np.float64)
+        self.grid = np.arange(0)
+
+    def update(self, buffered, target, frame_samples):
+        """Adjust the ratio, `buffered` and `target` in samples."""
+        dt = frame_samples / self.rate
+        error = (buffered - target) / self.rate
+        if self.error is None:
+            self.error = error
+        self.error += (error - self.error) * min(1.0, dt / self.smoothing)
+        limit = self.max_deviation
+        self.integral = max(-limit, min(limit, self.integral + self.ki * self.error * dt))
+        self.ratio = 1.0 + max(-limit, min(limit, self.kp * self.error + self.integral))
+
+    def process(self, pcm):
+        """Resample one frame of s16le bytes, returns an int16 array."""
+        frame = np.frombuffer(pcm, dtype=np.int16).reshape(-1, self.channels)
+        n = len(frame)
+        if self.ratio == 1.0 and self.phase == 1.0:
+            self.last[0] = frame[-1]
+            return frame
+        # Index 0 is the previous frame's last sample, so interpolation never jumps at frame edges
+        ext = np.concatenate((self.last, frame))
+        if len(self.grid) != n + 1:
+            self.grid = np.arange(n + 1, dtype=np.float64)
+        count = int((n - self.phase) // self.ratio) + 1
+        positions = self.phase + np.arange(count) * self.ratio
+        out = np.empty((count, self.channels), dtype=np.int16)
+        for ch in range(self.channels):
+            out[:, ch] = np.rint(np.interp(positions, self.grid, ext[:, ch]))
+        self.phase = positions[-1] + self.ratio - n
+        self.last[0] = frame[-1]
+        return out
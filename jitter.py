@@ -0,0 +1,142 @@
+# jitter.py
+import math
+import threading
+import time
+
+SEQ_MOD = 1 << 16
+
+def seq_diff(a, b):
+    """a - b for 16 bit sequence numbers that wrap around."""
+    return (a - b + 0x8000) % SEQ_MOD - 0x8000
+
+class JitterBuffer:
+    """Reorders audio packets and hands them out at the playback pace.
+
+    The network thread `push()`es packets as they arrive and the playback
+    thread `pop()`s one per frame. Playback starts once `target` frames are
+    queued. `target` follows the measured interarrival jitter (the RFC 3550
+    estimator) between `min_frames` and `max_frames`. A packet that arrives
+    after its slot was played is dropped. A missing slot pops as None so the
+    caller can conceal it. Running dry stops playback until the buffer has
+    refilled to `target`.
+    """
+    def __init__(self, min_frames=2, max_frames=25):
+        self.lock = threading.Lock()
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.reset(None)
+
+    def reset(self, rate):
+        self.packets = {}  # seq -> item
+        self.rate = rate
+        self.next_seq = None
+        self.playing = False
+        self.target = self.min_frames
+        self.frame_samples = None
+        self.jitter = 0.0  # seconds
+        self.last_transit = None
+        self.last_seq = None
+        self.last_timestamp = None
+        self.received = self.late = self.duplicates = 0
+        self.concealed = self.underruns = self.skipped = 0
+
+    def push(self, seq, timestamp, rate, item):
+        now = time.monotonic()
+        with self.lock:
+            if rate != self.rate:
+                # New stream format, nothing queued so far can be played with it
+                self.reset(rate)
+            if self.next_seq is not None:
+                behind = seq_diff(seq, self.next_seq)
+                if behind < -4 * self.max_frames:
+                    # Too old to be late, the sender restarted
+                    self.reset(rate)
+                elif behind < 0:
+                    self.received += 1
+                    self.late += 1
+                    return
+            self.received += 1
+            if seq in self.packets:
+                self.duplicates += 1
+                return
+            self.packets[seq] = item
+            self._measure(now, seq, timestamp)
+            if len(self.packets) > 2 * self.max_frames:
+                # Far behind, e.g. after the device stalled, start over from the newest audio
+                self.packets.pop(self._oldest())
+                self.skipped += 1
+                if self.playing:
+                    self.next_seq = self._oldest()
+
+    def _measure(self, now, seq, timestamp):
+        transit = now - timestamp / self.rate
+        if self.last_transit is not None:
+            d = abs(transit - self.last_transit)
+            if d < 1.0:  # larger jumps are timestamp wraps or sender restarts
+                self.jitter += (d - self.jitter) / 16
+        self.last_transit = transit
+        if self.last_seq is not None and seq_diff(seq, self.last_seq) == 1:
+            samples = (timestamp - self.last_timestamp) % (1 << 32)
+            if 0 < samples < self.rate:
+                self.frame_samples = samples
+        self.last_seq, self.last_timestamp = seq, timestamp
+        if self.frame_samples:
+            frame = self.frame_samples / self.rate
+            wanted = math.ceil(3 * self.jitter / frame) + 1
+            self.target = max(self.min_frames, min(self.max_frames, wanted))
+
+    def _oldest(self):
+        ref = next(iter(self.packets))
+        return min(self.packets, key=lambda s: seq_diff(s, ref))
+
+    def pop(self):
+        """Return the next item, or None when there is nothing to play for this slot."""
+        with self.lock:
+            if not self.playing:
+                if not self.packets or len(self.packets) < self.target:
+                    return None
+                self.playing = True
+                self.next_seq = self._oldest()
+            if not self.packets:
+                self.underruns += 1
+                self.playing = False
+                return None
+            if self.next_seq not in self.packets:
+                oldest = self._oldest()
+                if seq_diff(oldest, self.next_seq) > self.max_frames:
+                    # A gap no late packet can fill, jump to what we have
+                    self.next_seq = oldest
+                    self.skipped += 1
+            item = self.packets.pop(self.next_seq, None)
+            self.next_seq = (self.next_seq + 1) % SEQ_MOD
+            if item is None:
+                self.concealed += 1
+            elif len(self.packets) > 2 * self.target + 2:
+                # Latency left over from a jitter burst, skip a frame to catch up
+                self.packets.pop(self.next_seq, None)
+                self.next_seq = (self.next_seq + 1) % SEQ_MOD
+                self.skipped += 1
+            return item
+
+    def depth(self):
+        return len(self.packets)
+
+    def latency_ms(self):
+        if not self.frame_samples:
+            return 0.0
+        return 1000.0 * len(self.packets) * self.frame_samples / self.rate
+
+    def stats(self):
+        with self.lock:
+            return {
+                "depth": len(self.packets),
+                "target": self.target,
+                "latency_ms": round(self.latency_ms(), 1),
+                "jitter_ms": round(self.jitter * 1000, 2),
+                "received": self.received,
+                "late": self.late,
+                "duplicates": self.duplicates,
+                "concealed": self.concealed,
+                "underruns": self.underruns,
+                "skipped": self.skipped,
+            }
@@ -0,0 +1,89 @@
+# keymap.py
+import platform
+
+# Keys travel as (kind, code). Both sides must share these tables.
+KIND_SPECIAL = 0  # code indexes SPECIAL_KEYS
+KIND_CHAR = 1     # code is the character's code point
+KIND_DEAD = 2     # dead key, code is its combining character's code point
+KIND_VK_WINDOWS = 3  # virtual key codes only mean something on the system that sent them
+KIND_VK_X11 = 4
+KIND_VK_DARWIN = 5
+
+# pynput.keyboard.Key member names by code, only ever append. A member one
+# platform lacks decodes to None there.
+SPECIAL_KEYS = (
+    "unknown", "alt", "alt_l", "alt_r", "alt_gr", "backspace", "caps_lock",
+    "cmd", "cmd_l", "cmd_r", "ctrl", "ctrl_l", "ctrl_r", "delete", "down",
+    "end", "enter", "esc", "home", "left", "page_down", "page_up", "right",
+    "shift", "shift_l", "shift_r", "space", "tab", "up",
+    "media_play_pause", "media_volume_mute", "media_volume_down",
+    "media_volume_up", "media_previous", "media_next",
+    "insert", "menu", "num_lock", "pause", "print_screen", "scroll_lock",
+) + tuple(f"f{i}" for i in range(1, 25))
+SPECIAL_CODES = {name: code for code, name in enumerate(SPECIAL_KEYS)}
+
+VK_KINDS = {"windows": KIND_VK_WINDOWS, "linux": KIND_VK_X11, "darwin": KIND_VK_DARWIN}
+
+def legacy_name(kind, code):
+    """The key string older peers expect, as produced by key.char or str(key)."""
+    if kind == KIND_SPECIAL:
+        return "Key." + (SPECIAL_KEYS[code] if code < len(SPECIAL_KEYS) else "unknown")
+    if kind == KIND_CHAR or kind == KIND_DEAD:
+        return chr(code)
+    return f"<{code}>"
+
+class KeyMap:
+    """Translates between pynput keys and (kind, code) pairs.
+
+    Every pynput object is resolved once here, so encoding a key press is a
+    dict lookup and decoding one an index into a list. Key members this
+    table does not list travel as virtual key codes instead of getting
+    dropped.
+    """
+    def __init__(self, key_class, keycode_class):
+        self.Key = key_class
+        self.KeyCode = keycode_class
+        self.special = [getattr(key_class, name, None) for name in SPECIAL_KEYS]
+        self.codes = {}
+        for code, key in enumerate(self.special):
+            if key is not None:
+                self.codes.setdefault(key, code)  # aliases keep the first name
+        self.names = {f"Key.{name}": key for name, key in zip(SPECIAL_KEYS, self.special) if key is not None}
+        self.vk_kind = VK_KINDS.get(platform.system().lower(), KIND_VK_X11)
+
+    def encode(self, key):
+        if isinstance(key, self.Key):
+            code = self.codes.get(key)
+            if code is not None:
+                return KIND_SPECIAL, code
+            key = key.value  # a member missing from SPECIAL_KEYS, send its virtual key
+        char = getattr(key, "char", None)
+        if char is not None and len(char) == 1:
+            return (KIND_DEAD if getattr(key, "is_dead", False) else KIND_CHAR), ord(char)
+        vk = getattr(key, "vk", None)
+        if vk is not None:
+            return self.vk_kind, vk
+        return KIND_SPECIAL, 0
+
+    def decode(self, kind, code):
+        """Return something keyboard.Controller can press, None when this system has no such key."""
+        if kind == KIND_SPECIAL:
+            return self.special[code] if code < len(self.special) else None
+        if kind == KIND_CHAR:
+            return chr(code)
+        if kind == KIND_DEAD:
+            return self.KeyCode.from_dead(chr(code))
+        if kind == self.vk_kind:
+            return self.KeyCode.from_vk(code)
+        return None
+
+    def parse(self, name):
+        """Decode a key string from an older peer."""
+        key = self.names.get(name)
+        if key is not None:
+            return key
+        if name.startswith("<") and name.endswith(">") and name[1:-1].isdigit():
+            return self.KeyCode.from_vk(int(name[1:-1]))
+        if name.startswith("Key."):
+            return None
+        return name
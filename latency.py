@@ -0,0 +1,133 @@
+# latency.py
+import json
+import logging
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WINDOW = 2048  # latest samples kept per event kind
+CLOCK_SAMPLES = 8
+PERCENTILES = (50, 95, 99)
+BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Received event type -> reported kind
+KINDS = {
+    "move": "move",
+    "click": "click",
+    "scroll": "click",
+    "key_press": "key",
+    "key_release": "key",
+    "active_device": "transition",
+}
+
+def now_us():
+    """Timestamp for latency measurements, a monotonic clock in microseconds."""
+    return int(time.perf_counter() * 1_000_000)
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+class ClockSync:
+    """Offset between a peer's clock and ours, from ping round trips.
+
+    A pong gives the peer's clock at roughly the midpoint of the round trip,
+    exact when both legs took the same time. Queuing only ever makes a round
+    trip longer, so the sample with the shortest one among the last few is
+    used.
+    """
+    def __init__(self):
+        self.samples = deque(maxlen=CLOCK_SAMPLES)
+        self.offset = None  # peer clock minus ours, microseconds
+        self.rtt = None
+
+    def add(self, sent, remote, received):
+        rtt = received - sent
+        if rtt < 0:
+            return
+        self.samples.append((rtt, remote - (sent + received) // 2))
+        self.rtt, self.offset = min(self.samples)
+
+    def to_local(self, remote_us):
+        return None if self.offset is None else remote_us - self.offset
+
+    def stats(self):
+        if self.offset is None:
+            return None
+        return {"offset_ms": round(self.offset / 1000, 3), "rtt_ms": round(self.rtt / 1000, 3)}
+
+class LatencyStats:
+    """Rolling latency percentiles and histograms per event kind, in milliseconds."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.counts = {}
+
+    def record(self, kind, ms):
+        with self.lock:
+            window = self.windows.get(kind)
+            if window is None:
+                window = self.windows[kind] = deque(maxlen=WINDOW)
+                self.counts[kind] = 0
+            window.append(ms)
+            self.counts[kind] += 1
+
+    def snapshot(self):
+        with self.lock:
+            windows = {kind: sorted(window) for kind, window in self.windows.items()}
+            counts = dict(self.counts)
+        result = {}
+        for kind, ordered in windows.items():
+            entry = {"count": counts[kind], "window": len(ordered)}
+            for p in PERCENTILES:
+                entry[f"p{p}"] = round(percentile(ordered, p), 3)
+            entry["max"] = round(ordered[-1], 3) if ordered else 0.0
+            histogram, i = {}, 0
+            for bound in BUCKETS_MS:
+                n = 0
+                while i < len(ordered) and ordered[i] <= bound:
+                    n += 1
+                    i += 1
+                histogram[f"<={bound}"] = n
+            histogram[f">{BUCKETS_MS[-1]}"] = len(ordered) - i
+            entry["histogram"] = histogram
+            result[kind] = entry
+        return result
+
+    def summary(self):
+        parts = []
+        for kind, entry in sorted(self.snapshot().items()):
+            parts.append(f"{kind} p50 {entry['p50']:.2f} p95 {entry['p95']:.2f} "
+                         f"p99 {entry['p99']:.2f} ms (n={entry['count']})")
+        return ", ".join(parts)
+
+def serve(port, sources):
+    """Serve {name: source()} as JSON on localhost, e.g. http://127.0.0.1:<port>/stats."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("", "/stats"):
+                self.send_error(404)
+                return
+            body = json.dumps({name: source() for name, source in sources.items()}, indent=2).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    except OSError as e:
+        print(f"[Stats] Could not listen on port {port}: {e}")
+        logging.info(f"[Stats] Could not listen on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[Stats] Serving on http://127.0.0.1:{port}/stats")
+    logging.info(f"[Stats] Serving on http://127.0.0.1:{port}/stats")
+    return server
@@ -0,0 +1,49 @@
+# layout.py
+SERVER = "server"
+ANY_CLIENT = "*"  # placeholder node, taken by the first client not named in the layout
+
+DIRECTIONS = ("Left", "Right", "Top", "Bottom")
+OPPOSITE = {"Left": "Right", "Right": "Left", "Top": "Bottom", "Bottom": "Top"}
+
+class ScreenLayout:
+    """Graph of screens, every node maps a direction to its neighbour.
+
+    Links only need to be written once, the reverse direction is added
+    automatically: {"server": {"Right": "desk-2"}} also means desk-2 has
+    the server on its Left. Neighbours of neighbours are reachable by
+    walking the graph one edge at a time.
+    """
+    def __init__(self, links):
+        self.links = {SERVER: {}}
+        for node, neighbors in links.items():
+            for direction, target in neighbors.items():
+                if direction not in OPPOSITE or not target:
+                    print(f"[Layout] Ignoring invalid link {node} {direction} {target}")
+                    continue
+                self.links.setdefault(node, {})[direction] = target
+                self.links.setdefault(target, {}).setdefault(OPPOSITE[direction], node)
+
+    @classmethod
+    def from_config(cls, layout, server_direction):
+        """Use the `layout` setting, or the single client of `server_direction`."""
+        if layout:
+            return cls(layout)
+        return cls({SERVER: {server_direction or "Right": ANY_CLIENT}})
+
+    def nodes(self):
+        return list(self.links)
+
+    def neighbors(self, node):
+        return self.links.get(node, {})
+
+    def place(self, name, taken):
+        """Return the node a client called `name` occupies, or None if it has no place.
+
+        A named node is returned even when taken, a reconnecting client
+        replaces its stale connection.
+        """
+        if name and name in self.links and name != SERVER:
+            return name
+        if ANY_CLIENT in self.links and ANY_CLIENT not in taken:
+            return ANY_CLIENT
+        return None
@@ -1,34 +1,115 @@
 # log_viewer.py
 import tkinter as tk
 from tkinter import ttk
-import threading
-import time
 import os,sys
 
 LOG_FILE = "logs.log"
 
-def read_log(text_widget):
-    last_mod_time = 0
-    while True: 
+POLL_MS = 500
+MAX_LINES = 5000  # lines kept in the widget, older ones scroll out
+INITIAL_BYTES = 512 * 1024  # how far back from the end a large log starts
+READ_LIMIT = 1 << 20  # bytes taken per poll, a burst catches up over a few polls
+
+class LogTail:
+    """Reads only what was appended to a log file since the last call.
+
+    Remembers the file offset. A file that shrank (clear_logs truncates it)
+    is read again from the start. When logsetup rotates it, the rest of the
+    renamed file is read first, then the new file from the start; keeping
+    the old one open instead would stop the rename on Windows. An incomplete
+    last line waits for its newline.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.identity = None
+        self.offset = 0
+        self.partial = b""
+
+    def reset(self):
+        self.offset = 0
+        self.partial = b""
+
+    def read(self):
+        """Return (restarted, text), text being the new complete lines.
+
+        `restarted` means the file was truncated and text starts it over.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False, ""
+        restarted = False
+        identity = (st.st_dev, st.st_ino)
+        data = b""
+        skip = False
+        if self.identity is None:
+            self.offset = max(0, st.st_size - INITIAL_BYTES)
+            self.partial = b""
+            skip = self.offset > 0
+        elif identity != self.identity:
+            data = self.rotated_rest()
+            self.offset = 0
+        elif st.st_size < self.offset:
+            restarted = True
+            self.reset()
+        self.identity = identity
+        if st.st_size > self.offset:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                new = f.read(READ_LIMIT)
+            self.offset += len(new)
+            if skip:
+                new = new[new.find(b"\n") + 1:]  # started mid line
+            data += new
+        if not data:
+            return restarted, ""
+        data = self.partial + data
+        cut = data.rfind(b"\n") + 1
+        self.partial = data[cut:]
+        text = data[:cut].decode("utf-8", errors="replace")  # as logsetup writes it
+        return restarted, text.replace("\r\n", "\n")
+
+    def rotated_rest(self):
+        # What reached the file after the last read and before the rotation renamed it
         try:
-            if os.path.exists(LOG_FILE):
-                mod_time = os.path.getmtime(LOG_FILE)
-                if mod_time != last_mod_time:
-                    last_mod_time = mod_time
-                    with open(LOG_FILE, "r") as f:
-                        content = f.read()
-                    text_widget.config(state='normal')
-                    text_widget.delete('1.0', tk.END)
-                    text_widget.insert(tk.END, content)
-                    text_widget.config(state='disabled')
-                    text_widget.see('end')
-        except Exception as e:
-            print(f"Error reading log file: {e}")
-        time.sleep(1)
-
-def clear_logs(text_widget):
+            with open(self.path + ".1", "rb") as f:
+                st = os.fstat(f.fileno())
+                if (st.st_dev, st.st_ino) == self.identity:
+                    f.seek(self.offset)
+                    return f.read()
+        except OSError:
+            pass
+        self.partial = b""  # replaced rather than rotated, its last line stays incomplete
+        return b""
+
+def append_log(text_widget, text, restarted=False):
+    at_bottom = text_widget.yview()[1] >= 1.0
+    text_widget.config(state='normal')
+    if restarted:
+        text_widget.delete('1.0', tk.END)
+    text_widget.insert(tk.END, text)
+    lines = int(text_widget.index('end-1c').split('.')[0])
+    if lines > MAX_LINES:
+        text_widget.delete('1.0', f"{lines - MAX_LINES + 1}.0")
+    text_widget.config(state='disabled')
+    if at_bottom or restarted:
+        text_widget.see('end')  # follow the log unless the user scrolled up
+
+def follow_log(text_widget, tail):
+    """Poll for appended lines on the Tk thread, reads are small enough not to stall it."""
+    try:
+        restarted, text = tail.read()
+        if text or restarted:
+            append_log(text_widget, text, restarted)
+    except Exception as e:
+        print(f"Error reading log file: {e}")
+    text_widget.after(POLL_MS, follow_log, text_widget, tail)
+
+def clear_logs(text_widget, tail=None):
     with open(LOG_FILE, "w") as f:
         f.truncate(0)
+    if tail is not None:
+        tail.reset()
     text_widget.config(state='normal')
     text_widget.delete('1.0', tk.END)
     text_widget.config(state='disabled')
@@ -53,10 +134,11 @@ def main():
     button_frame = ttk.Frame(root)
     button_frame.pack(pady=5)
 
-    ttk.Button(button_frame, text="Clear Logs", command=lambda: clear_logs(text_area)).pack(side='left', padx=10)
+    tail = LogTail(LOG_FILE)
+    ttk.Button(button_frame, text="Clear Logs", command=lambda: clear_logs(text_area, tail)).pack(side='left', padx=10)
     ttk.Button(button_frame, text="Close", command=root.destroy).pack(side='right', padx=10)
 
-    threading.Thread(target=read_log, args=(text_area,), daemon=True).start()
+    follow_log(text_area, tail)
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+# logsetup.py
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import secrets
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from config import app_config
+
+LOG_FILE = "logs.log"
+ENV_PORT = "PORTAL_LOG_PORT"
+ENV_AUTHKEY = "PORTAL_LOG_KEY"
+RECONNECT_INTERVAL = 1.0  # seconds between attempts to reach the writer
+
+_queue = None
+_listener = None
+
+class ContextFilter(logging.Filter):
+    """Stamps every record of this process with its component.
+
+    `event` names what happened and `fields` carries its values, both
+    optional and usually set through `extra=fields(...)`.
+    """
+    def __init__(self, component):
+        super().__init__()
+        self.component = component
+
+    def filter(self, record):
+        if not hasattr(record, "component"):
+            record.component = self.component
+        if not hasattr(record, "event"):
+            record.event = "-"
+        if not hasattr(record, "fields"):
+            record.fields = {}
+        return True
+
+class TextFormatter(logging.Formatter):
+    """time level component[pid] event message key=value..."""
+    def __init__(self):
+        super().__init__("%(asctime)s.%(msecs)03d %(levelname)s %(component)s[%(process)d] %(event)s %(message)s",
+                         "%Y-%m-%d %H:%M:%S")
+
+    def format(self, record):
+        line = super().format(record)
+        if record.fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in record.fields.items())
+        return line
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "component": record.component,
+            "pid": record.process,
+            "thread": record.threadName,
+            "event": record.event,
+            "message": record.getMessage(),
+        }
+        entry.update(record.fields)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class HubHandler(logging.Handler):
+    """Sends records to the writer process started with serve().
+
+    Runs on the QueueListener thread, never on the thread that logged.
+    Records logged while the writer is unreachable are dropped.
+    """
+    def __init__(self, port, authkey):
+        super().__init__()
+        self.address = ("127.0.0.1", port)
+        self.authkey = authkey
+        self.conn = None
+        self.next_attempt = 0.0
+
+    def emit(self, record):
+        if self.conn is None:
+            now = time.monotonic()
+            if now < self.next_attempt:
+                return
+            self.next_attempt = now + RECONNECT_INTERVAL
+            try:
+                self.conn = Client(self.address, authkey=self.authkey)
+            except Exception:
+                return
+        try:
+            self.conn.send(dict(record.__dict__))
+        except Exception:
+            self.conn = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        super().close()
+
+def fields(event, **values):
+    """`extra` for a structured record, e.g. logging.info(msg, extra=fields("transition", ms=2.5))."""
+    return {"event": event, "fields": values}
+
+def file_handler():
+    handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=app_config.log_max_bytes or 0,
+                                                   backupCount=app_config.log_backups or 0, encoding="utf-8")
+    handler.setFormatter(JsonFormatter() if app_config.log_format == "json" else TextFormatter())
+    return handler
+
+def setup(component):
+    """Route this process' logging through a queue to a single writer.
+
+    Logging calls only format the message and enqueue it, a QueueListener
+    thread does the I/O. In a process started by the portal UI (see serve())
+    records go to the portal, which alone writes logs.log; anywhere else this
+    process writes it. Like logging.basicConfig, does nothing when the root
+    logger already has handlers.
+    """
+    global _queue, _listener
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    root.setLevel(app_config.log_level or "INFO")
+    _queue = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(_queue)
+    handler.addFilter(ContextFilter(component))
+    root.addHandler(handler)
+
+    port = os.environ.get(ENV_PORT)
+    authkey = os.environ.get(ENV_AUTHKEY)
+    if port and authkey:
+        target = HubHandler(int(port), bytes.fromhex(authkey))
+    else:
+        target = file_handler()
+    _listener = logging.handlers.QueueListener(_queue, target)
+    _listener.start()
+    atexit.register(_listener.stop)  # writes out what is still queued
+
+def serve():
+    """Take the records of child processes, call after setup() in the portal UI.
+
+    The address goes to children through the environment, like the runtime
+    state hub's. Their records join this process' queue, so logs.log has a
+    single writer and lines from different processes never interleave.
+    """
+    if _queue is None:
+        return
+    authkey = secrets.token_bytes(16)
+    listener = Listener(("127.0.0.1", 0), authkey=authkey)
+    os.environ[ENV_PORT] = str(listener.address[1])
+    os.environ[ENV_AUTHKEY] = authkey.hex()
+    threading.Thread(target=_accept, args=(listener,), daemon=True).start()
+
+def _accept(listener):
+    while True:
+        try:
+            conn = listener.accept()
+        except AuthenticationError:
+            continue
+        except OSError:
+            break
+        threading.Thread(target=_receive, args=(conn,), daemon=True).start()
+
+def _receive(conn):
+    while True:
+        try:
+            entry = conn.recv()
+        except Exception:
+            break
+        _queue.put(logging.makeLogRecord(entry))
+    conn.close()
@@ -1,10 +1,12 @@
 import tkinter as tk
 from tkinter import ttk
 from config import app_config
+from runtime import runtime_state
 import threading
 import subprocess
 import time
 import logging 
+import logsetup
 import platform
 import sys,os
 import socket 
@@ -56,11 +58,15 @@ class PortalUI:
         with open("logs.log","w") as f:
             print("")
 
-        logging.basicConfig(level=logging.INFO, filename="logs.log", filemode="a", format="%(levelname)s - %(message)s")
+        # The only process writing logs.log, share.py and audio.py send their records here
+        logsetup.setup("portal")
+        logsetup.serve()
 
         self.tab_control.bind("<<NotebookTabChanged>>", self.on_tab_changed)
         self.create_portal_tab()
 
+        runtime_state.serve()
+
         threading.Thread(target=self.check_status, daemon=True).start()
 
     def on_tab_changed(self, event):
@@ -233,9 +239,9 @@ class PortalUI:
                 logging.info("Portal is already running.")
                 return
 
-            app_config.stop_flag = False
+            runtime_state.stop_flag = False
             self.running = True
-            app_config.is_running = True
+            runtime_state.is_running = True
             self.status_label.config(text="Portal is running", foreground="green")
             self.start_stop_button.config(text="Stop")
             logging.info("Portal started")
@@ -247,7 +253,7 @@ class PortalUI:
             app_config.mode = self.mode.get()
             app_config.audio_enabled = self.audio_enabled.get()
             app_config.audio_mode = self.audio_mode.get()
-            app_config.save()  
+            app_config.flush()
 
             
             try:
@@ -264,9 +270,9 @@ class PortalUI:
 
         elif self.running and mode != "reload":
             logging.info("Stopping portal...")
-            app_config.stop_flag = True
+            runtime_state.stop_flag = True
             self.running = False
-            app_config.is_running = False
+            runtime_state.is_running = False
             self.status_label.config(text="Portal is not running", foreground="red")
             self.start_stop_button.config(text="Start")
             try:
@@ -295,11 +301,12 @@ class PortalUI:
             logging.info(f"Unknown command: {mode}")
 
     def check_status(self):
-        while app_config.is_running and not app_config.stop_flag:
-            time.sleep(0.5)
-        
-        self.status_label.config(text="Portal is not running", foreground="red")
-        self.start_stop_button.config(text="Start")
+        while True:
+            runtime_state.wait_until(lambda: runtime_state.is_running and not runtime_state.stop_flag)
+            runtime_state.wait_until(lambda: not runtime_state.is_running or runtime_state.stop_flag)
+
+            self.status_label.config(text="Portal is not running", foreground="red")
+            self.start_stop_button.config(text="Start")
         
 
 if __name__ == "__main__":
@@ -0,0 +1,481 @@
+# protocol.py
+import asyncio
+import json
+import struct
+from keymap import legacy_name
+
+# Highest binary protocol version this build speaks. 0 means JSON lines.
+PROTOCOL_VERSION = 6
+JSON_VERSION = 0
+CLIPBOARD_HASH_VERSION = 2  # first version with clipboard_have/ref/want
+CLIPBOARD_STREAM_VERSION = 3  # first version with clipboard_item/data/end/cancel
+CLIPBOARD_OFFER_VERSION = 4  # first version with clipboard_offer
+KEY_CODE_VERSION = 5  # first version sending keys as keymap codes
+LATENCY_VERSION = 6  # first version with stamp, ping and pong
+HANDSHAKE_TIMEOUT = 1.0
+
+# Mouse buttons are sent by index, both sides must share this table.
+BUTTONS = ("unknown", "left", "middle", "right", "x1", "x2",
+           "scroll_up", "scroll_down", "scroll_left", "scroll_right") + tuple(f"button{i}" for i in range(8, 31))
+BUTTON_CODES = {name: code for code, name in enumerate(BUTTONS)}
+
+# Binary frame tags (first byte of every frame)
+TAG_MOVE = 0x01
+TAG_CLICK = 0x02
+TAG_SCROLL = 0x03
+TAG_KEY_PRESS = 0x04
+TAG_KEY_RELEASE = 0x05
+TAG_ACTIVE_DEVICE = 0x06
+TAG_CLIPBOARD = 0x07
+TAG_CLIPBOARD_CHUNK = 0x08
+TAG_CLIPBOARD_HAVE = 0x09
+TAG_CLIPBOARD_REF = 0x0A
+TAG_CLIPBOARD_WANT = 0x0B
+TAG_CLIPBOARD_ITEM = 0x0C
+TAG_CLIPBOARD_DATA = 0x0D
+TAG_CLIPBOARD_END = 0x0E
+TAG_CLIPBOARD_CANCEL = 0x0F
+TAG_CLIPBOARD_OFFER = 0x10
+TAG_KEY_CODE_PRESS = 0x11
+TAG_KEY_CODE_RELEASE = 0x12
+TAG_STAMP = 0x13
+TAG_PING = 0x14
+TAG_PONG = 0x15
+
+ITEM_COMPRESSED = 0x01
+ITEM_LAST = 0x02
+
+MOVE = struct.Struct("<Bff")        # tag, x, y (normalized 0..1)
+CLICK = struct.Struct("<BBB")       # tag, button code, pressed
+SCROLL = struct.Struct("<Bhh")      # tag, dx, dy
+ACTIVE = struct.Struct("<BB")       # tag, value
+SHORT_HEADER = struct.Struct("<BB") # tag, payload length (keys)
+KEY_CODE = struct.Struct("<BBI")    # tag, keymap kind, code
+STAMP = struct.Struct("<BQ")        # tag, sender clock in microseconds (stamp, ping)
+PONG = struct.Struct("<BQQ")        # tag, ping's clock, our clock
+LONG_HEADER = struct.Struct("<BI")  # tag, payload length (clipboard)
+CHUNK_HEADER = struct.Struct("<BBI") # tag, final, payload length (clipboard_chunk)
+HASH = struct.Struct("<B16s")       # tag, clipboard content hash
+ITEM = struct.Struct("<BIIBB")      # tag, transfer id, size, flags, MIME type length (clipboard_item)
+DATA_HEADER = struct.Struct("<BII") # tag, transfer id, payload length (clipboard_data)
+TRANSFER = struct.Struct("<BI")     # tag, transfer id (clipboard_end, clipboard_cancel)
+OFFER = struct.Struct("<B16sIB")    # tag, content hash, size, MIME types length (clipboard_offer)
+
+class ProtocolError(Exception):
+    pass
+
+class JsonCodec:
+    """Newline delimited JSON, the original wire format."""
+    version = JSON_VERSION
+    name = "json"
+    resyncs = True  # every frame ends at a newline, a bad one can be skipped
+
+    def encode(self, evt):
+        if "code" in evt:
+            # Keys from the keymap, JSON peers only know key names
+            evt = {"type": evt["type"], "key": legacy_name(evt["kind"], evt["code"])}
+        return (json.dumps(evt) + "\n").encode()
+
+    def frame_end(self, buf, start, end, scanned=0):
+        # Returns the index just past the frame starting at `start`, or -1 if incomplete.
+        # Bytes before `scanned` are known not to hold a newline.
+        idx = buf.find(b"\n", max(start, scanned), end)
+        return -1 if idx < 0 else idx + 1
+
+    def decode(self, buf, start, end):
+        return json.loads(str(buf[start:end - 1], "utf-8"))
+
+class BinaryCodec:
+    """Fixed layout struct frames: one tag byte followed by the payload.
+
+    `version` is the negotiated version, callers check it before sending
+    events the peer may not know.
+    """
+    name = "binary"
+    resyncs = False  # after a bad frame nothing tells where the next one starts
+
+    _fixed_sizes = {
+        TAG_MOVE: MOVE.size,
+        TAG_CLICK: CLICK.size,
+        TAG_SCROLL: SCROLL.size,
+        TAG_ACTIVE_DEVICE: ACTIVE.size,
+        TAG_CLIPBOARD_HAVE: HASH.size,
+        TAG_CLIPBOARD_REF: HASH.size,
+        TAG_CLIPBOARD_WANT: HASH.size,
+        TAG_CLIPBOARD_END: TRANSFER.size,
+        TAG_CLIPBOARD_CANCEL: TRANSFER.size,
+        TAG_KEY_CODE_PRESS: KEY_CODE.size,
+        TAG_KEY_CODE_RELEASE: KEY_CODE.size,
+        TAG_STAMP: STAMP.size,
+        TAG_PING: STAMP.size,
+        TAG_PONG: PONG.size,
+    }
+
+    def __init__(self, version=PROTOCOL_VERSION):
+        self.version = version
+        self._encoders = {
+            "move": self._encode_move,
+            "click": self._encode_click,
+            "scroll": self._encode_scroll,
+            "key_press": self._encode_key_press,
+            "key_release": self._encode_key_release,
+            "active_device": self._encode_active,
+            "clipboard": self._encode_clipboard,
+            "clipboard_chunk": self._encode_clipboard_chunk,
+            "clipboard_have": self._encode_hash,
+            "clipboard_ref": self._encode_hash,
+            "clipboard_want": self._encode_hash,
+            "clipboard_item": self._encode_item,
+            "clipboard_data": self._encode_data,
+            "clipboard_end": self._encode_transfer,
+            "clipboard_cancel": self._encode_transfer,
+            "clipboard_offer": self._encode_offer,
+            "ping": self._encode_ping,
+            "pong": self._encode_pong,
+        }
+        self._decoders = {
+            TAG_MOVE: self._decode_move,
+            TAG_CLICK: self._decode_click,
+            TAG_SCROLL: self._decode_scroll,
+            TAG_KEY_PRESS: self._decode_key_press,
+            TAG_KEY_RELEASE: self._decode_key_release,
+            TAG_ACTIVE_DEVICE: self._decode_active,
+            TAG_CLIPBOARD: self._decode_clipboard,
+            TAG_CLIPBOARD_CHUNK: self._decode_clipboard_chunk,
+            TAG_CLIPBOARD_HAVE: self._decode_hash,
+            TAG_CLIPBOARD_REF: self._decode_hash,
+            TAG_CLIPBOARD_WANT: self._decode_hash,
+            TAG_CLIPBOARD_ITEM: self._decode_item,
+            TAG_CLIPBOARD_DATA: self._decode_data,
+            TAG_CLIPBOARD_END: self._decode_transfer,
+            TAG_CLIPBOARD_CANCEL: self._decode_transfer,
+            TAG_CLIPBOARD_OFFER: self._decode_offer,
+            TAG_KEY_CODE_PRESS: self._decode_key_code,
+            TAG_KEY_CODE_RELEASE: self._decode_key_code,
+            TAG_STAMP: self._decode_stamp,
+            TAG_PING: self._decode_ping,
+            TAG_PONG: self._decode_pong,
+        }
+
+    def encode(self, evt):
+        try:
+            encoder = self._encoders[evt["type"]]
+        except KeyError:
+            raise ProtocolError(f"Unknown event type: {evt.get('type')}")
+        if "ts" in evt and self.version >= LATENCY_VERSION:
+            # One buffer, so the stamp can never be separated from its event
+            return STAMP.pack(TAG_STAMP, evt["ts"]) + encoder(evt)
+        return encoder(evt)
+
+    def frame_end(self, buf, start, end, scanned=0):
+        tag = buf[start]
+        size = self._fixed_sizes.get(tag)
+        if size is None:
+            if tag == TAG_KEY_PRESS or tag == TAG_KEY_RELEASE:
+                if end - start < SHORT_HEADER.size:
+                    return -1
+                size = SHORT_HEADER.size + buf[start + 1]
+            elif tag == TAG_CLIPBOARD:
+                if end - start < LONG_HEADER.size:
+                    return -1
+                size = LONG_HEADER.size + LONG_HEADER.unpack_from(buf, start)[1]
+            elif tag == TAG_CLIPBOARD_CHUNK:
+                if end - start < CHUNK_HEADER.size:
+                    return -1
+                size = CHUNK_HEADER.size + CHUNK_HEADER.unpack_from(buf, start)[2]
+            elif tag == TAG_CLIPBOARD_ITEM:
+                if end - start < ITEM.size:
+                    return -1
+                size = ITEM.size + buf[start + ITEM.size - 1]
+            elif tag == TAG_CLIPBOARD_DATA:
+                if end - start < DATA_HEADER.size:
+                    return -1
+                size = DATA_HEADER.size + DATA_HEADER.unpack_from(buf, start)[2]
+            elif tag == TAG_CLIPBOARD_OFFER:
+                if end - start < OFFER.size:
+                    return -1
+                size = OFFER.size + buf[start + OFFER.size - 1]
+            else:
+                raise ProtocolError(f"Unknown frame tag: {tag:#04x}")
+        return start + size if end - start >= size else -1
+
+    def decode(self, buf, start, end):
+        return self._decoders[buf[start]](buf, start, end)
+
+    # Encoders
+    def _encode_move(self, evt):
+        return MOVE.pack(TAG_MOVE, evt["x"], evt["y"])
+
+    def _encode_click(self, evt):
+        return CLICK.pack(TAG_CLICK, BUTTON_CODES.get(evt["button"], 0), bool(evt["pressed"]))
+
+    def _encode_scroll(self, evt):
+        return SCROLL.pack(TAG_SCROLL, int(evt["dx"]), int(evt["dy"]))
+
+    def _encode_key(self, tag, code_tag, evt):
+        if "code" in evt:
+            if self.version >= KEY_CODE_VERSION:
+                return KEY_CODE.pack(code_tag, evt["kind"], evt["code"])
+            key = legacy_name(evt["kind"], evt["code"])
+        else:
+            key = evt["key"]
+        data = key.encode()
+        if len(data) > 255:
+            raise ProtocolError(f"Key name too long: {key!r}")
+        return SHORT_HEADER.pack(tag, len(data)) + data
+
+    def _encode_key_press(self, evt):
+        return self._encode_key(TAG_KEY_PRESS, TAG_KEY_CODE_PRESS, evt)
+
+    def _encode_key_release(self, evt):
+        return self._encode_key(TAG_KEY_RELEASE, TAG_KEY_CODE_RELEASE, evt)
+
+    def _encode_active(self, evt):
+        return ACTIVE.pack(TAG_ACTIVE_DEVICE, bool(evt["value"]))
+
+    def _encode_clipboard(self, evt):
+        data = evt["content"].encode()
+        return LONG_HEADER.pack(TAG_CLIPBOARD, len(data)) + data
+
+    def _encode_clipboard_chunk(self, evt):
+        data = evt["content"].encode()
+        return CHUNK_HEADER.pack(TAG_CLIPBOARD_CHUNK, bool(evt["final"]), len(data)) + data
+
+    _hash_tags = {"clipboard_have": TAG_CLIPBOARD_HAVE, "clipboard_ref": TAG_CLIPBOARD_REF, "clipboard_want": TAG_CLIPBOARD_WANT}
+    _hash_types = {tag: name for name, tag in _hash_tags.items()}
+
+    def _encode_hash(self, evt):
+        return HASH.pack(self._hash_tags[evt["type"]], bytes.fromhex(evt["hash"]))
+
+    def _encode_item(self, evt):
+        mime = evt["mime"].encode()
+        if len(mime) > 255:
+            raise ProtocolError(f"MIME type too long: {evt['mime']!r}")
+        flags = (ITEM_COMPRESSED if evt["compressed"] else 0) | (ITEM_LAST if evt["last"] else 0)
+        return ITEM.pack(TAG_CLIPBOARD_ITEM, evt["id"], evt["size"], flags, len(mime)) + mime
+
+    def _encode_data(self, evt):
+        return DATA_HEADER.pack(TAG_CLIPBOARD_DATA, evt["id"], len(evt["data"])) + evt["data"]
+
+    _transfer_tags = {"clipboard_end": TAG_CLIPBOARD_END, "clipboard_cancel": TAG_CLIPBOARD_CANCEL}
+    _transfer_types = {tag: name for name, tag in _transfer_tags.items()}
+
+    def _encode_transfer(self, evt):
+        return TRANSFER.pack(self._transfer_tags[evt["type"]], evt["id"])
+
+    def _encode_offer(self, evt):
+        mimes = ",".join(evt["mimes"]).encode()
+        if len(mimes) > 255:
+            raise ProtocolError(f"Too many MIME types: {evt['mimes']!r}")
+        return OFFER.pack(TAG_CLIPBOARD_OFFER, bytes.fromhex(evt["hash"]), evt["size"], len(mimes)) + mimes
+
+    def _encode_ping(self, evt):
+        return STAMP.pack(TAG_PING, evt["t"])
+
+    def _encode_pong(self, evt):
+        return PONG.pack(TAG_PONG, evt["t"], evt["remote"])
+
+    # Decoders
+    def _decode_move(self, buf, start, end):
+        _, x, y = MOVE.unpack_from(buf, start)
+        return {"type": "move", "x": x, "y": y}
+
+    def _decode_click(self, buf, start, end):
+        _, code, pressed = CLICK.unpack_from(buf, start)
+        name = BUTTONS[code] if code < len(BUTTONS) else "unknown"
+        return {"type": "click", "button": name, "pressed": bool(pressed)}
+
+    def _decode_scroll(self, buf, start, end):
+        _, dx, dy = SCROLL.unpack_from(buf, start)
+        return {"type": "scroll", "dx": dx, "dy": dy}
+
+    def _decode_key_press(self, buf, start, end):
+        return {"type": "key_press", "key": str(buf[start + SHORT_HEADER.size:end], "utf-8")}
+
+    def _decode_key_release(self, buf, start, end):
+        return {"type": "key_release", "key": str(buf[start + SHORT_HEADER.size:end], "utf-8")}
+
+    def _decode_key_code(self, buf, start, end):
+        tag, kind, code = KEY_CODE.unpack_from(buf, start)
+        return {"type": "key_press" if tag == TAG_KEY_CODE_PRESS else "key_release", "kind": kind, "code": code}
+
+    def _decode_stamp(self, buf, start, end):
+        return {"type": "stamp", "t": STAMP.unpack_from(buf, start)[1]}
+
+    def _decode_ping(self, buf, start, end):
+        return {"type": "ping", "t": STAMP.unpack_from(buf, start)[1]}
+
+    def _decode_pong(self, buf, start, end):
+        _, t, remote = PONG.unpack_from(buf, start)
+        return {"type": "pong", "t": t, "remote": remote}
+
+    def _decode_active(self, buf, start, end):
+        return {"type": "active_device", "value": bool(buf[start + 1])}
+
+    def _decode_clipboard(self, buf, start, end):
+        return {"type": "clipboard", "content": str(buf[start + LONG_HEADER.size:end], "utf-8")}
+
+    def _decode_clipboard_chunk(self, buf, start, end):
+        return {"type": "clipboard_chunk", "final": bool(buf[start + 1]),
+                "content": str(buf[start + CHUNK_HEADER.size:end], "utf-8")}
+
+    def _decode_hash(self, buf, start, end):
+        tag, digest = HASH.unpack_from(buf, start)
+        return {"type": self._hash_types[tag], "hash": digest.hex()}
+
+    def _decode_item(self, buf, start, end):
+        _, transfer, size, flags, _ = ITEM.unpack_from(buf, start)
+        return {"type": "clipboard_item", "id": transfer, "size": size,
+                "compressed": bool(flags & ITEM_COMPRESSED), "last": bool(flags & ITEM_LAST),
+                "mime": str(buf[start + ITEM.size:end], "utf-8")}
+
+    def _decode_data(self, buf, start, end):
+        # Copied, the receive buffer is reused for the next read
+        return {"type": "clipboard_data", "id": DATA_HEADER.unpack_from(buf, start)[1],
+                "data": bytes(buf[start + DATA_HEADER.size:end])}
+
+    def _decode_transfer(self, buf, start, end):
+        tag, transfer = TRANSFER.unpack_from(buf, start)
+        return {"type": self._transfer_types[tag], "id": transfer}
+
+    def _decode_offer(self, buf, start, end):
+        _, digest, size, _ = OFFER.unpack_from(buf, start)
+        mimes = str(buf[start + OFFER.size:end], "utf-8")
+        return {"type": "clipboard_offer", "hash": digest.hex(), "size": size,
+                "mimes": mimes.split(",") if mimes else []}
+
+class FramedReader:
+    """Reads whole frames from a stream socket.
+
+    Data is received with recv_into straight into one preallocated buffer.
+    Complete frames are decoded in place, a partial frame stays where it is
+    until more data arrives and is only moved to the front once the buffer
+    fills up. The buffer doubles when a single frame does not fit.
+    """
+    def __init__(self, sock, codec, size=65536):
+        self.sock = sock
+        self.codec = codec
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0      # first byte of the pending frame
+        self.end = 0        # end of received data
+        self.scanned = 0    # JSON only, no newline before this index
+        self.errors = []    # frames a resyncing codec could not decode, for the caller to report
+
+    def read(self):
+        """Block until data arrives, return the decoded events or None on EOF."""
+        if self.end == len(self.buffer):
+            self._make_room()
+        n = self.sock.recv_into(self.view[self.end:])
+        if not n:
+            return None
+        self.end += n
+        return self._drain()
+
+    async def read_async(self, loop):
+        """Same as read() for a non-blocking socket driven by an asyncio loop."""
+        if self.end == len(self.buffer):
+            self._make_room()
+        n = await loop.sock_recv_into(self.sock, self.view[self.end:])
+        if not n:
+            return None
+        self.end += n
+        return self._drain()
+
+    def _drain(self):
+        events = []
+        buf, view, codec = self.buffer, self.view, self.codec
+        start, end = self.start, self.end
+        try:
+            while start < end:
+                frame_end = codec.frame_end(buf, start, end, self.scanned)
+                if frame_end < 0:
+                    self.scanned = end
+                    break
+                try:
+                    events.append(codec.decode(view, start, frame_end))
+                except ValueError as e:
+                    if not codec.resyncs:
+                        raise
+                    self.errors.append(e)  # only this line is lost
+                start = frame_end
+        except Exception:
+            # A binary stream cannot be resynchronized, the connection is done
+            self.start = self.end = self.scanned = 0
+            raise
+        if start == end:
+            start = end = 0
+        self.start, self.end = start, end
+        return events
+
+    def _make_room(self):
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.view[self.start:self.end]
+        else:
+            self.view.release()
+            self.buffer = self.buffer + bytearray(len(self.buffer))
+            self.view = memoryview(self.buffer)
+        self.scanned = max(0, self.scanned - self.start)
+        self.start, self.end = 0, pending
+
+def codec_for(version):
+    if version >= 1:
+        return BinaryCodec(version)
+    return JsonCodec()
+
+async def _read_line(loop, sock, limit=64):
+    line = bytearray()
+    while len(line) < limit:
+        ch = await loop.sock_recv(sock, 1)
+        if not ch:
+            break
+        line += ch
+        if ch == b"\n":
+            break
+    return bytes(line)
+
+async def server_handshake(loop, sock, max_version=PROTOCOL_VERSION):
+    """Send CONNECTED and pick the highest version the client offers.
+
+    Returns (codec, client_name). `sock` must be non-blocking. Clients that
+    predate the binary protocol never send HELLO, they get JSON and no name.
+    """
+    await loop.sock_sendall(sock, b"CONNECTED\n")
+    try:
+        line = await asyncio.wait_for(_read_line(loop, sock, limit=256), HANDSHAKE_TIMEOUT)
+        if not line.startswith(b"HELLO "):
+            return JsonCodec(), None
+        fields = line.decode(errors="replace").split(maxsplit=2)
+        version = min(int(fields[1]), max_version)
+        name = fields[2].strip() if len(fields) > 2 else None
+    except (asyncio.TimeoutError, ValueError, IndexError):
+        return JsonCodec(), None
+    await loop.sock_sendall(sock, f"PROTO {version}\n".encode())
+    return codec_for(version), name
+
+async def client_handshake(loop, sock, max_version=PROTOCOL_VERSION, name=""):
+    """Wait for CONNECTED, offer `max_version` and return (codec, negotiated).
+
+    `sock` must be non-blocking. Servers that predate the binary protocol
+    never answer HELLO, they get JSON and `negotiated` is False. `name`
+    tells the server where this client sits in its screen layout.
+    """
+    try:
+        line = await asyncio.wait_for(_read_line(loop, sock), HANDSHAKE_TIMEOUT * 5)
+    except asyncio.TimeoutError:
+        line = b""
+    if line != b"CONNECTED\n":
+        raise Exception("Handshake failed")
+    await loop.sock_sendall(sock, f"HELLO {max_version} {name}".strip().encode() + b"\n")
+    try:
+        line = await asyncio.wait_for(_read_line(loop, sock), HANDSHAKE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return JsonCodec(), False
+    if not line.startswith(b"PROTO "):
+        return JsonCodec(), False
+    try:
+        version = int(line.split()[1])
+    except (ValueError, IndexError):
+        version = JSON_VERSION
+    return codec_for(min(version, max_version)), True
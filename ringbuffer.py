@@ -0,0 +1,58 @@
+# ringbuffer.py
+import numpy as np
+
+class RingBuffer:
+    """Fixed size int16 sample ring for one writer thread and one reader.
+
+    The writer copies decoded PCM bytes straight into the preallocated
+    array and the sounddevice callback copies out of it into `outdata`, so
+    neither side allocates per packet. Each position counter is only ever
+    advanced by its own side, which together with the GIL makes the pair
+    safe without a lock: data is written before `write_pos` moves past it.
+    """
+    def __init__(self, frames, channels):
+        self.frames = frames
+        self.channels = channels
+        self.frame_bytes = channels * 2
+        self.data = np.zeros((frames, channels), dtype=np.int16)
+        self.raw = memoryview(self.data).cast("B")
+        self.write_pos = 0
+        self.read_pos = 0
+        self.underruns = 0
+
+    def fill(self):
+        return self.write_pos - self.read_pos
+
+    def space(self):
+        return self.frames - self.fill()
+
+    def clear(self):
+        # Only call while the reader is stopped
+        self.write_pos = self.read_pos = 0
+
+    def write(self, pcm):
+        """Copy s16le bytes in, return the number of frames that fit."""
+        count = min(len(pcm) // self.frame_bytes, self.space())
+        start = self.write_pos % self.frames
+        first = min(count, self.frames - start)
+        fb = self.frame_bytes
+        self.raw[start * fb:(start + first) * fb] = pcm[:first * fb]
+        if count > first:
+            self.raw[:(count - first) * fb] = pcm[first * fb:count * fb]
+        self.write_pos += count
+        return count
+
+    def read_into(self, out):
+        """Fill `out` (frames x channels), padding with silence when short."""
+        wanted = len(out)
+        count = min(wanted, self.fill())
+        start = self.read_pos % self.frames
+        first = min(count, self.frames - start)
+        out[:first] = self.data[start:start + first]
+        if count > first:
+            out[first:count] = self.data[:count - first]
+        if count < wanted:
+            out[count:] = 0
+            self.underruns += 1
+        self.read_pos += count
+        return count
@@ -0,0 +1,132 @@
+# runtime.py
+import os
+import secrets
+import threading
+from multiprocessing.connection import Listener, Client
+
+ENV_PORT = "PORTAL_RUNTIME_PORT"
+ENV_AUTHKEY = "PORTAL_RUNTIME_KEY"
+
+class RuntimeState:
+    """Volatile state shared by portal.py, share.py and audio.py.
+
+    Values only live in memory. The portal UI hosts a hub on localhost with
+    `serve()`, the worker processes it launches `connect()` to it, and every
+    assignment is pushed to the other processes. Without a hub (e.g. share.py
+    started by hand) the state is simply local to the process.
+    """
+    def __init__(self):
+        self._set("values", {})
+        self._set("defaults", {
+            "is_running": False,
+            "active_device": False,
+            "stop_flag": False,
+        })
+        self._set("cond", threading.Condition())
+        self._set("subscribers", {})
+        self._set("peers", [])
+        self._set("send_lock", threading.Lock())
+        self._set("listener", None)
+        self._set("hub", None)
+        self.values.update(self.defaults)
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __getattr__(self, name):
+        return self.values.get(name)
+
+    def __setattr__(self, name, value):
+        self.update(name, value)
+
+    def update(self, name, value, origin=None):
+        with self.cond:
+            changed = self.values.get(name) != value
+            self.values[name] = value
+            self.cond.notify_all()
+        if not changed:
+            return
+        for callback in list(self.subscribers.get(name, ())):
+            try:
+                callback(value)
+            except Exception as e:
+                print(f"[Runtime] Subscriber error for {name}: {e}")
+        self._publish(name, value, origin)
+
+    def subscribe(self, name, callback):
+        """Call `callback(value)` whenever `name` changes, locally or remotely."""
+        self.subscribers.setdefault(name, []).append(callback)
+
+    def wait_until(self, predicate, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(predicate, timeout)
+
+    # Local channel
+    def serve(self):
+        """Host the hub and export its address for child processes."""
+        authkey = secrets.token_bytes(16)
+        listener = Listener(("127.0.0.1", 0), authkey=authkey)
+        self._set("listener", listener)
+        os.environ[ENV_PORT] = str(listener.address[1])
+        os.environ[ENV_AUTHKEY] = authkey.hex()
+        threading.Thread(target=self._accept_peers, daemon=True).start()
+
+    def connect(self):
+        """Join the hub started by the parent process, if there is one."""
+        port = os.environ.get(ENV_PORT)
+        authkey = os.environ.get(ENV_AUTHKEY)
+        if not port or not authkey:
+            return False
+        try:
+            hub = Client(("127.0.0.1", int(port)), authkey=bytes.fromhex(authkey))
+        except Exception as e:
+            print(f"[Runtime] Could not reach state hub: {e}")
+            return False
+        self._set("hub", hub)
+        with self.cond:
+            self.values.update(hub.recv())
+            self.cond.notify_all()
+        threading.Thread(target=self._receive, args=(hub,), daemon=True).start()
+        return True
+
+    def _accept_peers(self):
+        while True:
+            try:
+                peer = self.listener.accept()
+            except Exception:
+                break
+            with self.send_lock:
+                peer.send(dict(self.values))
+                self.peers.append(peer)
+            threading.Thread(target=self._receive, args=(peer,), daemon=True).start()
+
+    def _receive(self, conn):
+        while True:
+            try:
+                name, value = conn.recv()
+            except Exception:
+                break
+            self.update(name, value, origin=conn)
+        with self.send_lock:
+            if conn in self.peers:
+                self.peers.remove(conn)
+        if conn is self.hub:
+            # The portal UI is gone, workers should wind down
+            self._set("hub", None)
+            self.update("stop_flag", True)
+
+    def _publish(self, name, value, origin):
+        with self.send_lock:
+            targets = list(self.peers)
+            if self.hub is not None:
+                targets.append(self.hub)
+            for conn in targets:
+                if conn is origin:
+                    continue
+                try:
+                    conn.send((name, value))
+                except Exception:
+                    if conn in self.peers:
+                        self.peers.remove(conn)
+
+runtime_state = RuntimeState()
@@ -2,105 +2,188 @@
 import sys
 import socket
 import threading
-import json
+import asyncio
 import time
 import platform
-import pyperclip
-import subprocess
 import logging 
+import logsetup
 from pynput import mouse,keyboard
 from pynput.keyboard import Controller as KeyboardController, Key  
 from pynput.mouse import Button, Controller
 from config import app_config
+from runtime import runtime_state
+import protocol
+import transport
+import clipboard
+import keymap
+import latency
+from layout import ScreenLayout, SERVER
+
+CLIPBOARD_FETCH_TIMEOUT = 5.0  # seconds a paste waits for offered content
+CLOCK_SYNC_INTERVAL = 2.0  # seconds between pings when measuring latency
+LATENCY_LOG_INTERVAL = 60.0
+HEADLESS_SCREEN = (1920, 1080)
+GRAB_RETRY_MS = 50
+GRAB_ATTEMPTS = 20  # about a second for the overlay to get mapped
+# Windows low level keyboard hook
+LLKHF_INJECTED = 0x10  # the event came from SendInput, not from a keyboard
+KEY_DOWN_MESSAGES = (0x0100, 0x0104)  # WM_KEYDOWN, WM_SYSKEYDOWN
+MAPVK_VK_TO_CHAR = 2
 
 win32api = None
-win32clipboard = None
 if platform.system().lower() == "windows":
     try:
         import win32api
-        import win32clipboard
     except ImportError:
         pass  
-clipboard_lock = threading.Lock()
-os_type = platform.system().lower()
 
-if os_type == "windows":
-    import win32clipboard
+class MotionCoalescer:
+    """Keeps only the latest pointer position and sends it at most once per interval.
 
-    def get_clipboard():
-        with clipboard_lock:
-            try:
-                win32clipboard.OpenClipboard()
-                data = win32clipboard.GetClipboardData()
-                win32clipboard.CloseClipboard()
-                return data
-            except Exception:
-                win32clipboard.CloseClipboard()
-                return ""
-
-    def set_clipboard(text):
-        with clipboard_lock:
-            try:
-                win32clipboard.OpenClipboard()
-                win32clipboard.EmptyClipboard()
-                win32clipboard.SetClipboardText(text)
-                win32clipboard.CloseClipboard()
-            except Exception:
-                win32clipboard.CloseClipboard()
-
-elif os_type == "linux":
-    def get_clipboard():
-        with clipboard_lock:
-            try:
-                return subprocess.check_output(['xclip', '-selection', 'clipboard', '-o']).decode()
-            except Exception:
-                return ""
+    A move that arrives while idle goes out immediately, moves inside the
+    interval are merged and flushed by a timer on the event loop. `send`
+    gets the position and the latency.now_us() of the move. `flush()`
+    sends the pending move right away so clicks and keys stay ordered
+    behind it. `push()` and `flush()` may be called from any thread.
+    """
+    def __init__(self, loop, send, rate_hz):
+        self.loop = loop
+        self.send = send
+        self.interval = 1.0 / rate_hz if rate_hz else 0.0
+        self.lock = threading.Lock()
+        self.pending = None
+        self.last_flush = 0.0
+        self.timer = None
 
-    def set_clipboard(text):
-        with clipboard_lock:
-            try:
-                p = subprocess.Popen(['xclip', '-selection', 'clipboard'], stdin=subprocess.PIPE)
-                p.communicate(input=text.encode())
-            except Exception:
-                pass
-else:
-    import pyperclip
+    def push(self, x, y):
+        with self.lock:
+            now = time.perf_counter()
+            if self.pending is None and self.timer is None and now - self.last_flush >= self.interval:
+                self.last_flush = now
+                self.send(x, y, int(now * 1_000_000))
+                return
+            self.pending = (x, y, int(now * 1_000_000))
+            if self.timer is None:
+                self.timer = True  # armed on the loop below
+                delay = max(0.0, self.last_flush + self.interval - now)
+                self.loop.call_soon_threadsafe(self._arm, delay)
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def stop(self):
+        with self.lock:
+            self.pending = None
+            if self.timer not in (None, True):
+                self.timer.cancel()
+            self.timer = None
 
-    def get_clipboard():
-        with clipboard_lock:
-            return pyperclip.paste()
+    def _arm(self, delay):
+        with self.lock:
+            if self.timer is True:
+                self.timer = self.loop.call_later(delay, self._on_timer)
 
-    def set_clipboard(text):
-        with clipboard_lock:
-            pyperclip.copy(text)
+    def _on_timer(self):
+        with self.lock:
+            self.timer = None
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self.pending is not None:
+            x, y, at = self.pending
+            self.pending = None
+            self.last_flush = time.perf_counter()
+            self.send(x, y, at)
 
 class MouseSyncApp:
-    def __init__(self):
+    """Shares this machine's pointer, keyboard and clipboard, or applies a server's.
+
+    `headless` skips the Tk/Qt app and overlay, keeps the clipboard in
+    memory and assumes a HEADLESS_SCREEN sized display. Together with
+    stub controllers this runs the whole protocol without a display,
+    which is what bench_share.py does.
+    """
+    def __init__(self, headless=False, mouse_controller=None, keyboard_controller=None):
+        self.headless = headless
         self.edge_transition_cooldown = False
+        self.edge_margin = 2
+        self.sides = {}
+        self.active_edges = ()
         self.primary_port = app_config.server_primary_port
         self.secondary_port = app_config.server_secondary_port
         self.retry = 5
-        self.mouse_controller = Controller()
-        self.keyboard_controller = KeyboardController()
+        self.mouse_controller = mouse_controller or Controller()
+        self.keyboard_controller = keyboard_controller or KeyboardController()
         self.keyboard_listener = None
-        self.keyboard_listener_lock = threading.Lock()
+        self.keys_remote = False  # the pointer route is on another screen
+        self.forward_keys = False  # gates the keyboard listener, keys_remote once keys stop reaching this machine
+        self.keyboard_grabbed = False  # Linux, the overlay holds the keyboard grab
+        self.needs_grab = platform.system() == "Linux" and not headless
+        self.keys_down = {}  # (kind, code) -> peer it was pressed on
+        self.local_keys = {}  # (kind, code) -> pynput key held down on this machine
+        self.vk_keys = {}  # Windows virtual key code -> pynput Key member
+        self.keymap = keymap.KeyMap(Key, keyboard.KeyCode)
+        self.stamp_events = app_config.latency_stats  # send latency timestamps with input events
+        self.latency = latency.LatencyStats()
+        self.stats_server = None
+        self.mouse_listener = None
         self.server_socket = None
+        self.secondary_server_socket = None
         self.client_socket = None
         self.secondary_client_socket = None
+        self.connections = []
+        self.senders = []
+        self.layout = ScreenLayout.from_config(app_config.layout, app_config.server_direction)
+        self.peers = {}  # layout node -> connected Peer (server)
+        self.active_node = SERVER
+        self.active_peer = None
+        self.route_lock = threading.Lock()
+        self.server_peer = None  # client side
+        self.offer = None  # clipboard_offer behind our promised clipboard, and the peer that made it
+        self.fetches = {}  # hash -> future of content asked for with clipboard_want
         self.overlay = None
         self.screen_width = None
         self.screen_height = None
         self.gui_app = None
-        self.last_send = None
+        self.gui_bridge = None
+        self.motion = None
+        self.loop = None
+        self.stop_event = None
+        self.transition_lock = None
+        self.tasks = set()
         self.os_type = platform.system().lower()
+        self.max_protocol = protocol.JSON_VERSION if app_config.wire_protocol == "json" else protocol.PROTOCOL_VERSION
+        self.single_connection = app_config.connection_mode != "dual"
+        self.handlers = {
+            "move": self.apply_move,
+            "click": self.apply_click,
+            "scroll": self.apply_scroll,
+            "key_press": self.apply_key_press,
+            "key_release": self.apply_key_release,
+            "active_device": self.apply_active_device,
+            "clipboard": self.apply_clipboard,
+            "clipboard_chunk": self.apply_clipboard,
+            "clipboard_have": self.apply_clipboard_have,
+            "clipboard_ref": self.apply_clipboard_ref,
+            "clipboard_want": self.apply_clipboard_want,
+            "clipboard_item": self.apply_clipboard,
+            "clipboard_data": self.apply_clipboard,
+            "clipboard_end": self.apply_clipboard,
+            "clipboard_cancel": self.apply_clipboard,
+            "clipboard_offer": self.apply_clipboard_offer,
+            "ping": self.apply_ping,
+            "pong": self.apply_pong,
+        }
 
-        logging.basicConfig(level=logging.INFO, filename="logs.log", filemode="a",format ="%(levelname)s - %(message)s")
+        logsetup.setup("share")
 
-        app_config.load()
-        app_config.active_device = False
-        app_config.save()
+        runtime_state.connect()
+        runtime_state.active_device = False
 
-        if self.os_type == "windows":
+        if headless:
+            self.screen_width, self.screen_height = HEADLESS_SCREEN
+        elif self.os_type == "windows":
             import tkinter as tk
             self.tk = tk
             self.gui_app = self.tk.Tk()
@@ -109,40 +192,82 @@ class MouseSyncApp:
             self.screen_height = self.gui_app.winfo_screenheight()
         elif self.os_type == "linux":
             from PyQt5.QtWidgets import QApplication, QWidget
-            from PyQt5.QtCore import Qt
+            from PyQt5.QtCore import Qt, QObject, QTimer, pyqtSignal, pyqtSlot
             self.Qt = Qt
+            self.QTimer = QTimer
             self.QWidget = QWidget
             self.gui_app = QApplication(sys.argv)
             screen = self.gui_app.primaryScreen().size()
             self.screen_width = screen.width()
             self.screen_height = screen.height()
 
+            class GuiBridge(QObject):
+                # Emitting from any thread queues the call onto the Qt main thread
+                call = pyqtSignal(object)
+
+                @pyqtSlot(object)
+                def run(self, fn):
+                    fn()
+
+            self.gui_bridge = GuiBridge()
+            self.gui_bridge.call.connect(self.gui_bridge.run)
+
+        # Cached clipboard, reads are a memory lookup instead of a fork or a system call
+        self.clipboard = clipboard.MemoryClipboard() if headless else clipboard.create(self.gui_app, self.run_on_gui)
+        self.history = clipboard.ClipboardHistory()
+        self.history.add(self.clipboard.digest, self.clipboard.get())
+        self.clipboard.subscribe(self.on_clipboard_change)
+
+    def run_on_gui(self, fn):
+        if self.gui_app is None:
+            return  # headless, nothing to draw
+        if self.os_type == "windows":
+            self.gui_app.after(0, fn)
+        elif self.gui_bridge:
+            self.gui_bridge.call.emit(fn)
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def request_stop(self, *_):
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
     def cleanup(self):
         print("[System] Cleaning up sockets and resources...")
         logging.info("[System] Closing all sockets")
-        try:
-            if self.client_socket:
-                self.client_socket.shutdown(socket.SHUT_RDWR)
-                self.client_socket.close()
-            if self.secondary_client_socket:
-                self.secondary_client_socket.shutdown(socket.SHUT_RDWR)
-                self.secondary_client_socket.close()
-        except Exception as e:
-            print(f"[Client] Error closing socket: {e}")
-            logging.info(f"[Client] Error closing socket: {e}")
-        try:
-            if self.server_socket:
-                self.server_socket.close()
-        except Exception as e:
-            print(f"[Server] Error closing socket: {e}")
-            logging.info(f"[Server] Error closing socket: {e}")
+        for listener in (self.mouse_listener, self.keyboard_listener):
+            if listener:
+                listener.stop()
+        if self.stats_server:
+            self.stats_server.shutdown()
+        if self.motion:
+            self.motion.stop()
+        for sender in self.senders:
+            sender.close()
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+                conn.close()
+            except Exception as e:
+                print(f"[Client] Error closing socket: {e}")
+                logging.info(f"[Client] Error closing socket: {e}")
+        for listener in (self.server_socket, self.secondary_server_socket):
+            try:
+                if listener:
+                    listener.close()
+            except Exception as e:
+                print(f"[Server] Error closing socket: {e}")
+                logging.info(f"[Server] Error closing socket: {e}")
         if self.overlay:
-            self.destroy_overlay()
-        app_config.is_running = False
-        app_config.save()
+            self.run_on_gui(self.destroy_overlay)
+        runtime_state.is_running = False
 
     def create_overlay(self):
-        if not app_config.active_device:
+        if not runtime_state.active_device or self.overlay:
             return
         if self.os_type == "windows":
             overlay = self.tk.Toplevel(self.gui_app)
@@ -166,379 +291,774 @@ class MouseSyncApp:
             overlay.show()
             overlay.raise_()
             self.overlay = overlay
+            self.grab_keyboard(overlay, GRAB_ATTEMPTS)
+
+    def grab_keyboard(self, overlay, attempts):
+        """Linux: grab the keyboard for the overlay, typed keys then only reach the client.
+
+        pynput still sees them. The X server refuses the grab until the
+        overlay is mapped, and QWindow.setKeyboardGrabEnabled() says whether
+        it took, so retry for a while. Runs on the GUI thread.
+        """
+        if overlay is not self.overlay:
+            return  # destroyed meanwhile
+        window = overlay.windowHandle()
+        if window is not None and window.setKeyboardGrabEnabled(True):
+            self.confirm_keyboard_grab(True)
+        elif attempts > 1:
+            self.QTimer.singleShot(GRAB_RETRY_MS, lambda: self.grab_keyboard(overlay, attempts - 1))
+        else:
+            self.confirm_keyboard_grab(False)
 
     def destroy_overlay(self):
         if self.overlay:
             if self.os_type == "windows":
                 self.overlay.destroy()
             elif self.os_type == "linux":
+                self.confirm_keyboard_grab(False)
+                window = self.overlay.windowHandle()
+                if window is not None:
+                    window.setKeyboardGrabEnabled(False)
                 self.overlay.close()
             self.overlay = None
 
-    def monitor_mouse_edges(self,client_socket):
-        margin = 2
-        while app_config.is_running:
-            x, y = self.mouse_controller.position
-            if not app_config.active_device and not self.edge_transition_cooldown:
-                if app_config.server_direction == "Right" and x >= self.screen_width - margin:
-                    self.transition(True, (margin, y))
-                elif app_config.server_direction == "Left" and x <= margin:
-                    self.transition(True, (self.screen_width - margin, y))
-                elif app_config.server_direction == "Top" and y <= margin:
-                    self.transition(True, (x, self.screen_height - margin))
-                elif app_config.server_direction == "Bottom" and y >= self.screen_height - margin:
-                    self.transition(True, (x, margin))
-            elif app_config.active_device and not self.edge_transition_cooldown:
-                if app_config.server_direction == "Right" and x <= margin:
-                    self.transition(False, (self.screen_width - margin, y))
-                elif app_config.server_direction == "Left" and x >= self.screen_width - margin:
-                    self.transition(False, (margin, y))
-                elif app_config.server_direction == "Top" and y >= self.screen_height - margin:
-                    self.transition(False, (x, margin))
-                elif app_config.server_direction == "Bottom" and y <= margin:
-                    self.transition(False, (x, self.screen_height - margin))
-
-            # Cooldown Reset
+    def warp(self, position):
+        if win32api and not self.headless:
+            win32api.SetCursorPos(position)
+        else:
+            self.mouse_controller.position = position
+
+    def build_edges(self):
+        """Precompute the side of the screen each layout direction leaves through.
+
+        Each side is (axis, is_high_side, threshold, warp_to): the pointer
+        crosses it when its coordinate on `axis` reaches `threshold`, and is
+        then warped to `warp_to` on that axis.
+        """
+        margin = self.edge_margin
+        right = self.screen_width - margin
+        bottom = self.screen_height - margin
+        self.sides = {
+            "Right": (0, True, right, margin),
+            "Left": (0, False, margin, right),
+            "Top": (1, False, margin, bottom),
+            "Bottom": (1, True, bottom, margin),
+        }
+        self.active_edges = self.edges_for(self.active_node)
+
+    def edges_for(self, node):
+        # Sides of `node` leading to a reachable screen, with the target appended
+        edges = []
+        for direction, target in self.layout.neighbors(node).items():
+            if target == SERVER or target in self.peers:
+                edges.append(self.sides[direction] + (target,))
+        return tuple(edges)
+
+    def check_edges(self, x, y):
+        # Called from the pynput move callback, keep it cheap
+        if self.edge_transition_cooldown:
+            margin = self.edge_margin
             if margin < x < self.screen_width - margin and margin < y < self.screen_height - margin:
                 self.edge_transition_cooldown = False
+            return False
+        for axis, high, threshold, warp, target in self.active_edges:
+            coord = x if axis == 0 else y
+            if (coord >= threshold) if high else (coord <= threshold):
+                self.request_transition(target, (warp, y) if axis == 0 else (x, warp))
+                return True
+        return False
+
+    def request_transition(self, target, new_position):
+        # Flip routing state right away, the rest runs on the event loop
+        with self.route_lock:
+            if self.motion:
+                # Pending moves belong to the screen being left
+                self.motion.flush()
+            started = latency.now_us()
+            previous = self.active_node
+            self.active_node = target
+            self.active_peer = self.peers.get(target)
+            self.active_edges = self.edges_for(target)
+            self.gate_keyboard(target != SERVER)
+            runtime_state.active_device = target != SERVER
+            self.edge_transition_cooldown = True
+        self.loop.call_soon_threadsafe(self.spawn, self.transition(previous, target, new_position, started))
+
+    def gate_keyboard(self, forward):
+        """Switch keys between the active peer and this machine, the hook itself stays up.
+
+        Called with route_lock held. On Linux keys are forwarded only once the
+        overlay holds the keyboard grab (confirm_keyboard_grab), until then
+        they stay local instead of reaching both machines.
+        """
+        leaving = forward and not self.keys_remote
+        self.keys_remote = forward
+        self.forward_keys = forward and (self.keyboard_grabbed or not self.needs_grab)
+        if leaving:
+            # Their releases may never reach the window that saw them go down, the overlay grabs them on Linux
+            for key in list(self.local_keys.values()):
+                try:
+                    self.keyboard_controller.release(key)
+                except Exception:
+                    pass
+        # Keys held on a peer would stay down on the screen we left
+        for (kind, code), peer in list(self.keys_down.items()):
+            if peer is not self.active_peer and self.keys_down.pop((kind, code), None) is not None:
+                try:
+                    peer.sender.send({"type": "key_release", "kind": kind, "code": code})
+                except Exception:
+                    pass
 
-            time.sleep(0.01)
+    def confirm_keyboard_grab(self, grabbed):
+        """Called on the GUI thread once the overlay took or gave up the keyboard grab."""
+        with self.route_lock:
+            self.keyboard_grabbed = grabbed
+            self.forward_keys = self.keys_remote and grabbed
+        if self.keys_remote and not grabbed:
+            logging.warning("[System] Could not grab the keyboard, keys stay on this machine")
 
-    def clipboard_sender(self, _socket):
-        current_clip = get_clipboard()
+    def clipboard_sender(self, sender, content):
         try:
-            data = {"type": "clipboard", "content": current_clip}
-            _socket.sendall((json.dumps(data) + "\n").encode())
-            print("[Clipboard] Sent clipboard data")
+            sender.send_clipboard(content)
+            logging.debug("[Clipboard] Sent clipboard data")
         except Exception as e:
-            print(f"[Clipboard] Error: {e}")
+            logging.error(f"[Clipboard] Error: {e}")
 
-    def transition(self, to_active, new_position):
-        app_config.load()
-        app_config.active_device = to_active
-        self.edge_transition_cooldown = True
-        if self.os_type == "windows":
-            self.gui_app.after_idle( self.create_overlay if to_active else self.destroy_overlay)
-            self.mouse_controller.position = new_position  
+    async def send_clipboard_if_changed(self, peer):
+        content, digest = self.clipboard.snapshot()
+        if peer.current == digest:
+            return
+        if peer.dedup and digest in peer.known:
+            # Seen there before, a reference is enough
+            peer.sender.cancel_clipboard()
+            peer.sender.send({"type": "clipboard_ref", "hash": digest})
+            logging.debug("[Clipboard] Sent clipboard reference")
+        elif digest != clipboard.EMPTY_HASH and self.lazy_clipboard(peer):
+            # Only say what is there, the peer asks for it when something pastes
+            peer.sender.cancel_clipboard()
+            peer.sender.send(self.describe_clipboard(content, digest))
+            logging.debug("[Clipboard] Sent clipboard offer")
         else:
-            if to_active:
-                self.create_overlay()
-            else:
-                self.destroy_overlay()
-            
-            if win32api:
-                win32api.SetCursorPos(new_position)
-            else: 
-                self.mouse_controller.position = new_position
-        
+            if self.clipboard.pending():
+                content = await self.fetch_clipboard(digest)  # passing on a clipboard we only hold a promise for
+                if content is None:
+                    return
+            self.clipboard_sender(peer.sender, content)
+        peer.remember(digest)
+
+    def lazy_clipboard(self, peer):
+        return (app_config.clipboard_mode == "lazy"
+                and peer.sender.codec.version >= protocol.CLIPBOARD_OFFER_VERSION)
+
+    def describe_clipboard(self, content, digest):
+        offer = self.offer
+        if not content and offer is not None and offer["hash"] == digest:
+            return {"type": "clipboard_offer", "hash": digest, "size": offer["size"], "mimes": offer["mimes"]}
+        return {"type": "clipboard_offer", "hash": digest, "size": clipboard.content_size(content),
+                "mimes": list(content)}
+
+    async def fetch_clipboard(self, digest):
+        """Content for `digest`, asking the peer that offered it when it is not here."""
+        content = self.history.get(digest)
+        if content is not None:
+            return content
+        content, current = self.clipboard.snapshot()
+        if current == digest and content:
+            return content  # too large for the history
+        offer = self.offer
+        if offer is None or offer["hash"] != digest:
+            return None
+        future = self.fetches.get(digest)
+        if future is None:
+            future = self.fetches[digest] = self.loop.create_future()
+            offer["peer"].sender.send({"type": "clipboard_want", "hash": digest})
+            print(f"[Clipboard] Fetching clipboard from {offer['peer'].name}")
         try:
-            active_msg = {"type": "active_device", "value": to_active}
-            self.secondary_server.sendall((json.dumps(active_msg) + "\n").encode())
+            return await asyncio.wait_for(asyncio.shield(future), CLIPBOARD_FETCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("[Clipboard] Fetching clipboard timed out")
+            logging.info("[Clipboard] Fetching clipboard timed out")
+            self.fetches.pop(digest, None)
+            return None
+
+    def fetch_clipboard_blocking(self, digest):
+        # Called by the system clipboard on a paste, never on the event loop thread
+        try:
+            future = asyncio.run_coroutine_threadsafe(self.fetch_clipboard(digest), self.loop)
+            return future.result(CLIPBOARD_FETCH_TIMEOUT + 1)
         except Exception as e:
-            print(f"[Transition] Failed to send active_device state: {e}")
-            logging.info(f"[Transition] Failed to send active_device state: {e}")
-
-        if to_active:
-            current_clip = get_clipboard()
-            if self.last_send != current_clip:
-                self.last_send = current_clip
-                self.clipboard_sender(self.secondary_server)
-
-        
-        print(f"[System] Device {'Activated' if to_active else 'Deactivated'} at {new_position}")
-        logging.info(f"[System] Device {'Activated' if to_active else 'Deactivated'} at {new_position}")
-        app_config.save()
-        time.sleep(0.2)
-
-    def input_sender_mouse(self, client_socket):
-        def send_json(data):
-            try:
-                client_socket.sendall((json.dumps(data) + "\n").encode())
-            except Exception as e:
-                app_config.is_running = False
-                app_config.save()
-                print(f"[Server] Send failed: {e}")
-                logging.info("[Server] Send failed: {e}")
-    
-        def on_move(x, y):
-            if not app_config.active_device and app_config.is_running:
-                return
-            norm_x = x / self.screen_width
-            norm_y = y / self.screen_height
-            send_json({"type": "move", "x": norm_x, "y": norm_y})
-    
-        def on_click(x, y, button, pressed):
-            if not app_config.active_device:
-                return
-            send_json({"type": "click", "button": button.name, "pressed": pressed})
-    
-        def on_scroll(x, y, dx, dy):
-            if not app_config.active_device:
-                return
-            send_json({"type": "scroll", "dx": dx, "dy": dy})
+            print(f"[Clipboard] Fetch failed: {e}")
+            return None
 
-        mouse.Listener(on_move=on_move, on_click=on_click, on_scroll=on_scroll).start()
+    def on_clipboard_change(self, content):
+        # Runs on the thread that noticed the change
+        digest = self.clipboard.digest
+        self.history.add(digest, content)
+        for peer in self.connected_peers():
+            if peer.dedup and peer.current != digest:
+                peer.sender.send({"type": "clipboard_have", "hash": digest})
 
-    def input_sender_keyboard(self, client_socket):
-        def send_json(data):
-            try:
-                client_socket.sendall((json.dumps(data) + "\n").encode())
-            except Exception as e:
-                app_config.is_running = False
-                app_config.save()
-                print(f"[Server] Send failed: {e}")
-                logging.info("[Server] Send failed: {e}")
+    async def transition(self, previous, target, new_position, started):
+        async with self.transition_lock:
+            self.run_on_gui(self.create_overlay if target != SERVER else self.destroy_overlay)
+            self.warp(new_position)
 
-        def on_press(key):
-            if not app_config.active_device:
-                return
-            try:
-                send_json({"type": "key_press", "key": key.char})
-            except AttributeError:
-                send_json({"type": "key_press", "key": str(key)})
-    
-        def on_release(key):
-            if not app_config.active_device:
-                return
-            try:
-                send_json({"type": "key_release", "key": key.char})
-            except AttributeError:
-                send_json({"type": "key_release", "key": str(key)})
-    
-        # Keyboard listener handler thread
-        def keyboard_listener_watcher():
-            while app_config.is_running:
-                with self.keyboard_listener_lock:
-                    if app_config.active_device and self.keyboard_listener is None:
-                        self.keyboard_listener = keyboard.Listener(
-                            on_press=on_press, on_release=on_release, suppress=True
-                        )
-                        self.keyboard_listener.start()
-    
-                    elif not app_config.active_device and self.keyboard_listener is not None:
-                        self.keyboard_listener.stop()
-                        self.keyboard_listener = None
-                time.sleep(0.5)
-    
-        threading.Thread(target=keyboard_listener_watcher, daemon=True).start()
-    
-    def handle_primary(self, client_socket):
-        threading.Thread(target=self.monitor_mouse_edges,args=(client_socket,), daemon=True).start()
-        threading.Thread(target=self.input_sender_mouse, args=(client_socket,), daemon=True).start()
-
-    def handle_secondary(self, sec_socket):        
-        threading.Thread(target=self.input_sender_keyboard, args=(sec_socket,), daemon=True).start()
-
-    def start_server(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind(("0.0.0.0", self.primary_port))
-        self.server_socket.listen(1)
-        print("[Server] Waiting for Client to connect")
-        logging.info("[Server] Waiting for Client to connect")
+            if self.motion:
+                self.motion.flush()
+            leaving = self.peers.get(previous)
+            entering = self.peers.get(target)
+            for peer, value in ((leaving, False), (entering, True)):
+                if peer is None:
+                    continue
+                evt = {"type": "active_device", "value": value}
+                if self.stamp_events:
+                    evt["ts"] = started
+                try:
+                    peer.sender.send(evt)
+                except Exception as e:
+                    logging.warning(f"[Transition] Failed to send active_device state: {e}",
+                                    extra=logsetup.fields("send_failed", peer=peer.name))
 
-        def accept_primary():
-            client, addr = self.server_socket.accept()
-            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            print(f"[Server] Primary connection from: {addr}")
-            client.sendall(b'CONNECTED\n')
-            self.handle_primary(client)
-
-        def accept_secondary():
-            def read_clipboard():
-                while app_config.is_running:
-                    try:
-                        data = self.secondary_server.recv(1024).decode()
-                        if not data:
-                            break
-                        else:
-                            try:
-                                evt = json.loads(data)
-                                if evt["type"] == "clipboard":
-                                    current_clipboard = evt["content"]
-                                    local_clip = get_clipboard()
-                                    if current_clipboard != local_clip:
-                                        app_config.clipboard = current_clipboard
-                                        set_clipboard(current_clipboard)
-                                        app_config.save()
-                                        logging.info("[Clipboard] Updated.")
-                            except json.JSONDecodeError as e:
-                                print(f"[Clipboard] JSON decode error: {e}")
-
-                    except Exception as e:
-                        print(f"[Clipboard] Error reading clipboard data: {e}")
-            sec_socket, sec_addr = self.secondary_server_socket.accept()
-            sec_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            print(f"[Server] Secondary connection from: {sec_addr}")
-            self.secondary_server = sec_socket
-            self.handle_secondary(sec_socket)
-            threading.Thread(target=read_clipboard, daemon=True).start()
-            logging.info("[Server] Connected Successfully")
-
-        self.secondary_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.secondary_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.secondary_server_socket.bind(("0.0.0.0", self.secondary_port))
-        self.secondary_server_socket.listen(1)
-        
-        threading.Thread(target=accept_primary, daemon=True).start()
-        threading.Thread(target=accept_secondary, daemon=True).start()
-
-    def start_client(self):
-
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-
-        self.secondary_client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.secondary_client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        print(f"[Client] Connecting to {app_config.server_ip}:{self.primary_port}")
+            # Logged only, the queue keeps console and disk writes off the input path
+            logging.info(f"[System] Switched from {previous} to {target} at {new_position}",
+                         extra=logsetup.fields("transition", source=previous, target=target,
+                                               ms=round((latency.now_us() - started) / 1000, 2)))
 
-        for i in range(10,-1,-1):
+        if entering is not None:
+            # Outside the lock, a lazy offer may wait on a clipboard fetch and later crossings must not
+            self.spawn(self.send_clipboard_if_changed(entering))
+
+    def on_send_error(self, error):
+        runtime_state.is_running = False
+
+    def open_sender(self, sock, codec, name, on_error=None):
+        sender = transport.LaneSender(self.loop, sock, codec, on_error=on_error or self.on_send_error,
+                                      chunked=self.single_connection, name=name)
+        self.senders.append(sender)
+        return sender
+
+    def hashes_clipboard(self, codec):
+        return codec.version >= protocol.CLIPBOARD_HASH_VERSION
+
+    def add_peer(self, node, peer):
+        stale = self.peers.get(node)
+        if stale is not None:
+            self.drop_peer(node, stale)
+        self.peers[node] = peer
+        with self.route_lock:
+            if self.active_node == node:
+                self.active_peer = peer
+            self.active_edges = self.edges_for(self.active_node)
+        print(f"[Server] {peer.name} placed at {node}")
+        logging.info(f"[Server] {peer.name} placed at {node}")
+
+    def drop_peer(self, node, peer):
+        """Forget `peer`, moving the pointer home if it was on that screen."""
+        if self.peers.get(node) is not peer:
+            return
+        del self.peers[node]
+        peer.close()
+        for sender in {peer.sender, peer.input_sender}:
+            if sender in self.senders:
+                self.senders.remove(sender)
+            self.close_connection(sender.sock)
+        print(f"[Server] {peer.name} disconnected")
+        logging.info(f"[Server] {peer.name} disconnected")
+        if self.active_node == node:
+            self.request_transition(SERVER, (self.screen_width // 2, self.screen_height // 2))
+        else:
+            with self.route_lock:
+                self.active_edges = self.edges_for(self.active_node)
+
+    def close_connection(self, sock):
+        if sock in self.connections:
+            self.connections.remove(sock)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    # Local input, called on the pynput listener threads
+    def send_pointer_event(self, evt):
+        peer = self.active_peer
+        if peer is not None:
+            peer.input_sender.send(evt)
+
+    def send_key_event(self, evt):
+        peer = self.active_peer
+        if peer is not None:
+            peer.sender.send(evt)
+
+    def send_move(self, x, y, at):
+        evt = {"type": "move", "x": x / self.screen_width, "y": y / self.screen_height}
+        if self.stamp_events:
+            evt["ts"] = at
+        self.send_pointer_event(evt)
+
+    def on_move(self, x, y):
+        if self.check_edges(x, y):
+            return
+        if not runtime_state.active_device and runtime_state.is_running:
+            return
+        self.motion.push(x, y)
+
+    def on_click(self, x, y, button, pressed):
+        if not runtime_state.active_device:
+            return
+        evt = {"type": "click", "button": button.name, "pressed": pressed}
+        if self.stamp_events:
+            evt["ts"] = latency.now_us()
+        self.motion.flush()
+        self.send_pointer_event(evt)
+
+    def on_scroll(self, x, y, dx, dy):
+        if not runtime_state.active_device:
+            return
+        evt = {"type": "scroll", "dx": dx, "dy": dy}
+        if self.stamp_events:
+            evt["ts"] = latency.now_us()
+        self.motion.flush()
+        self.send_pointer_event(evt)
+
+    def win32_event_filter(self, msg, data):
+        """Windows: route each key in the hook, before any window sees it.
+
+        Forwarded keys are dropped with suppress_event(), which also skips
+        on_press and on_release, so every key is routed here and the
+        callbacks never run. Injected events, like the releases gate_keyboard
+        sends, pass untouched. Returning False lets the event through to this
+        machine without the callbacks.
+        """
+        if data.flags & LLKHF_INJECTED:
+            return False
+        key = self.vk_key(data.vkCode)
+        forwarded = self.press_key(key) if msg in KEY_DOWN_MESSAGES else self.release_key(key)
+        if forwarded:
+            self.keyboard_listener.suppress_event()
+        return False
+
+    def vk_key(self, vk):
+        # Characters travel unshifted, the modifiers follow as their own keys
+        key = self.vk_keys.get(vk)
+        if key is not None:
+            return key
+        char = win32api.MapVirtualKey(vk, MAPVK_VK_TO_CHAR) if win32api else 0
+        if char and not char & 0x80000000:  # the high bit marks a dead key
+            return keyboard.KeyCode.from_char(chr(char).lower())
+        return keyboard.KeyCode.from_vk(vk)
+
+    def on_press(self, key):
+        self.press_key(key)
+
+    def on_release(self, key):
+        self.release_key(key)
+
+    def press_key(self, key):
+        """True when the key went to the active peer instead of this machine."""
+        kind, code = self.keymap.encode(key)
+        if not self.forward_keys:
+            self.local_keys[(kind, code)] = key
+            return False
+        self.local_keys.pop((kind, code), None)
+        if self.motion:
+            self.motion.flush()
+        if self.active_peer is not None:
+            self.keys_down[(kind, code)] = self.active_peer
+        evt = {"type": "key_press", "kind": kind, "code": code}
+        if self.stamp_events:
+            evt["ts"] = latency.now_us()
+        self.send_key_event(evt)
+        return True
+
+    def release_key(self, key):
+        kind, code = self.keymap.encode(key)
+        # A key pressed before crossing is released here, not on the peer that never saw it go down
+        if self.local_keys.pop((kind, code), None) is not None or not self.forward_keys:
+            return False
+        if self.motion:
+            self.motion.flush()
+        self.keys_down.pop((kind, code), None)
+        evt = {"type": "key_release", "kind": kind, "code": code}
+        if self.stamp_events:
+            evt["ts"] = latency.now_us()
+        self.send_key_event(evt)
+        return True
+
+    def input_sender_mouse(self):
+        self.motion = MotionCoalescer(self.loop, self.send_move, app_config.pointer_rate_hz)
+        self.mouse_listener = mouse.Listener(on_move=self.on_move, on_click=self.on_click, on_scroll=self.on_scroll)
+        self.mouse_listener.start()
+
+    def input_sender_keyboard(self):
+        # Created once and gated by forward_keys. Forwarded keys are kept from this
+        # machine by win32_event_filter() on Windows, the overlay's keyboard grab on Linux.
+        self.vk_keys = {key.value.vk: key for key in Key}  # as pynput's win32 listener maps them
+        self.keyboard_listener = keyboard.Listener(on_press=self.on_press, on_release=self.on_release,
+                                                   win32_event_filter=self.win32_event_filter)
+        self.keyboard_listener.start()
+
+    def start_capture(self):
+        self.build_edges()
+        self.input_sender_mouse()
+        self.input_sender_keyboard()
+
+    # Incoming events, shared by server and client
+    def apply_move(self, evt, peer):
+        self.warp((int(evt["x"] * self.screen_width), int(evt["y"] * self.screen_height)))
+
+    def apply_click(self, evt, peer):
+        btn = getattr(Button, evt['button'])
+        if evt['pressed']:
+            self.mouse_controller.press(btn)
+        else:
+            self.mouse_controller.release(btn)
+
+    def apply_scroll(self, evt, peer):
+        self.mouse_controller.scroll(evt['dx'], evt['dy'])
+
+    def parse_key(self, evt):
+        if "code" in evt:
+            key = self.keymap.decode(evt["kind"], evt["code"])
+        else:
+            key = self.keymap.parse(evt["key"])  # older peer
+        if key is None:
+            print(f"[Parse] No such key here: {evt}")
+        return key
+
+    def apply_key_press(self, evt, peer):
+        key = self.parse_key(evt)
+        if key:
+            self.keyboard_controller.press(key)
+
+    def apply_key_release(self, evt, peer):
+        key = self.parse_key(evt)
+        if key:
+            self.keyboard_controller.release(key)
+
+    def apply_active_device(self, evt, peer):
+        runtime_state.active_device = evt["value"]
+        if not runtime_state.active_device:
+            self.spawn(self.send_clipboard_if_changed(peer))
+
+    def apply_clipboard(self, evt, peer):
+        content = peer.clipboard.feed(evt)
+        if content is not None:
+            self.spawn(self.store_clipboard(content, peer))
+
+    async def store_clipboard(self, content, peer):
+        digest = clipboard.content_hash(content)
+        peer.remember(digest)
+        future = self.fetches.pop(digest, None)
+        if future is not None and not future.done():
+            future.set_result(content)
+        if self.clipboard.digest == digest and self.clipboard.pending():
+            # Fetched for a promise, the system clipboard already offers it
+            self.history.add(digest, content)
+            self.clipboard.fulfil(digest, content)
+            print("[Clipboard] Fetched clipboard content")
+            return
+        if self.clipboard.get() != content:
+            # Writing may still block on Windows, keep it off the loop
+            await self.loop.run_in_executor(None, self.clipboard.set, content)
+            print("[Clipboard] Updated clipboard content")
+            logging.info("[Clipboard] Updated.")
+        # A client left for another one, pass its clipboard along
+        active = self.active_peer
+        if active is not None and active is not peer:
+            await self.send_clipboard_if_changed(active)
+
+    def apply_clipboard_have(self, evt, peer):
+        peer.remember(evt["hash"])
+
+    def apply_clipboard_ref(self, evt, peer):
+        content = self.history.get(evt["hash"])
+        if content is None:
+            # Dropped from our history since, ask for the content itself
+            peer.sender.send({"type": "clipboard_want", "hash": evt["hash"]})
+            return
+        self.spawn(self.store_clipboard(content, peer))
+
+    def apply_clipboard_want(self, evt, peer):
+        self.spawn(self.answer_clipboard_want(evt["hash"], peer))
+
+    async def answer_clipboard_want(self, digest, peer):
+        content = await self.fetch_clipboard(digest)
+        if content is None:
+            return
+        peer.known.pop(digest, None)
+        self.clipboard_sender(peer.sender, content)
+        peer.remember(digest)
+
+    def apply_clipboard_offer(self, evt, peer):
+        digest = evt["hash"]
+        peer.remember(digest)
+        content = self.history.get(digest)
+        if content is not None:
+            self.spawn(self.store_clipboard(content, peer))
+            return
+        if self.clipboard.digest == digest:
+            return
+        self.offer = dict(evt, peer=peer)
+        if self.clipboard.promise(digest, evt["mimes"], lambda: self.fetch_clipboard_blocking(digest)):
+            print(f"[Clipboard] {evt['size']} bytes available from {peer.name}, fetched on paste")
+            logging.info(f"[Clipboard] Offer of {evt['size']} bytes from {peer.name}")
+        else:
+            # No way to defer on this platform, fetch now
+            self.spawn(self.fetch_clipboard(digest))
+
+    async def receive_events(self, sock, codec, label, peer):
+        """Apply events from `sock` until the connection closes."""
+        reader = protocol.FramedReader(sock, codec)
+        handlers = self.handlers
+        stamp = None  # latency timestamp of the next event
+        while runtime_state.is_running:
             try:
-                self.client_socket.connect((app_config.server_ip, self.primary_port))
-                if self.client_socket.recv(1024) != b'CONNECTED\n':
-                    raise Exception("Handshake failed")
+                events = await reader.read_async(self.loop)
+            except (ValueError, protocol.ProtocolError) as e:
+                # Only binary codecs raise, the frame boundary is lost and anything further would be garbage
+                print(f"[{label}] Decode error, closing connection: {e}")
+                logging.warning(f"[{label}] Decode error, closing connection: {e}")
                 break
             except Exception as e:
-                E = e
-                print(f"Retrying connection (primary) Attempt: {i}")
-                logging.info(f"Retrying connection (primary) Attempt: {i}")
-                time.sleep(1)
-        else:
-            print(f"[Client] Connection failed: {E}")
-            logging.info(f"[Client] Connection failed: {E}")
-            app_config.is_running = False
-            self.cleanup()
-            app_config.save()
+                print(f"[{label}] Receive error: {e}")
+                break
+            if events is None:
+                break
+            if reader.errors:
+                for e in reader.errors:
+                    print(f"[{label}] Skipped undecodable line: {e}")
+                reader.errors.clear()
+            for evt in events:
+                kind = evt["type"]
+                if kind == "stamp":
+                    stamp = evt["t"]
+                    continue
+                try:
+                    handlers[kind](evt, peer)
+                except Exception as e:
+                    print(f"[{label}] Event error: {e}")
+                if stamp is not None:
+                    self.record_latency(kind, stamp, peer)
+                    stamp = None
+
+    def record_latency(self, kind, stamp, peer):
+        sent = peer.clock.to_local(stamp)
+        if sent is None:
+            return  # no clock offset yet
+        # Offset estimates are off by up to half the round trip asymmetry, never report below zero
+        ms = max(0.0, (latency.now_us() - sent) / 1000)
+        self.latency.record(latency.KINDS.get(kind, kind), ms)
+
+    def apply_ping(self, evt, peer):
+        peer.sender.send({"type": "pong", "t": evt["t"], "remote": latency.now_us()})
+
+    def apply_pong(self, evt, peer):
+        peer.clock.add(evt["t"], evt["remote"], latency.now_us())
+
+    def connected_peers(self):
+        return list(self.peers.values()) if self.server_peer is None else [self.server_peer]
+
+    async def measure_latency(self):
+        """Keep clock offsets fresh and log a latency summary now and then."""
+        last_log = time.monotonic()
+        while runtime_state.is_running:
+            for peer in self.connected_peers():
+                if peer.sender.codec.version >= protocol.LATENCY_VERSION:
+                    peer.sender.send({"type": "ping", "t": latency.now_us()})
+            await asyncio.sleep(CLOCK_SYNC_INTERVAL)
+            if time.monotonic() - last_log >= LATENCY_LOG_INTERVAL:
+                last_log = time.monotonic()
+                summary = self.latency.summary()
+                if summary:
+                    print(f"[Latency] {summary}")
+                    logging.info(f"[Latency] {summary}")
+
+    def stats(self):
+        return {
+            "latency_ms": self.latency.snapshot(),
+            "clocks": {peer.name: peer.clock.stats() for peer in self.connected_peers()},
+        }
+
+    def listen(self, port):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("0.0.0.0", port))
+        listener.listen(5)
+        listener.setblocking(False)
+        return listener
+
+    async def accept_connection(self, listener, label):
+        client, addr = await self.loop.sock_accept(listener)
+        client.setblocking(False)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections.append(client)
+        print(f"[Server] {label} connection from: {addr}")
+        return client
+
+    async def handshake(self, client, label):
+        codec, name = await protocol.server_handshake(self.loop, client, self.max_protocol)
+        logging.info(f"[Server] {label} protocol: {codec.name}")
+        return codec, name
+
+    async def accept(self, listener, label):
+        client = await self.accept_connection(listener, label)
+        codec, name = await self.handshake(client, label)
+        return client, codec, name
+
+    async def handle_client(self, client):
+        """Handshake and serve one client, a failure only drops this connection."""
+        try:
+            codec, name = await self.handshake(client, "Client")
+        except (OSError, protocol.ProtocolError) as e:
+            print(f"[Server] Handshake failed: {e}")
+            logging.info(f"[Server] Handshake failed: {e}")
+            self.close_connection(client)
+            return
+        await self.serve_client(client, codec, name)
+
+    async def serve_client(self, client, codec, name):
+        node = self.layout.place(name, self.peers)
+        if node is None:
+            print(f"[Server] No place in the layout for {name}, closing connection")
+            logging.info(f"[Server] No place in the layout for {name}")
+            self.close_connection(client)
             return
-        print("[Client] Primary Connected")
+        # Every client gets its own sender, a slow one never holds up the others
+        sender = self.open_sender(client, codec, f"Server:{node}",
+                                  on_error=lambda e: self.close_connection(client))
+        peer = transport.Peer(name or node, sender, dedup=self.hashes_clipboard(codec))
+        self.add_peer(node, peer)
+        try:
+            await self.receive_events(client, codec, "Server", peer)
+        finally:
+            self.drop_peer(node, peer)
+            self.close_connection(client)
 
-        def receive_primary():
-            buffer = ""
-            while app_config.is_running:
+    async def start_server(self):
+        self.server_socket = self.listen(self.primary_port)
+        self.start_capture()
+        print("[Server] Waiting for Client to connect")
+        logging.info("[Server] Waiting for Client to connect")
+
+        if self.single_connection:
+            while runtime_state.is_running:
+                # Only accepting here, a slow or broken handshake never holds up the next client
                 try:
-                    data = self.client_socket.recv(1024).decode()
-                except Exception as e:
-                    print(f"[Client] Receive error: {e}")
-                    app_config.is_running = False
-                    app_config.save()
-                    break
-                if not data:
-                    break
-                buffer += data
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    try:
-                        evt = json.loads(line)
-                        if evt["type"] == "move":
-                            x = int(evt["x"] * self.screen_width)
-                            y = int(evt["y"] * self.screen_height)
-                            new_position = (x,y)
-                            if win32api:
-                                win32api.SetCursorPos(new_position)
-                            else: 
-                                self.mouse_controller.position = new_position
-                        elif evt["type"] == "click":
-                            btn = getattr(Button, evt['button'])
-                            if evt['pressed']:
-                                self.mouse_controller.press(btn)
-                            else:
-                                self.mouse_controller.release(btn)
-                        elif evt["type"] == "scroll":
-                            self.mouse_controller.scroll(evt['dx'], evt['dy'])
-                    except Exception as e:
-                        print(f"[Client] Parse error: {e}")
-
-        print(f"[Client] Connecting to {app_config.server_ip}:{self.secondary_port}")
+                    client = await self.accept_connection(self.server_socket, "Client")
+                except OSError as e:
+                    if self.server_socket.fileno() < 0:
+                        break  # closed by cleanup
+                    logging.info(f"[Server] Accept failed: {e}")
+                    continue
+                self.spawn(self.handle_client(client))
+            return
+
+        # The legacy two port setup serves a single client
+        self.secondary_server_socket = self.listen(self.secondary_port)
+        (client, codec, name), (sec_socket, sec_codec, _) = await asyncio.gather(
+            self.accept(self.server_socket, "Primary"),
+            self.accept(self.secondary_server_socket, "Secondary"),
+        )
+        node = self.layout.place(name, self.peers)
+        if node is None:
+            print(f"[Server] No place in the layout for {name}")
+            runtime_state.is_running = False
+            return
+        peer = transport.Peer(name or node, self.open_sender(sec_socket, sec_codec, "Server"),
+                              input_sender=self.open_sender(client, codec, "Server"),
+                              dedup=self.hashes_clipboard(sec_codec))
+        self.add_peer(node, peer)
+        logging.info("[Server] Connected Successfully")
+        await self.receive_events(sec_socket, sec_codec, "Clipboard", peer)
+        runtime_state.is_running = False
+
+    async def connect(self, port, label, handshake=True):
+        """Connect to the server with retries, returns (socket, codec, negotiated) or None."""
+        print(f"[Client] Connecting to {app_config.server_ip}:{port}")
         for i in range(10,-1,-1):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(False)
             try:
-                self.secondary_client_socket.connect((app_config.server_ip, self.secondary_port))
-                logging.info("[Client] Connected successfully.")
-                print("[Client] Connected successfully.")
-                break
+                await self.loop.sock_connect(sock, (app_config.server_ip, port))
+                if handshake:
+                    codec, negotiated = await protocol.client_handshake(
+                        self.loop, sock, self.max_protocol, app_config.client_name or socket.gethostname())
+                else:
+                    codec, negotiated = protocol.JsonCodec(), False
+                self.connections.append(sock)
+                print(f"[Client] {label} Connected ({codec.name})")
+                logging.info(f"[Client] {label} Connected ({codec.name})")
+                return sock, codec, negotiated
             except Exception as e:
                 E = e
-                logging.info(f"Retrying connection (secondary) Attempt: {i}")
-                print(f"Retrying connection (secondary) Attempt: {i}")
-                time.sleep(1)
-        else:
-            print(f"[Client] Connection failed: {E}")
-            logging.info(f"[Client] Connection failed: {E}")
-            app_config.is_running = False
-            self.cleanup()
-            app_config.save()
-            return 
-        print("[Client] Secondary Connected")
-                
-        def receive_secondary():
-            def parse_key(key_str):
-                if key_str.startswith("Key."):
-                    try:
-                        return getattr(Key, key_str.split(".", 1)[1])
-                    except AttributeError:
-                        print(f"[Parse] Unknown special key: {key_str}")
-                        return None
-                return key_str
-            buffer = ""
-            while app_config.is_running:
-                try:
-                    data = self.secondary_client_socket.recv(1024).decode()
-                except Exception as e:
-                    print(f"[Client] Secondary receive error: {e}")
-                    app_config.is_running = False
-                    app_config.save()
-                    break
-                if not data:
-                    break
-                buffer += data
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    try:
-                        evt = json.loads(line)
-                        if evt["type"] == "key_press":
-                            key = parse_key(evt["key"])
-                            if key:
-                                self.keyboard_controller.press(key)
-                        elif evt["type"] == "key_release":
-                            key = parse_key(evt["key"])
-                            if key:
-                                self.keyboard_controller.release(key)
-                        elif evt["type"] == "active_device":
-                            app_config.active_device = evt["value"]
-                            app_config.save()
-                            if not app_config.active_device:
-                                current_clip = get_clipboard()
-                                if self.last_send != current_clip:
-                                    self.last_send = current_clip
-                                    self.clipboard_sender(self.secondary_client_socket)
-                        elif evt["type"] == "clipboard":
-                            current_clip = get_clipboard()
-                            if current_clip != evt["content"]:
-                                app_config.clipboard = evt["content"]
-                                set_clipboard(evt["content"])
-                                self.last_send = evt["content"]
-                                app_config.save()
-                                print("[Clipboard] Updated clipboard content")
-                                logging.info("[Clipboard] Updated.")
-
-                    except Exception as e:
-                        print(f"[Client] Secondary parse error: {e}")
-
-        threading.Thread(target=receive_primary, daemon=True).start()
-        threading.Thread(target=receive_secondary, daemon=True).start()
+                sock.close()
+                print(f"Retrying connection ({label.lower()}) Attempt: {i}")
+                logging.info(f"Retrying connection ({label.lower()}) Attempt: {i}")
+                await asyncio.sleep(1)
+        print(f"[Client] Connection failed: {E}")
+        logging.info(f"[Client] Connection failed: {E}")
+        runtime_state.is_running = False
+        return None
 
-    def run(self):
-        app_config.is_running = True
+    async def start_client(self):
+        primary = await self.connect(self.primary_port, "Primary")
+        if primary is None:
+            return
+        self.client_socket, codec, negotiated = primary
+        if self.single_connection:
+            self.server_peer = transport.Peer(SERVER, self.open_sender(self.client_socket, codec, "Client"),
+                                              dedup=self.hashes_clipboard(codec))
+            await self.receive_events(self.client_socket, codec, "Client", self.server_peer)
+            runtime_state.is_running = False
+            return
+
+        secondary = await self.connect(self.secondary_port, "Secondary", handshake=negotiated)
+        if secondary is None:
+            return
+        self.secondary_client_socket, sec_codec, _ = secondary
+        self.server_peer = transport.Peer(SERVER, self.open_sender(self.secondary_client_socket, sec_codec, "Client"),
+                                          dedup=self.hashes_clipboard(sec_codec))
+
+        # Losing either connection ends the session
+        await asyncio.wait([
+            self.spawn(self.receive_events(self.client_socket, codec, "Client", self.server_peer)),
+            self.spawn(self.receive_events(self.secondary_client_socket, sec_codec, "Client", self.server_peer)),
+        ], return_when=asyncio.FIRST_COMPLETED)
+        runtime_state.is_running = False
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.transition_lock = asyncio.Lock()
+        runtime_state.subscribe("stop_flag", lambda stop: stop and self.request_stop())
+        runtime_state.subscribe("is_running", lambda running: running or self.request_stop())
+
+        if app_config.latency_stats:
+            self.spawn(self.measure_latency())
+            if app_config.stats_port:
+                self.stats_server = latency.serve(app_config.stats_port, {"share": self.stats})
         if app_config.mode == "server":
-            self.start_server()
+            self.spawn(self.start_server())
         else:
-            self.start_client()
-
-        def monitor_stop():
-            while app_config.is_running and not app_config.stop_flag:
-                time.sleep(0.5)
-            self.cleanup()
-            self.gui_app.quit()
-        threading.Thread(target=monitor_stop, daemon=True).start()
+            self.spawn(self.start_client())
+        if runtime_state.is_running and not runtime_state.stop_flag:
+            await self.stop_event.wait()
+
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.cleanup()
+        if self.gui_app is not None:
+            self.run_on_gui(self.gui_app.quit)
+
+    def run(self):
+        runtime_state.is_running = True
+        if self.headless:
+            asyncio.run(self.main())
+            return
+        threading.Thread(target=asyncio.run, args=(self.main(),), daemon=True).start()
 
         if self.os_type == "windows":
             self.gui_app.mainloop()
@@ -0,0 +1,363 @@
+# transport.py
+import asyncio
+import itertools
+import logging
+import time
+import zlib
+from collections import deque, OrderedDict
+
+import clipboard
+import logsetup
+from latency import ClockSync
+from protocol import CLIPBOARD_STREAM_VERSION
+
+# Logical channels, every event type belongs to exactly one
+CHANNEL_POINTER = "pointer"
+CHANNEL_KEYBOARD = "keyboard"
+CHANNEL_CONTROL = "control"
+CHANNEL_CLIPBOARD = "clipboard"
+
+CHANNELS = {
+    "move": CHANNEL_POINTER,
+    "click": CHANNEL_POINTER,
+    "scroll": CHANNEL_POINTER,
+    "key_press": CHANNEL_KEYBOARD,
+    "key_release": CHANNEL_KEYBOARD,
+    "active_device": CHANNEL_CONTROL,
+    "ping": CHANNEL_CONTROL,
+    "pong": CHANNEL_CONTROL,
+    "clipboard": CHANNEL_CLIPBOARD,
+    "clipboard_chunk": CHANNEL_CLIPBOARD,
+    "clipboard_have": CHANNEL_CLIPBOARD,
+    "clipboard_ref": CHANNEL_CLIPBOARD,
+    "clipboard_want": CHANNEL_CLIPBOARD,
+    "clipboard_item": CHANNEL_CLIPBOARD,
+    "clipboard_data": CHANNEL_CLIPBOARD,
+    "clipboard_end": CHANNEL_CLIPBOARD,
+    "clipboard_cancel": CHANNEL_CLIPBOARD,
+    "clipboard_offer": CHANNEL_CLIPBOARD,
+}
+
+# Channels written only when nothing interactive is waiting
+BULK_CHANNELS = {CHANNEL_CLIPBOARD}
+
+CLIPBOARD_CHUNK = 16 * 1024  # characters per clipboard_chunk frame
+STREAM_CHUNK = 64 * 1024  # uncompressed bytes per clipboard_data frame
+COMPRESS_MIN = 1024  # smaller items are sent as is
+COMPRESS_LEVEL = 1  # zlib, fast beats small on a LAN
+PROGRESS_MIN = 1024 * 1024  # transfers this large log their progress
+PRECOMPRESSED = ("image/png", "image/jpeg", "image/gif", "image/webp")
+KNOWN_HASHES = 64  # clipboard hashes remembered per peer
+
+def log_progress(label, done, total, state):
+    """Log each quarter of a large transfer, `state` holds the last one logged."""
+    if total < PROGRESS_MIN:
+        return
+    quarter = 4 * done // total
+    if quarter > state[0]:
+        state[0] = quarter
+        print(f"[Clipboard] {label} {done * 100 // total}% of {total // 1024} KB")
+        logging.info(f"[Clipboard] {label} {done * 100 // total}% of {total // 1024} KB")
+
+class ClipboardStream:
+    """One clipboard transfer, encoded into frames as the writer asks for them.
+
+    Every format goes out as clipboard_item (MIME type, size, flags), its
+    bytes in clipboard_data frames of up to STREAM_CHUNK and clipboard_end.
+    Compressible formats are deflated on the fly, so neither the compressed
+    copy nor the frames of a large image ever exist in memory all at once.
+    `cancel()` stops the transfer, the peer is told with clipboard_cancel
+    if it already saw part of it.
+    """
+    def __init__(self, codec, transfer_id, content):
+        self.codec = codec
+        self.id = transfer_id
+        self.content = content
+        self.total = max(1, clipboard.content_size(content))
+        self.done = 0
+        self.wire = 0
+        self.started = False
+        self.finished = False
+        self.cancelled = False
+        self.progress = [0]
+        self.frames = self._frames()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def next_frame(self):
+        """Return the next encoded frame, None once nothing is left to send."""
+        if self.finished:
+            return None
+        if self.cancelled:
+            self.finished = True
+            if self.started:
+                print(f"[Clipboard] Transfer {self.id} superseded at {self.done * 100 // self.total}%")
+                return self.codec.encode({"type": "clipboard_cancel", "id": self.id})
+            return None
+        frame = next(self.frames, None)
+        if frame is None:
+            self.finished = True
+            logging.info(f"[Clipboard] Sent {self.done} bytes as {self.wire}")
+            return None
+        self.started = True
+        self.wire += len(frame)
+        return frame
+
+    def _frames(self):
+        encode = self.codec.encode
+        items = list(self.content.items())
+        for index, (mime, data) in enumerate(items):
+            compressed = len(data) >= COMPRESS_MIN and mime not in PRECOMPRESSED
+            yield encode({"type": "clipboard_item", "id": self.id, "mime": mime, "size": len(data),
+                          "compressed": compressed, "last": index == len(items) - 1})
+            deflate = zlib.compressobj(COMPRESS_LEVEL) if compressed else None
+            view = memoryview(data)
+            for start in range(0, len(data), STREAM_CHUNK):
+                piece = view[start:start + STREAM_CHUNK]
+                out = deflate.compress(piece) if deflate else bytes(piece)
+                self.done += len(piece)
+                log_progress("Sending", self.done, self.total, self.progress)
+                if out:
+                    yield encode({"type": "clipboard_data", "id": self.id, "data": out})
+            if deflate:
+                yield encode({"type": "clipboard_data", "id": self.id, "data": deflate.flush()})
+            yield encode({"type": "clipboard_end", "id": self.id})
+
+class LaneSender:
+    """Writes events to one non-blocking socket from an asyncio task.
+
+    Pointer, keyboard and control events share the realtime lane, which is
+    written first and keeps their relative order (a click must not overtake
+    the keys typed after it). Clipboard data goes on the bulk lane and is
+    written one chunk at a time, only while the realtime lane is empty, so a
+    large clipboard never delays a keystroke queued behind it. A newer
+    clipboard cancels a transfer that is still queued or in flight.
+
+    `send()` may be called from any thread, e.g. pynput callbacks. Frames
+    are encoded by the caller and the writer task is woken at most once per
+    burst through call_soon_threadsafe.
+    """
+    def __init__(self, loop, sock, codec, on_error=None, chunked=True, name="Sender"):
+        self.loop = loop
+        self.sock = sock
+        self.codec = codec
+        self.on_error = on_error
+        self.chunked = chunked
+        self.name = name
+        self.realtime = deque()
+        self.bulk = deque()
+        self.streams = []
+        self.transfer_ids = itertools.count(1)
+        self.wakeup = asyncio.Event()
+        self.wake_pending = False
+        self.running = True
+        self.task = loop.create_task(self._run())
+
+    def send(self, evt):
+        frame = self.codec.encode(evt)
+        if CHANNELS.get(evt["type"]) in BULK_CHANNELS:
+            self.bulk.append(frame)
+        else:
+            self.realtime.append(frame)
+        self._notify()
+
+    def send_clipboard(self, content):
+        """Queue clipboard content, superseding any transfer not yet done.
+
+        Peers before CLIPBOARD_STREAM_VERSION only get the text, split into
+        chunks when they support it.
+        """
+        self.cancel_clipboard()
+        if self.codec.version >= CLIPBOARD_STREAM_VERSION:
+            stream = ClipboardStream(self.codec, next(self.transfer_ids) & 0xFFFFFFFF, content)
+            self.streams.append(stream)
+            self.bulk.append(stream)
+            self._notify()
+            return
+        if clipboard.TEXT not in content:
+            print("[Clipboard] Peer only takes text, not sending")
+            return
+        text = clipboard.content_text(content)
+        if not self.chunked:
+            self.send({"type": "clipboard", "content": text})
+            return
+        frames = []
+        for start in range(0, max(len(text), 1), CLIPBOARD_CHUNK):
+            final = start + CLIPBOARD_CHUNK >= len(text)
+            frames.append(self.codec.encode({"type": "clipboard_chunk", "content": text[start:start + CLIPBOARD_CHUNK], "final": final}))
+        # One extend so concurrent transfers never interleave their chunks
+        self.bulk.extend(frames)
+        self._notify()
+
+    def cancel_clipboard(self):
+        for stream in self.streams:
+            stream.cancel()
+        self.streams = []
+
+    def close(self):
+        self.running = False
+        self.realtime.clear()
+        self.bulk.clear()
+        self.loop.call_soon_threadsafe(self.task.cancel)
+
+    def _notify(self):
+        if not self.wake_pending and self.running:
+            self.wake_pending = True
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        self.wake_pending = False
+        self.wakeup.set()
+
+    async def _run(self):
+        realtime, bulk = self.realtime, self.bulk
+        try:
+            while self.running:
+                if not realtime and not bulk:
+                    self.wakeup.clear()
+                    if not realtime and not bulk:
+                        await self.wakeup.wait()
+                    continue
+                if realtime:
+                    # Everything interactive that piled up goes out in one syscall
+                    frames = []
+                    while realtime:
+                        frames.append(realtime.popleft())
+                    data = b"".join(frames)
+                elif isinstance(bulk[0], ClipboardStream):
+                    data = bulk[0].next_frame()
+                    if data is None:
+                        bulk.popleft()
+                        continue
+                else:
+                    data = bulk.popleft()
+                await self.loop.sock_sendall(self.sock, data)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.warning(f"[{self.name}] Send failed: {e}", extra=logsetup.fields("send_failed", lane=self.name))
+            self.running = False
+            if self.on_error:
+                self.on_error(e)
+
+class ClipboardAssembler:
+    """Rebuilds clipboard content from clipboard events.
+
+    Streamed transfers are inflated item by item as data arrives. A
+    transfer with a new id replaces an unfinished one, a cancelled or
+    malformed one is dropped. Text from older peers (whole or in
+    clipboard_chunk parts) becomes text-only content.
+    """
+    def __init__(self):
+        self.parts = []
+        self.dropped = None
+        self.reset(None)
+
+    def reset(self, transfer_id):
+        self.id = transfer_id
+        self.items = {}
+        self.item = None  # (mime, size, last) of the format being received
+        self.chunks = []
+        self.received = 0
+        self.inflate = None
+        self.progress = [0]
+        self.started = time.monotonic()
+
+    def feed(self, evt):
+        """Return the clipboard content once complete, otherwise None."""
+        kind = evt["type"]
+        if kind == "clipboard":
+            self.parts = []
+            return clipboard.text_content(evt["content"])
+        if kind == "clipboard_chunk":
+            self.parts.append(evt["content"])
+            if not evt["final"]:
+                return None
+            text = "".join(self.parts)
+            self.parts = []
+            return clipboard.text_content(text)
+        if kind == "clipboard_cancel":
+            if evt["id"] == self.id:
+                self.reset(None)
+            return None
+        if kind == "clipboard_item":
+            if evt["id"] == self.dropped:
+                return None
+            if evt["id"] != self.id:
+                self.reset(evt["id"])
+            if evt["size"] > clipboard.MAX_ITEM_BYTES:
+                return self._fail(f"{evt['mime']} too large ({evt['size']} bytes)")
+            self.item = (evt["mime"], evt["size"], evt["last"])
+            self.chunks = []
+            self.received = 0
+            self.progress = [0]
+            self.inflate = zlib.decompressobj() if evt["compressed"] else None
+            return None
+        if evt["id"] != self.id or self.item is None:
+            return None  # rest of a transfer we gave up on
+        mime, size, last = self.item
+        if kind == "clipboard_data":
+            data = evt["data"]
+            if self.inflate:
+                # Never inflate past the announced size
+                data = self.inflate.decompress(data, size - self.received + 1)
+            self.received += len(data)
+            if self.received > size:
+                return self._fail(f"{mime} larger than announced")
+            self.chunks.append(data)
+            log_progress("Receiving", self.received, size, self.progress)
+            return None
+        # clipboard_end
+        if self.inflate:
+            self.chunks.append(self.inflate.flush())
+            self.received = sum(len(chunk) for chunk in self.chunks)
+        if self.received != size:
+            return self._fail(f"{mime} incomplete ({self.received} of {size} bytes)")
+        self.items[mime] = b"".join(self.chunks)
+        self.item, self.chunks = None, []
+        if not last:
+            return None
+        content = self.items
+        logging.info(f"[Clipboard] Received {clipboard.content_size(content)} bytes "
+                     f"in {time.monotonic() - self.started:.2f} s")
+        self.reset(None)
+        return content
+
+    def _fail(self, reason):
+        print(f"[Clipboard] Dropping transfer {self.id}: {reason}")
+        logging.info(f"[Clipboard] Dropping transfer {self.id}: {reason}")
+        self.dropped = self.id
+        self.reset(None)
+        return None
+
+class Peer:
+    """A connected machine and the senders used to reach it.
+
+    In dual mode pointer events use the primary connection (`input_sender`)
+    and everything else the secondary one, otherwise both are the same.
+    `current` is the hash of the clipboard the peer holds, `known` the
+    hashes it still has in its clipboard history. `clock` maps the
+    peer's latency timestamps onto ours.
+    """
+    def __init__(self, name, sender, input_sender=None, dedup=False):
+        self.name = name
+        self.sender = sender
+        self.input_sender = input_sender or sender
+        self.clipboard = ClipboardAssembler()
+        self.dedup = dedup
+        self.current = None
+        self.known = OrderedDict()
+        self.clock = ClockSync()
+
+    def remember(self, digest):
+        self.current = digest
+        self.known[digest] = True
+        self.known.move_to_end(digest)
+        while len(self.known) > KNOWN_HASHES:
+            self.known.popitem(last=False)
+
+    def close(self):
+        self.sender.close()
+        if self.input_sender is not self.sender:
+            self.input_sender.close()